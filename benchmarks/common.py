@@ -0,0 +1,102 @@
+"""
+Helpers shared by the benchmark scripts in this folder.
+
+The folder deliberately has no `__init__.py`, so Red's downloader never mistakes it for a cog. Scripts are run
+directly, like `python benchmarks/recurring_scheduler.py`, and import this file as a plain module.
+"""
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List
+
+ROOT = Path(__file__).resolve().parent.parent
+
+if str(ROOT) not in sys.path:
+	sys.path.insert(0, str(ROOT))
+
+
+def percentiles(values: Iterable[float], points: Iterable[int] = (50, 90, 99)) -> Dict[str, float]:
+	"""Returns nearest-rank percentiles of the values, plus their maximum, keyed like `p50`."""
+	values = sorted(values)
+
+	if not values:
+		return {**{f"p{point}": None for point in points}, "max": None}
+
+	result = {f"p{point}": values[max(0, -(-point * len(values) // 100) - 1)] for point in points}
+	result["max"] = values[-1]
+	return result
+
+
+def peak_rss_mb() -> float:
+	"""Returns the peak resident set size of this process so far, in MiB."""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports it in KiB, macOS in bytes.
+	return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+async def setup_config(data_path: Path):
+	"""Points Red's data manager at a scratch folder with the JSON driver, so cogs can use Config without a bot."""
+	from redbot.core import data_manager, drivers
+
+	data_manager.basic_config = data_manager.basic_config_default.copy()
+	data_manager.basic_config.update(DATA_PATH=str(data_path), STORAGE_TYPE="JSON", STORAGE_DETAILS={})
+	await drivers.get_driver_class().initialize(**data_manager.storage_details())
+
+
+class DriverCounter:
+	"""Counts the reads and writes a Config object makes to its storage driver."""
+	def __init__(self, config):
+		self.reads = 0
+		self.writes = 0
+		driver = config.driver
+
+		def counted(method: Callable, attribute: str):
+			async def wrapper(*args, **kwargs):
+				setattr(self, attribute, getattr(self, attribute) + 1)
+				return await method(*args, **kwargs)
+
+			return wrapper
+
+		driver.get = counted(driver.get, "reads")
+		driver.set = counted(driver.set, "writes")
+		driver.clear = counted(driver.clear, "writes")
+
+	def snapshot(self) -> Dict[str, int]:
+		return {"reads": self.reads, "writes": self.writes}
+
+
+def run_isolated(function: Callable, *args):
+	"""Runs a function in a fresh process, so every run's peak memory is measured on its own."""
+	with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+		return executor.submit(function, *args).result()
+
+
+def write_results(name: str, runs: List[dict], output: str = None):
+	"""Writes benchmark results as JSON, with enough context to compare runs across commits."""
+	try:
+		commit = subprocess.run(
+			["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+		).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+
+	results = {
+		"benchmark": name,
+		"commit": commit,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"timestamp": time.time(),
+		"runs": runs
+	}
+	text = json.dumps(results, indent=2)
+
+	if(output):
+		Path(output).write_text(text + "\n", encoding="utf-8")
+	else:
+		print(text)
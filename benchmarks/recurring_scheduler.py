@@ -0,0 +1,253 @@
+"""
+Simulates the RecurringMessages scheduler over whole days of virtual time, to benchmark it without Discord.
+
+The cog runs for real on Red's JSON Config driver in a scratch folder. Its clock is replaced with a virtual one
+that jumps straight to each due time, and channels are replaced with stubs that record what they were sent. Every
+combination of reminder and guild counts is simulated in a fresh process, and the results are written as JSON.
+
+    python benchmarks/recurring_scheduler.py --reminders 1000 10000 100000 --guilds 10 1000 --days 1
+"""
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List
+
+from common import DriverCounter, peak_rss_mb, percentiles, run_isolated, setup_config, write_results
+
+START = datetime(2024, 1, 1)
+
+
+class VirtualClock:
+	"""
+	Virtual UTC time that jumps straight to each due time, then runs at real speed while the tick is processed.
+
+	Lateness measured against it is the time the cog itself took to get a message out, without the idle time.
+	"""
+	def __init__(self, start: datetime):
+		self.jump(start)
+
+	def jump(self, when: datetime):
+		self.base = when
+		self._started = time.perf_counter()
+
+	def now(self) -> datetime:
+		return self.base + timedelta(seconds=time.perf_counter() - self._started)
+
+
+class RecordingChannel:
+	"""Stands in for a text channel, recording every message instead of sending it."""
+	def __init__(self, channel_id: int, guild: "SimulatedGuild", clock: VirtualClock, latency: float):
+		self.id = channel_id
+		self.guild = guild
+		self.name = f"channel-{channel_id}"
+		self.clock = clock
+		self.latency = latency
+		self.sent: List[datetime] = []
+
+	async def send(self, content: str):
+		if(self.latency):
+			await asyncio.sleep(self.latency)
+
+		self.sent.append(self.clock.now())
+
+
+class SimulatedGuild:
+	def __init__(self, guild_id: int):
+		self.id = guild_id
+		self.channels: Dict[int, RecordingChannel] = {}
+
+	@property
+	def text_channels(self) -> List[RecordingChannel]:
+		return list(self.channels.values())
+
+	def get_channel(self, channel_id: int):
+		return self.channels.get(channel_id)
+
+
+class SimulatedBot:
+	"""The few parts of Red the cog uses outside of commands."""
+	def __init__(self, loop: asyncio.AbstractEventLoop, guilds: List[SimulatedGuild]):
+		self.loop = loop
+		self.shard_count = 1
+		self.shard_ids = None
+		self._guilds = {guild.id: guild for guild in guilds}
+
+	@property
+	def guilds(self) -> List[SimulatedGuild]:
+		return list(self._guilds.values())
+
+	def get_guild(self, guild_id: int):
+		return self._guilds.get(guild_id)
+
+	async def wait_until_ready(self):
+		pass
+
+
+def make_schedule(rng: random.Random, mix: str, hotspot: float) -> str:
+	if(rng.random() < hotspot):
+		return "00:00"
+
+	if(mix == "mixed"):
+		roll = rng.random()
+
+		if(roll < 0.1):
+			return "every 15 minutes"
+
+		if(roll < 0.3):
+			return f"hourly {rng.randrange(60)}"
+
+	return f"{rng.randrange(24):02}:{rng.randrange(60):02}"
+
+
+async def simulate(loop: asyncio.AbstractEventLoop, options: dict, data_path: Path) -> dict:
+	from recurringmessages.recurringmessages import RecurringMessages, SCHEMA_VERSION
+
+	await setup_config(data_path)
+
+	rng = random.Random(options["seed"])
+	clock = VirtualClock(START)
+	guilds = [SimulatedGuild((10 ** 17) + i) for i in range(options["guilds"])]
+	bot = SimulatedBot(loop, guilds)
+
+	cog = RecurringMessages(bot)
+	cog.loop.cancel()
+	cog.metrics_dump.cancel()
+	cog.scheduler.clock = clock.now
+	cog.dispatcher.clock = clock.now
+
+	for guild in guilds:
+		for i in range(options["channels"]):
+			channel_id = guild.id * 100 + i
+			guild.channels[channel_id] = RecordingChannel(channel_id, guild, clock, options["send_latency"])
+
+	# Reminders are spread evenly over guilds, and were last sent just before the simulation starts.
+	last_sent = (START - timedelta(minutes=1)).isoformat()
+	per_guild: Dict[int, dict] = {guild.id: {} for guild in guilds}
+
+	for reminder_id in range(1, options["reminders"] + 1):
+		guild = guilds[reminder_id % len(guilds)]
+		per_guild[guild.id][str(reminder_id)] = {
+			"channel_id": rng.choice(guild.text_channels).id,
+			"message": f"Reminder #{reminder_id}",
+			"schedule": make_schedule(rng, options["mix"], options["hotspot"]),
+			"timezone": "UTC",
+			"catch_up": "once",
+			"last_sent": last_sent
+		}
+
+	for guild_id, reminders in per_guild.items():
+		await cog.config.guild_from_id(guild_id).reminders.set(reminders)
+		await cog.config.guild_from_id(guild_id).last_id.set(options["reminders"])
+
+	await cog.config.schema_version.set(SCHEMA_VERSION)
+
+	results = []
+	dispatch = cog.dispatcher.dispatch
+
+	async def recording_dispatch(jobs):
+		batch = await dispatch(jobs)
+		results.extend(batch)
+		return batch
+
+	cog.dispatcher.dispatch = recording_dispatch
+	counter = DriverCounter(cog.config)
+
+	load_started = time.perf_counter()
+	await cog.load_schedule()
+	load_time = time.perf_counter() - load_started
+	load_io = counter.snapshot()
+
+	end = START + timedelta(days=options["days"])
+	tick_reads, tick_writes, tick_sizes = [], [], []
+	cpu_started = time.process_time()
+
+	while True:
+		when = cog.scheduler.next_time()
+
+		if(when is None or when > end):
+			break
+
+		clock.jump(when)
+		due = cog.scheduler.pop_due(clock.now())
+		before = counter.snapshot()
+
+		await cog.send_due(due)
+
+		tick_reads.append(counter.reads - before["reads"])
+		tick_writes.append(counter.writes - before["writes"])
+		tick_sizes.append(len(due))
+
+	cpu_time = time.process_time() - cpu_started
+	await cog.close_leases()
+
+	lateness = [result.lateness for result in results]
+
+	return {
+		"options": options,
+		"load_seconds": load_time,
+		"load_config_reads": load_io["reads"],
+		"ticks": len(tick_sizes),
+		"sent": sum(result.sent for result in results),
+		"failed": sum(not result.sent for result in results),
+		"largest_tick": max(tick_sizes, default=0),
+		"lateness_seconds": percentiles(lateness),
+		"config_reads_per_tick": sum(tick_reads) / len(tick_reads) if tick_reads else 0,
+		"config_writes_per_tick": sum(tick_writes) / len(tick_writes) if tick_writes else 0,
+		"max_config_writes_per_tick": max(tick_writes, default=0),
+		"cpu_seconds_per_day": cpu_time / options["days"],
+		"peak_rss_mb": peak_rss_mb()
+	}
+
+
+def run(options: dict) -> dict:
+	# The cog's task loops bind to the event loop current when it is imported, so set one up before importing it.
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	try:
+		with tempfile.TemporaryDirectory() as data_path:
+			return loop.run_until_complete(simulate(loop, options, Path(data_path)))
+	finally:
+		loop.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--reminders', type=int, nargs='+', default=[1000, 10000, 100000])
+	parser.add_argument('--guilds', type=int, nargs='+', default=[10, 1000])
+	parser.add_argument('--channels', type=int, default=5, help='channels per guild')
+	parser.add_argument('--days', type=float, default=1.0, help='simulated days')
+	parser.add_argument('--mix', choices=('daily', 'mixed'), default='daily', help='daily only, or with sub-daily schedules')
+	parser.add_argument('--hotspot', type=float, default=0.05, help='fraction of reminders due at 00:00')
+	parser.add_argument('--send-latency', type=float, default=0.0, help='seconds every send takes')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', help='JSON file to write the results to, instead of printing them')
+	args = parser.parse_args()
+
+	runs = []
+
+	for guilds in args.guilds:
+		for reminders in args.reminders:
+			options = {
+				"reminders": reminders,
+				"guilds": guilds,
+				"channels": args.channels,
+				"days": args.days,
+				"mix": args.mix,
+				"hotspot": args.hotspot,
+				"send_latency": args.send_latency,
+				"seed": args.seed
+			}
+			print(f"Simulating {reminders} reminders in {guilds} guilds...", file=sys.stderr)
+			runs.append(run_isolated(run, options))
+
+	write_results("recurring_scheduler", runs, args.output)
+
+
+if __name__ == '__main__':
+	main()
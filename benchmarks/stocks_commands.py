@@ -0,0 +1,295 @@
+"""
+Benchmarks the Stocks cog's commands against synthetic guilds, fully offline.
+
+The cog runs for real on Red's JSON Config driver in a scratch folder, with quotes served by the local stand-in
+for the quote API (`stocks/standin.py`), with a configurable latency and rate limit. The bank is replaced with an
+in-memory one, and reaction menus only render their first page. Every combination of guild sizes is benchmarked
+in a fresh process, and the results are written as JSON.
+
+    python benchmarks/stocks_commands.py --members 100 10000 --positions 10 --latency 0.05 --output stocks.json
+"""
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List
+
+from common import DriverCounter, peak_rss_mb, percentiles, run_isolated, setup_config, write_results
+
+OPERATIONS = ("get_stock_data", "buy", "sell", "list", "leaderboard")
+
+
+class SimulatedBank:
+	"""An in-memory stand-in for Red's bank, where everyone starts out rich."""
+	def __init__(self, starting_balance: int = 10 ** 12):
+		self.starting_balance = starting_balance
+		self.balances: Dict[int, int] = {}
+
+	async def get_currency_name(self, guild) -> str:
+		return "credits"
+
+	async def get_balance(self, member) -> int:
+		return self.balances.get(member.id, self.starting_balance)
+
+	async def withdraw_credits(self, member, amount: int) -> int:
+		balance = await self.get_balance(member)
+
+		if(amount > balance):
+			raise ValueError("Insufficient funds")
+
+		self.balances[member.id] = balance - amount
+		return self.balances[member.id]
+
+	async def deposit_credits(self, member, amount: int) -> int:
+		self.balances[member.id] = await self.get_balance(member) + amount
+		return self.balances[member.id]
+
+
+class SimulatedMember:
+	def __init__(self, member_id: int, guild: "SimulatedGuild"):
+		self.id = member_id
+		self.guild = guild
+		self.name = f"member-{member_id}"
+		self.display_name = self.name
+		self.avatar_url = ""
+		self.bot = False
+
+
+class SimulatedGuild:
+	def __init__(self, guild_id: int):
+		self.id = guild_id
+		self.name = f"guild-{guild_id}"
+		self.icon_url = ""
+		self.members: Dict[int, SimulatedMember] = {}
+
+	def get_member(self, member_id: int):
+		return self.members.get(member_id)
+
+
+class SimulatedBot:
+	def __init__(self, loop: asyncio.AbstractEventLoop, guilds: List[SimulatedGuild]):
+		self.loop = loop
+		self.guilds = guilds
+		self._users = {member.id: member for guild in guilds for member in guild.members.values()}
+
+	def get_user(self, user_id: int):
+		return self._users.get(user_id)
+
+	async def wait_until_ready(self):
+		pass
+
+
+class _Typing:
+	async def __aenter__(self):
+		pass
+
+	async def __aexit__(self, *args):
+		pass
+
+
+class SimulatedContext:
+	"""The parts of a command context the cog uses. Messages are counted, not sent."""
+	def __init__(self, bot: SimulatedBot, guild: SimulatedGuild, author: SimulatedMember):
+		self.bot = bot
+		self.guild = guild
+		self.author = author
+		self.sent = 0
+
+	async def send(self, content=None, **kwargs):
+		self.sent += 1
+
+	async def embed_requested(self) -> bool:
+		return False
+
+	async def tick(self):
+		pass
+
+	async def react_quietly(self, *args, **kwargs):
+		pass
+
+	def typing(self) -> _Typing:
+		return _Typing()
+
+
+async def timed(samples: List[float], errors: List[str], operation: Callable[[], Awaitable]):
+	started = time.perf_counter()
+
+	try:
+		await operation()
+	except Exception as e:
+		errors.append(repr(e))
+	else:
+		samples.append(time.perf_counter() - started)
+
+
+async def benchmark(loop: asyncio.AbstractEventLoop, options: dict, data_path: Path) -> dict:
+	import stocks.stocks as stocks_module
+	from stocks.pages import LazyPages
+	from stocks.stocks import Stocks
+	from stocks.standin import StandInServer
+
+	await setup_config(data_path)
+
+	stocks_module.bank = SimulatedBank()
+
+	async def first_page_only(self, ctx, timeout: float = 30.0):
+		await ctx.send(self[0])
+
+	LazyPages.menu = first_page_only
+
+	server = StandInServer(latency=options["latency"], rate_limit=options["rate_limit"])
+	await server.start(port=options["port"])
+
+	rng = random.Random(options["seed"])
+	tickers = [f"SYM{i:05}" for i in range(options["tickers"])]
+	guilds = [SimulatedGuild((10 ** 17) + i) for i in range(options["guilds"])]
+
+	for guild in guilds:
+		for i in range(options["members"]):
+			# Like real snowflakes, member IDs fit in the 64-bit integers SQLite stores.
+			member = SimulatedMember(guild.id + (i + 1) * 10 ** 6, guild)
+			guild.members[member.id] = member
+
+	bot = SimulatedBot(loop, guilds)
+	cog = Stocks(bot)
+
+	try:
+		await cog.config.provider.set("local")
+		await cog.config.provider_argument.set(f"http://127.0.0.1:{options['port']}")
+		await cog.config.storage.set(options["storage"])
+		await cog.config.schema_version.set(stocks_module.SCHEMA_VERSION)
+
+		held: Dict[int, List[str]] = {}
+
+		for guild in guilds:
+			for member in guild.members.values():
+				held[member.id] = rng.sample(tickers, min(options["positions"], len(tickers)))
+				positions = {
+					ticker: {"count": rng.randint(100, 1000), "investment": rng.randint(100, 100000)}
+					for ticker in held[member.id]
+				}
+				await cog.config.member_from_ids(guild.id, member.id).stocks.set(positions)
+
+		synthetic = await cog.storage.all_members()
+		await cog.initialize()
+
+		if(options["storage"] != "config"):
+			# Copy the synthetic holdings over, like `[p]stocks set storage` does.
+			await cog.storage.replace_all(synthetic)
+
+		counter = DriverCounter(cog.config)
+		samples: Dict[str, List[float]] = {operation: [] for operation in OPERATIONS}
+		errors: Dict[str, List[str]] = {operation: [] for operation in OPERATIONS}
+		requests: Dict[str, int] = {}
+
+		def context() -> SimulatedContext:
+			guild = rng.choice(guilds)
+			return SimulatedContext(bot, guild, rng.choice(list(guild.members.values())))
+
+		# The cog is never added to a bot, so commands are called through their callbacks.
+		def sell(ctx: SimulatedContext):
+			return Stocks.sell.callback(cog, ctx, rng.choice(held[ctx.author.id]), 1)
+
+		operations = {
+			"get_stock_data": lambda: cog.get_stock_data(context(), rng.sample(tickers, min(10, len(tickers)))),
+			"buy": lambda: Stocks.buy.callback(cog, context(), rng.choice(tickers), rng.randint(1, 10)),
+			"sell": lambda: sell(context()),
+			"list": lambda: Stocks.list.callback(cog, context()),
+			"leaderboard": lambda: Stocks.leaderboard.callback(cog, context())
+		}
+
+		started = time.perf_counter()
+
+		for name in OPERATIONS:
+			before = server.request_count
+			pending = [timed(samples[name], errors[name], operations[name]) for _ in range(options["iterations"])]
+
+			# Commands run `concurrency` at a time, like a busy bot handling several users at once.
+			for i in range(0, len(pending), options["concurrency"]):
+				await asyncio.gather(*pending[i:i + options["concurrency"]])
+
+			requests[name] = server.request_count - before
+
+		elapsed = time.perf_counter() - started
+	finally:
+		# Closed even when a run fails, as the SQLite connection's thread would keep the process alive.
+		await cog.storage.close()
+		cog.quote_batcher.close()
+		await cog.session.close()
+		await server.stop()
+
+	return {
+		"options": options,
+		"seconds": elapsed,
+		"latency_seconds": {name: percentiles(values, (50, 99)) for name, values in samples.items()},
+		"errors": {name: len(values) for name, values in errors.items()},
+		"first_errors": {name: values[:5] for name, values in errors.items() if values},
+		"upstream_requests": requests,
+		"upstream_symbols": server.symbol_count,
+		"upstream_rejected": server.rejected_count,
+		"config": counter.snapshot(),
+		"peak_rss_mb": peak_rss_mb()
+	}
+
+
+def run(options: dict) -> dict:
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	try:
+		with tempfile.TemporaryDirectory() as data_path:
+			return loop.run_until_complete(benchmark(loop, options, Path(data_path)))
+	finally:
+		loop.close()
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--guilds', type=int, default=1)
+	parser.add_argument('--members', type=int, nargs='+', default=[100, 1000, 10000], help='members per guild')
+	parser.add_argument('--positions', type=int, nargs='+', default=[10], help='positions per member')
+	parser.add_argument('--tickers', type=int, default=500, help='number of distinct tickers')
+	parser.add_argument('--iterations', type=int, default=200, help='calls of every command')
+	parser.add_argument('--concurrency', type=int, default=10, help='calls running at once')
+	parser.add_argument('--storage', choices=('config', 'sqlite'), default='config')
+	parser.add_argument('--latency', type=float, default=0.05, help='seconds the quote API takes to answer')
+	parser.add_argument('--rate-limit', type=int, default=0, help='quote API requests allowed per second, 0 for no limit')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--output', help='JSON file to write the results to, instead of printing them')
+	args = parser.parse_args()
+
+	runs = []
+
+	for members in args.members:
+		for positions in args.positions:
+			options = {
+				"guilds": args.guilds,
+				"members": members,
+				"positions": positions,
+				"tickers": args.tickers,
+				"iterations": args.iterations,
+				"concurrency": args.concurrency,
+				"storage": args.storage,
+				"latency": args.latency,
+				"rate_limit": args.rate_limit,
+				"port": args.port,
+				"seed": args.seed
+			}
+			print(f"Benchmarking {args.guilds} guild(s) of {members} members with {positions} positions...", file=sys.stderr)
+			result = run_isolated(run, options)
+
+			# Failed commands return early, so their timings would make the run look faster than it is.
+			if(any(result["errors"].values())):
+				sys.exit(f"Commands failed: {result['first_errors']}")
+
+			runs.append(result)
+
+	write_results("stocks_commands", runs, args.output)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, Hashable, Iterable, List, NamedTuple, Optional
+from weakref import WeakValueDictionary
+
+import aiohttp
+import discord
+
+log = logging.getLogger("red.gradient-cogs.recurringmessages")
+
+
+class SendJob(NamedTuple):
+	key: Hashable
+	channel: discord.TextChannel
+	message: str
+	due: datetime
+
+
+class DispatchResult(NamedTuple):
+	key: Hashable
+	sent: bool
+	# Seconds between the time the reminder was due and the time it went out, or was given up on.
+	lateness: float
+	attempts: int
+	error: Optional[BaseException] = None
+
+
+class ReminderDispatcher:
+	"""
+	Sends due reminders concurrently.
+
+	At most `max_concurrency` sends are in flight at once, at most `per_guild` of them in the same guild and at
+	most `per_channel` in the same channel, so one busy or slow channel can't hold up every other one. Transient
+	failures are retried with an exponential backoff; anything else, like missing permissions, is not.
+	"""
+	def __init__(
+		self,
+		clock: Callable[[], datetime] = datetime.utcnow,
+		max_concurrency: int = 16,
+		per_guild: int = 4,
+		per_channel: int = 1,
+		retries: int = 2,
+		retry_delay: float = 1.0
+	):
+		self.clock = clock
+		self.max_concurrency = max_concurrency
+		self.per_guild = per_guild
+		self.per_channel = per_channel
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self._semaphore: asyncio.Semaphore = None
+		self._guilds: "WeakValueDictionary[int, asyncio.Semaphore]" = WeakValueDictionary()
+		self._channels: "WeakValueDictionary[int, asyncio.Semaphore]" = WeakValueDictionary()
+
+	async def dispatch(self, jobs: Iterable[SendJob]) -> List[DispatchResult]:
+		"""Sends every job and returns their results in the same order."""
+		if(self._semaphore is None):
+			self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+		return await asyncio.gather(*(self._send(job) for job in jobs))
+
+	@staticmethod
+	def is_transient(error: BaseException) -> bool:
+		if(isinstance(error, discord.HTTPException)):
+			return error.status >= 500 or error.status == 429
+
+		return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError, OSError))
+
+	def _limit(self, limits: WeakValueDictionary, key: int, size: int) -> asyncio.Semaphore:
+		semaphore = limits.get(key)
+
+		if(semaphore is None):
+			semaphore = limits[key] = asyncio.Semaphore(size)
+
+		return semaphore
+
+	async def _send(self, job: SendJob) -> DispatchResult:
+		guild_limit = self._limit(self._guilds, job.channel.guild.id, self.per_guild)
+		channel_limit = self._limit(self._channels, job.channel.id, self.per_channel)
+
+		async with channel_limit, guild_limit, self._semaphore:
+			attempt = 0
+
+			while True:
+				attempt += 1
+
+				try:
+					await job.channel.send(job.message)
+				except Exception as e:
+					if(attempt > self.retries or not self.is_transient(e)):
+						log.warning("Could not send recurring message %s after %d attempt(s): %r", job.key, attempt, e)
+						return DispatchResult(job.key, False, self.lateness(job), attempt, e)
+
+					await asyncio.sleep(self.retry_delay * 2 ** (attempt - 1))
+					continue
+
+				return DispatchResult(job.key, True, self.lateness(job), attempt)
+
+	def lateness(self, job: SendJob) -> float:
+		return max(0.0, (self.clock() - job.due).total_seconds())
@@ -0,0 +1,109 @@
+import os
+import socket
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List, Set, Tuple
+
+import aiosqlite
+
+# (guild id, reminder id, occurrence the reminder was last sent for before this one)
+Occurrence = Tuple[int, int, datetime]
+
+
+class LeaseStore:
+	"""
+	Shard leases and sent occurrences, in a local SQLite file shared by every bot process on the same host.
+
+	A process only schedules the reminders of guilds on shards it holds the lease of, and a lease that is not renewed
+	within `ttl` seconds can be taken over by another process. On top of that, every occurrence of a reminder is
+	claimed before it is sent, so even two processes that both think they own a guild during a failover or a reshard
+	never send the same occurrence twice. Occurrences are identified by the one sent before them, which every process
+	agrees on even when catching up makes their due times differ.
+	"""
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS shard_leases (
+		shard_count INTEGER NOT NULL,
+		shard_id INTEGER NOT NULL,
+		owner TEXT NOT NULL,
+		expires REAL NOT NULL,
+		PRIMARY KEY (shard_count, shard_id)
+	) WITHOUT ROWID;
+	CREATE TABLE IF NOT EXISTS sent (
+		guild_id INTEGER NOT NULL,
+		reminder_id INTEGER NOT NULL,
+		after TEXT NOT NULL,
+		owner TEXT NOT NULL,
+		claimed_at REAL NOT NULL,
+		PRIMARY KEY (guild_id, reminder_id, after)
+	) WITHOUT ROWID;
+	CREATE INDEX IF NOT EXISTS sent_claimed_at ON sent (claimed_at);
+	"""
+
+	def __init__(self, path: Path, ttl: float = 60.0):
+		self.path = path
+		self.ttl = ttl
+		self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+		self.db: aiosqlite.Connection = None
+
+	async def open(self):
+		self.db = await aiosqlite.connect(str(self.path))
+		await self.db.execute("PRAGMA journal_mode=WAL")
+		await self.db.execute("PRAGMA busy_timeout=5000")
+		await self.db.executescript(self.SCHEMA)
+		await self.db.commit()
+
+	async def close(self):
+		if(self.db is not None):
+			await self.db.close()
+			self.db = None
+
+	async def acquire(self, shard_count: int, shard_ids: Iterable[int]) -> Set[int]:
+		"""Takes or renews the leases of the given shards, and returns the ones this process holds."""
+		shard_ids = list(shard_ids)
+		now = time.time()
+
+		await self.db.executemany(
+			"""
+			INSERT INTO shard_leases (shard_count, shard_id, owner, expires) VALUES (?, ?, ?, ?)
+			ON CONFLICT (shard_count, shard_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+			WHERE shard_leases.owner = excluded.owner OR shard_leases.expires < ?
+			""",
+			[(shard_count, shard_id, self.owner, now + self.ttl, now) for shard_id in shard_ids]
+		)
+		await self.db.commit()
+
+		async with self.db.execute(
+			"SELECT shard_id FROM shard_leases WHERE shard_count = ? AND owner = ?",
+			(shard_count, self.owner)
+		) as cursor:
+			held = {shard_id async for shard_id, in cursor}
+
+		return held.intersection(shard_ids)
+
+	async def release(self):
+		"""Gives up every lease held by this process, so other processes can take its shards right away."""
+		await self.db.execute("DELETE FROM shard_leases WHERE owner = ?", (self.owner,))
+		await self.db.commit()
+
+	async def claim(self, occurrences: List[Occurrence]) -> List[bool]:
+		"""Claims occurrences before sending them. Returns, for each one, whether this process may send it."""
+		claimed = []
+		now = time.time()
+
+		for guild_id, reminder_id, after in occurrences:
+			cursor = await self.db.execute(
+				"INSERT OR IGNORE INTO sent (guild_id, reminder_id, after, owner, claimed_at) VALUES (?, ?, ?, ?, ?)",
+				(guild_id, reminder_id, after.isoformat(), self.owner, now)
+			)
+			claimed.append(cursor.rowcount == 1)
+			await cursor.close()
+
+		await self.db.commit()
+		return claimed
+
+	async def prune(self, max_age: float):
+		"""Forgets the occurrences claimed over `max_age` seconds ago, once no process can still try to send them."""
+		await self.db.execute("DELETE FROM sent WHERE claimed_at < ?", (time.time() - max_age,))
+		await self.db.commit()
@@ -0,0 +1,153 @@
+# Every cog in this repo is installed on its own, so each one ships an identical copy of this file.
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Union
+
+# Upper bounds of the default histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+	def __init__(self, name: str, help: str):
+		self.name = name
+		self.help = help
+		self.value = 0
+
+	def inc(self, amount: Union[int, float] = 1):
+		self.value += amount
+
+
+class Gauge:
+	"""A value that is only read from `function` when the metrics are rendered."""
+	def __init__(self, name: str, help: str, function: Callable[[], float]):
+		self.name = name
+		self.help = help
+		self.function = function
+
+	@property
+	def value(self) -> float:
+		return self.function()
+
+
+class Histogram:
+	"""
+	Counts observations in fixed buckets, like a Prometheus histogram.
+
+	Observing a value is a binary search over the bucket bounds and two additions, so it is cheap enough for hot
+	paths. Percentiles are estimated from the buckets.
+	"""
+	def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+		self.name = name
+		self.help = help
+		self.bounds = tuple(sorted(buckets))
+		# One count per bucket, plus one for the values over the last bound.
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value: float):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	@contextmanager
+	def time(self) -> Iterator[None]:
+		started = time.perf_counter()
+
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - started)
+
+	def percentile(self, point: float) -> Optional[float]:
+		"""Returns the upper bound of the bucket the percentile falls in, or None without observations."""
+		if not self.count:
+			return None
+
+		rank = point / 100 * self.count
+		seen = 0
+
+		for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+			seen += count
+
+			if(seen >= rank):
+				return bound
+
+		return float("inf")
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+class Metrics:
+	"""A registry of metrics, that can be rendered for a command or in the Prometheus text format."""
+	def __init__(self, prefix: str):
+		self.prefix = prefix
+		self.metrics: Dict[str, Metric] = {}
+		self.started = time.time()
+
+	def _register(self, metric: Metric) -> Metric:
+		self.metrics[metric.name] = metric
+		return metric
+
+	def counter(self, name: str, help: str) -> Counter:
+		return self._register(Counter(name, help))
+
+	def gauge(self, name: str, help: str, function: Callable[[], float]) -> Gauge:
+		return self._register(Gauge(name, help, function))
+
+	def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+		return self._register(Histogram(name, help, buckets))
+
+	def render(self) -> str:
+		"""Renders every metric as one line of plain text, for a command."""
+		lines: List[str] = [f"Since {time.strftime('%Y-%m-%d %H:%M', time.gmtime(self.started))} UTC"]
+
+		for metric in self.metrics.values():
+			if(isinstance(metric, Histogram)):
+				if not metric.count:
+					lines.append(f"{metric.name}: no data")
+					continue
+
+				lines.append(
+					f"{metric.name}: count={metric.count} mean={metric.sum / metric.count:.4g} "
+					f"p50<={metric.percentile(50):g} p99<={metric.percentile(99):g}"
+				)
+			else:
+				lines.append(f"{metric.name}: {metric.value:g}")
+
+		return "\n".join(lines)
+
+	def prometheus(self) -> str:
+		"""Renders every metric in the Prometheus text exposition format."""
+		lines: List[str] = []
+
+		for metric in self.metrics.values():
+			name = f"{self.prefix}_{metric.name}"
+			kind = "counter" if isinstance(metric, Counter) else "gauge" if isinstance(metric, Gauge) else "histogram"
+			lines.append(f"# HELP {name} {metric.help}")
+			lines.append(f"# TYPE {name} {kind}")
+
+			if(isinstance(metric, Histogram)):
+				cumulative = 0
+
+				for bound, count in zip(metric.bounds, metric.counts):
+					cumulative += count
+					lines.append(f'{name}_bucket{{le="{bound:g}"}} {cumulative}')
+
+				lines.append(f'{name}_bucket{{le="+Inf"}} {metric.count}')
+				lines.append(f"{name}_sum {metric.sum:g}")
+				lines.append(f"{name}_count {metric.count}")
+			else:
+				lines.append(f"{name} {metric.value:g}")
+
+		return "\n".join(lines) + "\n"
+
+	def write_prometheus(self, path: Path):
+		"""Writes the Prometheus text to a file, replacing it atomically so scrapers never see half of it."""
+		temporary = path.with_name(path.name + ".tmp")
+		temporary.write_text(self.prometheus(), encoding="utf-8")
+		os.replace(temporary, path)
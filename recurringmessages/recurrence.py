@@ -0,0 +1,284 @@
+import re
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import FrozenSet, List, Optional, Tuple
+
+import pytz
+
+# What to do with the occurrences a reminder missed while the bot was down.
+CATCH_UP_SKIP = "skip"  # only send the next one on time
+CATCH_UP_ONCE = "once"  # send once right away, then carry on
+CATCH_UP_ALL = "all"    # send every missed one, oldest first
+CATCH_UP_POLICIES = (CATCH_UP_SKIP, CATCH_UP_ONCE, CATCH_UP_ALL)
+
+# Occurrences this late are not on time anymore, but missed.
+GRACE = timedelta(minutes=1)
+# Occurrences missed longer ago than this are never caught up.
+CATCH_UP_WINDOW = timedelta(days=1)
+
+_EPOCH = datetime(1970, 1, 1)
+_DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+# How far ahead a schedule must have an occurrence, or it is rejected.
+_HORIZON_YEARS = 8
+
+SCHEDULE_HELP = (
+	"`HH:MM` or `daily HH:MM`, `hourly MM`, `every N minutes`, `every N hours`, `weekdays HH:MM`, "
+	"`weekends HH:MM`, `mon,wed,fri HH:MM`, `monthly D HH:MM` or `cron M H DOM MON DOW`"
+)
+
+
+class Schedule:
+	"""
+	A compiled recurrence rule. Times are naive UTC datetimes, like `datetime.utcnow()`.
+
+	Use `compile_schedule` to get one, so every spec and timezone pair is only compiled once.
+	"""
+	spec: str
+	timezone: pytz.BaseTzInfo
+
+	def next_after(self, after: datetime) -> datetime:
+		"""Returns the first occurrence strictly after `after`."""
+		raise NotImplementedError()
+
+
+class IntervalSchedule(Schedule):
+	"""Every fixed number of seconds, counted from the Unix epoch. The timezone makes no difference."""
+	def __init__(self, spec: str, timezone: pytz.BaseTzInfo, seconds: int):
+		self.spec = spec
+		self.timezone = timezone
+		self.step = timedelta(seconds=seconds)
+
+	def next_after(self, after: datetime) -> datetime:
+		return _EPOCH + ((after - _EPOCH) // self.step + 1) * self.step
+
+
+class CalendarSchedule(Schedule):
+	"""
+	A set of wall-clock times of day, on a set of days, in a timezone.
+
+	Times of day are kept as sorted minutes since midnight, so finding the next one is a binary search. Days are
+	matched like cron does: when both days of the month and weekdays are restricted, either one matching is enough.
+	Wall-clock times skipped when clocks go forward happen as soon as the clocks are past them, and wall-clock times
+	repeated when clocks go back only happen the first time around.
+	"""
+	def __init__(
+		self,
+		spec: str,
+		timezone: pytz.BaseTzInfo,
+		minutes: List[int],
+		days: Optional[FrozenSet[int]] = None,
+		months: Optional[FrozenSet[int]] = None,
+		weekdays: Optional[FrozenSet[int]] = None
+	):
+		self.spec = spec
+		self.timezone = timezone
+		self.minutes = sorted(set(minutes))
+		self.days = days
+		self.months = sorted(months) if months is not None else None
+		self.weekdays = weekdays
+
+		if not self.minutes:
+			raise ValueError("a schedule needs at least one time of day")
+
+		if(self._next_day(date(2000, 1, 1), date(2000 + _HORIZON_YEARS, 1, 1)) is None):
+			raise ValueError("that schedule never happens")
+
+	def _day_matches(self, day: date) -> bool:
+		if(self.days is not None and self.weekdays is not None):
+			return day.day in self.days or day.weekday() in self.weekdays
+
+		if(self.days is not None):
+			return day.day in self.days
+
+		if(self.weekdays is not None):
+			return day.weekday() in self.weekdays
+
+		return True
+
+	def _next_day(self, day: date, limit: date) -> Optional[date]:
+		"""Returns the first matching day on or after `day`, skipping whole months that don't match."""
+		while(day < limit):
+			if(self.months is not None and day.month not in self.months):
+				i = bisect_left(self.months, day.month)
+				year = day.year if i < len(self.months) else day.year + 1
+				day = date(year, self.months[i % len(self.months)], 1)
+				continue
+
+			if(self._day_matches(day)):
+				return day
+
+			day += timedelta(days=1)
+
+		return None
+
+	def _localize(self, naive: datetime) -> datetime:
+		try:
+			local = self.timezone.localize(naive, is_dst=None)
+		except pytz.AmbiguousTimeError:
+			local = self.timezone.localize(naive, is_dst=True)
+		except pytz.NonExistentTimeError:
+			local = self.timezone.normalize(self.timezone.localize(naive, is_dst=False))
+
+		return local.astimezone(pytz.utc).replace(tzinfo=None)
+
+	def _next_local(self, local: datetime) -> datetime:
+		"""Returns the first matching wall-clock time strictly after a wall-clock time."""
+		day = local.date()
+		i = bisect_right(self.minutes, local.hour * 60 + local.minute)
+
+		if(i < len(self.minutes) and self._day_matches(day) and (self.months is None or day.month in self.months)):
+			minute = self.minutes[i]
+		else:
+			day = self._next_day(day + timedelta(days=1), day + timedelta(days=366 * _HORIZON_YEARS))
+			minute = self.minutes[0]
+
+		return datetime.combine(day, time(minute // 60, minute % 60))
+
+	def next_after(self, after: datetime) -> datetime:
+		local = pytz.utc.localize(after).astimezone(self.timezone).replace(tzinfo=None)
+
+		while True:
+			local = self._next_local(local)
+			when = self._localize(local)
+
+			# Only a wall-clock time from the repeated hour when clocks go back can land before `after`.
+			if(when > after):
+				return when
+
+
+def _parse_time(text: str) -> int:
+	parsed = datetime.strptime(text, "%H:%M")
+	return parsed.hour * 60 + parsed.minute
+
+
+def _parse_field(text: str, low: int, high: int, names: Tuple[str, ...] = ()) -> Optional[FrozenSet[int]]:
+	"""Parses a cron field like `*`, `1,15`, `1-5`, `*/10` or `mon-fri`. Returns None for an unrestricted `*`."""
+	if(text == "*"):
+		return None
+
+	values = set()
+
+	def value(part: str) -> int:
+		if part in names:
+			return names.index(part) + low
+
+		number = int(part)
+		if not low <= number <= high:
+			raise ValueError(f"{number} is out of range")
+
+		return number
+
+	for item in text.split(","):
+		item, _, step = item.partition("/")
+
+		if(item == "*"):
+			start, stop = low, high
+		elif("-" in item):
+			start, stop = map(value, item.split("-", 1))
+		else:
+			start = stop = value(item)
+
+			if(step):
+				stop = high
+
+		values.update(range(start, stop + 1, int(step) if step else 1))
+
+	return frozenset(values)
+
+
+def _parse_weekdays(text: str) -> FrozenSet[int]:
+	# Cron counts weekdays from sunday, as 0 or 7, but Python counts them from monday.
+	days = _parse_field(text, 0, 7, ("sun", "mon", "tue", "wed", "thu", "fri", "sat"))
+	return frozenset((day - 1) % 7 for day in days) if days is not None else None
+
+
+@lru_cache(maxsize=1024)
+def compile_schedule(spec: str, timezone: str = "UTC") -> Schedule:
+	"""
+	Compiles a schedule spec in a timezone. Raises ValueError if either of them is invalid.
+
+	The accepted specs are listed in `SCHEDULE_HELP`.
+	"""
+	try:
+		tz = pytz.timezone(timezone)
+	except pytz.UnknownTimeZoneError:
+		raise ValueError(f"Unknown timezone \"{timezone}\".")
+
+	normalized = " ".join(spec.lower().split())
+	words = normalized.split(" ")
+
+	try:
+		if(re.fullmatch(r"\d{1,2}:\d{2}", normalized)):
+			return CalendarSchedule(normalized, tz, [_parse_time(normalized)])
+
+		if(words[0] == "daily" and len(words) == 2):
+			return CalendarSchedule(normalized, tz, [_parse_time(words[1])])
+
+		if(words[0] == "hourly" and len(words) == 2):
+			minute = int(words[1].lstrip(":"))
+			if not 0 <= minute < 60:
+				raise ValueError()
+
+			return CalendarSchedule(normalized, tz, range(minute, 24 * 60, 60))
+
+		if(words[0] == "every" and len(words) == 3 and words[2] in ("minute", "minutes", "hour", "hours")):
+			minutes = int(words[1]) * (60 if words[2].startswith("hour") else 1)
+			if(minutes <= 0):
+				raise ValueError()
+
+			# Intervals that fit evenly in a day stay aligned to midnight, in the schedule's timezone.
+			if((24 * 60) % minutes == 0):
+				return CalendarSchedule(normalized, tz, range(0, 24 * 60, minutes))
+
+			return IntervalSchedule(normalized, tz, minutes * 60)
+
+		if(words[0] in ("weekdays", "weekends") and len(words) == 2):
+			weekdays = frozenset(range(5)) if words[0] == "weekdays" else frozenset((5, 6))
+			return CalendarSchedule(normalized, tz, [_parse_time(words[1])], weekdays=weekdays)
+
+		if(len(words) == 2 and all(day in _DAYS for day in words[0].split(","))):
+			weekdays = frozenset(_DAYS.index(day) for day in words[0].split(","))
+			return CalendarSchedule(normalized, tz, [_parse_time(words[1])], weekdays=weekdays)
+
+		if(words[0] == "monthly" and len(words) == 3):
+			day = int(words[1])
+			if not 1 <= day <= 31:
+				raise ValueError()
+
+			return CalendarSchedule(normalized, tz, [_parse_time(words[2])], days=frozenset((day,)))
+
+		if(words[0] == "cron" and len(words) == 6):
+			minutes = _parse_field(words[1], 0, 59) or range(60)
+			hours = _parse_field(words[2], 0, 23) or range(24)
+
+			return CalendarSchedule(
+				normalized, tz,
+				[hour * 60 + minute for hour in hours for minute in minutes],
+				days=_parse_field(words[3], 1, 31),
+				months=_parse_field(words[4], 1, 12, ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")),
+				weekdays=_parse_weekdays(words[5])
+			)
+	except ValueError as e:
+		raise ValueError(f"Invalid schedule \"{spec}\"{': ' + str(e) if str(e) else ''}.")
+
+	raise ValueError(f"Invalid schedule \"{spec}\".")
+
+
+def next_fire(schedule: Schedule, last_sent: datetime, now: datetime, catch_up: str = CATCH_UP_ONCE) -> datetime:
+	"""
+	Returns when a reminder is next due, given the occurrence it was last sent for.
+
+	Occurrences missed by more than `GRACE` are handled according to the catch-up policy. Returned times in the
+	past are due right away.
+	"""
+	after = max(last_sent, now - CATCH_UP_WINDOW)
+	first = schedule.next_after(after)
+
+	if(first >= now - GRACE or catch_up == CATCH_UP_ALL):
+		return first
+
+	if(catch_up == CATCH_UP_ONCE):
+		return now
+
+	return schedule.next_after(now)
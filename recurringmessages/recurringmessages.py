@@ -1,31 +1,78 @@
-from math import ceil
 from redbot.core import commands
 from redbot.core import Config
-from redbot.core.utils.chat_formatting import box
-from redbot.core.utils.menus import menu, DEFAULT_CONTROLS, close_menu
 from redbot.core.bot import Red
+from redbot.core.data_manager import cog_data_path
+from redbot.core.utils.chat_formatting import box, pagify
 from discord.ext import tasks
 from prettytable import PrettyTable
-from datetime import time, date, datetime
-import prettytable, discord, logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Set, Tuple
+from pathlib import Path
+import prettytable, discord, logging, asyncio, tempfile
+from .pages import LazyPages
+from .dispatch import ReminderDispatcher, SendJob
+from .leases import LeaseStore
+from .metrics import Metrics
+from .recurrence import CATCH_UP_ONCE, CATCH_UP_POLICIES, SCHEDULE_HELP, compile_schedule, next_fire
+from .reminders import Reminder, ReminderIndex, ReminderKey, upgrade_reminder_data
+from .scheduler import ReminderScheduler
+from .transfer import CHUNK_SIZE, FORMATS, file_format, parse_row, read_rows, write_rows
 
 log = logging.getLogger("red.gradient-cogs.recurringmessages")
 
+SCHEMA_VERSION = 2
+
+# Seconds a shard lease lasts without being renewed. Leases are renewed three times as often.
+LEASE_TTL = 60
+# Seconds before the reminders of a batch that failed are due again.
+RETRY_DELAY = 60
+
 class RecurringMessages(commands.Cog):
 	"""Send recurring messages to a channel on an interval."""
 	def __init__(self, bot : Red):
 		super().__init__()
 		self.bot: Red = bot
 		self.config = Config.get_conf(self, identifier=98766212374527)
-		self.config.register_guild(reminders=[], last_id=0)
+		self.config.register_global(schema_version=0, lease_file=None, metrics_file=None)
+		# Reminders are keyed by their id, as a string since config is stored as JSON.
+		self.config.register_guild(reminders={}, last_id=0)
+		self.reminders = ReminderIndex()
+		self.scheduler = ReminderScheduler()
+		self.dispatcher = ReminderDispatcher(clock=self.scheduler.clock)
+		self.leases: LeaseStore = None
+		self.owned_shards: Set[int] = set()
+		self.send_tasks: Set[asyncio.Task] = set()
+		self.metrics: Metrics = self.create_metrics()
 		self.loop.start()
+		self.metrics_dump.start()
+
+	def create_metrics(self) -> Metrics:
+		"""Creates the metrics of the task loop. Recording them is a few additions per tick, so they are always on."""
+		metrics = Metrics("recurringmessages")
+		self.tick_time = metrics.histogram("tick_seconds", "Time spent sending a batch of reminders due at once.")
+		self.reminders_due = metrics.counter("reminders_due_total", "Reminders that came due.")
+		self.reminders_claimed = metrics.counter(
+			"reminders_claimed_elsewhere_total", "Due reminders another bot process had already sent."
+		)
+		self.messages_sent = metrics.counter("messages_sent_total", "Recurring messages sent.")
+		self.messages_failed = metrics.counter("messages_failed_total", "Recurring messages that could not be sent.")
+		self.send_lateness = metrics.histogram(
+			"send_lateness_seconds", "How long after their due time messages went out.", (0.1, 0.5, 1, 5, 15, 60, 300, 900)
+		)
+		metrics.gauge("reminders_scheduled", "Reminders waiting in the scheduler.", lambda: len(self.scheduler))
+		metrics.gauge("owned_shards", "Shards this bot process holds the lease of.", lambda: len(self.owned_shards))
+		return metrics
 
 	def cog_unload(self):
 		self.loop.cancel()
-		return super().cog_unload()
+		self.lease_loop.cancel()
+		self.metrics_dump.cancel()
 
-	def create_reminder_data(self, id: int, channel_id: int, message: str, time: str, last_sent: str) -> dict:
-		return { "id": id, "channel_id": channel_id, "message": message , "time": time, "last_sent": last_sent }
+		for task in self.send_tasks:
+			task.cancel()
+
+		self.bot.loop.create_task(self.close_leases())
+		return super().cog_unload()
 
 	@commands.guild_only()
 	@commands.group(aliases=["recurringmessages"])
@@ -35,55 +82,91 @@ class RecurringMessages(commands.Cog):
 
 	@commands.guildowner_or_permissions(administrator=True)
 	@recurring.group(autohelp=False)
-	async def add(self, ctx: commands.Context, channel: discord.TextChannel, message_time: str, message: str):
-		"""Add a new recurring message to this server. Times are specified in UTC."""
+	async def add(self, ctx: commands.Context, channel: discord.TextChannel, schedule: str, message: str):
+		"""
+		Add a new recurring message to this server. Schedules are in UTC unless a timezone is set for them.
+
+		Schedules can be `HH:MM` or `daily HH:MM`, `hourly MM`, `every N minutes`, `every N hours`, `weekdays HH:MM`,
+		`weekends HH:MM`, `mon,wed,fri HH:MM`, `monthly D HH:MM` or `cron M H DOM MON DOW`.
+		"""
 		await ctx.trigger_typing()
 
-		reminder_time: time
+		try:
+			compiled = compile_schedule(schedule)
+		except ValueError as e:
+			await ctx.send(f"{e} Schedules can be {SCHEDULE_HELP}.")
+			await ctx.react_quietly(reaction="❎")
+			return
+
+		async with self.config.guild(ctx.guild).last_id.get_lock():
+			new_id = (await self.config.guild(ctx.guild).last_id()) + 1
+			# Only occurrences after the reminder was added are sent.
+			reminder = Reminder(new_id, channel.id, message, compiled, CATCH_UP_ONCE, self.scheduler.clock())
+			await self.config.guild(ctx.guild).reminders.set_raw(str(new_id), value=reminder.to_data())
+			await self.config.guild(ctx.guild).last_id.set(new_id)
+
+		self.reminders.set(ctx.guild.id, reminder)
+		self.schedule_reminder(ctx.guild.id, reminder)
+
+		await ctx.tick()
+		await ctx.reply(f"I will send that message there on the schedule `{compiled.spec}` (UTC), starting {self.describe_next(ctx.guild.id, reminder)}.")
+
+	@commands.guildowner_or_permissions(administrator=True)
+	@recurring.group(autohelp=False)
+	async def timezone(self, ctx: commands.Context, id: int, timezone: str):
+		"""Set the timezone of a recurring message's schedule, like `Europe/Madrid` or `America/New_York`."""
+		reminder = self.reminders.get(ctx.guild.id, id)
+
+		if(reminder is None):
+			await ctx.react_quietly(reaction="❎")
+			return
 
 		try:
-			reminder_time = time.fromisoformat(message_time)
-		except Exception as e:
-			await ctx.send(f"Invalid time \"{message_time}\".")
+			compiled = compile_schedule(reminder.schedule.spec, timezone)
+		except ValueError as e:
+			await ctx.send(str(e))
 			await ctx.react_quietly(reaction="❎")
-			log.exception(e)
 			return
 
-		actual_time = reminder_time.isoformat("minutes")
-		current_time: time = datetime.utcnow().timetz()
-		last_sent = str(date.min)
+		reminder = await self.update_reminder(ctx.guild.id, reminder._replace(schedule=compiled))
+		await ctx.tick()
+		await ctx.reply(f"That message will now be sent in {compiled.timezone.zone} time, next {self.describe_next(ctx.guild.id, reminder)}.")
+
+	@commands.guildowner_or_permissions(administrator=True)
+	@recurring.group(autohelp=False)
+	async def catchup(self, ctx: commands.Context, id: int, policy: str):
+		"""
+		Set what happens to the messages missed while the bot was down.
 
-		if(reminder_time < current_time):
-			last_sent = str(datetime.utcnow().date())
+		`skip` only sends the next one on time, `once` sends one right away and `all` sends every missed one.
+		Only messages missed in the last day are ever caught up.
+		"""
+		reminder = self.reminders.get(ctx.guild.id, id)
+		policy = policy.lower()
 
-		async with self.config.guild(ctx.guild).reminders() as guild_reminders:
-			new_id = (await self.config.guild(ctx.guild).last_id()) + 1
-			reminder = self.create_reminder_data(new_id, channel.id, message, actual_time, last_sent)
-			guild_reminders.append(reminder)
-			await self.config.guild(ctx.guild).last_id.set(new_id)
+		if(reminder is None or policy not in CATCH_UP_POLICIES):
+			await ctx.react_quietly(reaction="❎")
+			return
 
+		await self.update_reminder(ctx.guild.id, reminder._replace(catch_up=policy))
 		await ctx.tick()
-		await ctx.reply("I will send that message there every day at %s UTC." % actual_time)
 
 	@commands.guildowner_or_permissions(administrator=True)
 	@recurring.group(aliases=["remove"], autohelp=False)
 	async def delete(self, ctx: commands.Context, id: int):
 		"""Delete a recurring message on this server."""
-		async with self.config.guild(ctx.guild).reminders() as guild_reminders:
-			guild_reminders: list[dict]
-			for reminder in guild_reminders:
-				if(reminder["id"] == id):
-					guild_reminders.remove(reminder)
-					await ctx.tick()
-					return
-		
-		await ctx.react_quietly(reaction="❎")
+		if(self.reminders.get(ctx.guild.id, id) is None):
+			await ctx.react_quietly(reaction="❎")
+			return
+
+		await self.delete_reminders(ctx.guild.id, [id])
+		await ctx.tick()
 
 	@commands.guildowner_or_permissions(administrator=True)
 	@recurring.group(autohelp=False)
 	async def list(self, ctx: commands.Context):
-		"""Lists all recurring messages in the server. All times are in UTC."""
-		reminders: list[dict] = await self.config.guild(ctx.guild).reminders()
+		"""Lists all recurring messages in the server. Schedules are in UTC unless their timezone is shown."""
+		reminders = [*self.reminders.guild(ctx.guild.id).values()]
 
 		if(len(reminders) == 0):
 			await ctx.send(f"This server does not have any recurring messages.")
@@ -92,61 +175,168 @@ class RecurringMessages(commands.Cog):
 		embed_requested = await ctx.embed_requested()
 		base_embed = discord.Embed()
 		base_embed.set_author(name=f"Recurring Messages for \"{str(ctx.guild)}\"")
-		base_table = PrettyTable(field_names=["ID", "Channel", "Time", "Message"])
+		base_table = PrettyTable(field_names=["ID", "Channel", "Schedule", "Message"])
 		base_table.set_style(prettytable.PLAIN_COLUMNS)
 		base_table.right_padding_width = 2
 		base_table.align = "l"
 
 		base_table.align["Message"] = "m"
 
-		temp_table = base_table.copy()
+		def get_rows(start: int, stop: int):
+			rows = []
+
+			for reminder in reminders[start:stop]:
+				msg = reminder.message
+
+				if(len(msg) > 20):
+					msg = msg[:18] + "..."
+
+				reminder_id = str(reminder.id)
+				channel_id = reminder.channel_id
+				channel = self.bot.get_channel(channel_id)
+
+				if(channel == None):
+					channel = channel_id
+				else:
+					channel = str(channel)
+
+				schedule = reminder.schedule.spec
+
+				if(reminder.schedule.timezone.zone != "UTC"):
+					schedule += f" ({reminder.schedule.timezone.zone})"
+
+				rows.append([f"#{reminder_id}", f"#{channel}", schedule, msg])
+
+			return rows
+
+		pages = LazyPages(base_table, len(reminders), get_rows, base_embed if embed_requested else None)
+		await pages.menu(ctx)
+
+	@commands.guildowner_or_permissions(administrator=True)
+	@recurring.group(name="import", autohelp=False)
+	async def import_reminders(self, ctx: commands.Context):
+		"""
+		Add recurring messages in bulk from an attached CSV, JSON or JSON lines file.
+
+		Every row needs a `channel` (id, mention or name), a `schedule` and a `message`, and can have a `timezone`
+		and a `catch_up` policy. Rows with errors are reported and skipped, and every other row is added at once.
+		The files made by `[p]recurring export` can be imported as they are.
+		"""
+		if not ctx.message.attachments:
+			await ctx.send("Attach a .csv, .json or .jsonl file to import.")
+			return
+
+		attachment: discord.Attachment = ctx.message.attachments[0]
 
-		pages = []
+		try:
+			fmt = file_format(attachment.filename)
+			text = (await attachment.read()).decode("utf-8-sig")
+		except (ValueError, discord.HTTPException) as e:
+			await ctx.send(f"I couldn't read that file: {e}")
+			await ctx.react_quietly(reaction="❎")
+			return
+
+		async with ctx.typing():
+			parsed = []
+			errors = []
+
+			for count, (number, row) in enumerate(read_rows(text, fmt), start=1):
+				try:
+					parsed.append(parse_row(ctx.guild, row))
+				except ValueError as e:
+					errors.append(f"Row {number}: {e}")
+
+				if(count % CHUNK_SIZE == 0):
+					await asyncio.sleep(0)
 
-		def make_embed():
-			nonlocal temp_table, pages
-			msg = temp_table.get_string()
+			if(parsed):
+				now = self.scheduler.clock()
 
-			if(embed_requested):
-				embed = base_embed.copy()
-				embed.description = box(msg, lang="md")
-				embed.set_footer(text=f"Page {len(pages)+1}/{ceil(len(reminders)/10)}")
-				pages.append(embed)
-			else:
-				pages.append(box(msg, lang="md"))
+				# Ids are allocated in one block, and every reminder is saved in the same write.
+				async with self.config.guild(ctx.guild).last_id.get_lock():
+					async with self.config.guild(ctx.guild).all() as data:
+						first_id = data["last_id"] + 1
+						reminders = [
+							Reminder(first_id + i, channel.id, message, schedule, catch_up, now)
+							for i, (channel, message, schedule, catch_up) in enumerate(parsed)
+						]
+						data["reminders"].update((str(reminder.id), reminder.to_data()) for reminder in reminders)
+						data["last_id"] = first_id + len(reminders) - 1
 
-			temp_table = base_table.copy()
+				for reminder in reminders:
+					self.reminders.set(ctx.guild.id, reminder)
+					self.schedule_reminder(ctx.guild.id, reminder)
 
-		for idx, reminder in enumerate(reminders, start=1):
-			msg = reminder["message"]
+		summary = f"Added {len(parsed)} recurring message{'s' if len(parsed) != 1 else ''}."
 
-			if(len(msg) > 20):
-				msg = msg[:18] + "..."
+		if(errors):
+			summary += f" {len(errors)} row{'s' if len(errors) != 1 else ''} had errors:\n" + "\n".join(errors)
 
-			reminder_id = str(reminder["id"])
-			channel_id = reminder["channel_id"]
-			channel = self.bot.get_channel(channel_id)
+		for page in pagify(summary):
+			await ctx.send(page)
 
-			if(channel == None):
-				channel = channel_id
-			else:
-				channel = str(channel)
+		if(parsed):
+			await ctx.tick()
 
-			temp_table.add_row([f"#{reminder_id}", f"#{channel}", reminder["time"], msg])
-			
-			if(idx % 10 == 0):
-				make_embed()
+	@commands.guildowner_or_permissions(administrator=True)
+	@recurring.group(autohelp=False)
+	async def export(self, ctx: commands.Context, file_type: str = "csv"):
+		"""Export every recurring message in this server as a CSV, JSON or JSON lines file."""
+		file_type = file_type.lower().lstrip(".")
+		reminders = [*self.reminders.guild(ctx.guild.id).values()]
 
-		if(len(pages) != ceil(len(reminders)/10)):
-			make_embed()
+		if file_type not in FORMATS:
+			await ctx.send(f"The format must be one of {', '.join(FORMATS)}.")
+			return
 
-		if not pages:
+		if(len(reminders) == 0):
 			await ctx.send(f"This server does not have any recurring messages.")
 			return
 
-		c = DEFAULT_CONTROLS if len(pages) > 1 else {"\N{CROSS MARK}": close_menu}
+		# Rows are written to a temporary file as they are formatted, rather than building the whole file in memory.
+		with tempfile.TemporaryFile() as file:
+			await write_rows(file, reminders, file_type)
+			file.seek(0)
+			await ctx.send(file=discord.File(file, filename=f"recurring-messages-{ctx.guild.id}.{file_type}"))
+
+	@commands.is_owner()
+	@recurring.group(autohelp=False)
+	async def leasefile(self, ctx: commands.Context, path: str = None):
+		"""
+		Set the SQLite file bot processes use to split reminders between them.
+
+		Every process of a clustered bot on the same host must use the same file. Leave it empty to use one in this
+		cog's data folder.
+		"""
+		await self.config.lease_file.set(path)
+		await self.close_leases()
+		self.loop.restart()
+		await ctx.tick()
+
+	@commands.is_owner()
+	@recurring.group(name="metrics", autohelp=False)
+	async def show_metrics(self, ctx: commands.Context):
+		"""Shows how the task loop performed since the cog was loaded."""
+		for page in pagify(self.metrics.render()):
+			await ctx.send(box(page))
+
+	@commands.is_owner()
+	@recurring.group(autohelp=False)
+	async def metricsfile(self, ctx: commands.Context, path: str = None):
+		"""
+		Set a file to write the metrics to every minute, in the Prometheus text format.
+
+		Point a node exporter's textfile collector at it to scrape them. Leave it empty to stop writing it.
+		"""
+		if(path is not None):
+			path = Path(path).expanduser().resolve()
 
-		await menu(ctx, pages, c)
+			if not path.parent.is_dir():
+				await ctx.send(f"The folder `{path.parent}` does not exist.")
+				return
+
+		await self.config.metrics_file.set(str(path) if path is not None else None)
+		await ctx.tick()
 
 	@commands.is_owner()
 	@recurring.group(autohelp=False)
@@ -155,59 +345,250 @@ class RecurringMessages(commands.Cog):
 		self.loop.restart()
 		await ctx.tick()
 
-	@tasks.loop(minutes=1.0)
-	async def loop(self):
+	@commands.Cog.listener()
+	async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+		keys = self.reminders.by_channel(channel.id)
+
+		if(keys):
+			await self.delete_reminders(channel.guild.id, [reminder_id for _, reminder_id in keys])
+
+	async def delete_reminders(self, guild_id: int, reminder_ids: List[int]):
+		"""Deletes reminders from a guild in one config write, and unschedules them."""
+		for reminder_id in reminder_ids:
+			self.reminders.remove(guild_id, reminder_id)
+			self.scheduler.cancel((guild_id, reminder_id))
+
+		async with self.config.guild_from_id(guild_id).reminders() as guild_reminders:
+			for reminder_id in reminder_ids:
+				guild_reminders.pop(str(reminder_id), None)
+
+	def schedule_reminder(self, guild_id: int, reminder: Reminder):
+		"""Schedules a reminder for the next time it is due."""
+		when = next_fire(reminder.schedule, reminder.last_sent, self.scheduler.clock(), reminder.catch_up)
+		self.scheduler.schedule((guild_id, reminder.id), when)
+
+	async def update_reminder(self, guild_id: int, reminder: Reminder) -> Reminder:
+		"""Saves a changed reminder and schedules it again."""
+		await self.config.guild_from_id(guild_id).reminders.set_raw(str(reminder.id), value=reminder.to_data())
+		self.reminders.set(guild_id, reminder)
+		self.schedule_reminder(guild_id, reminder)
+		return reminder
+
+	def describe_next(self, guild_id: int, reminder: Reminder) -> str:
+		when = self.scheduler.when((guild_id, reminder.id))
+		return f"at {when.strftime('%Y-%m-%d %H:%M')} UTC" if when is not None else "soon"
+
+	async def migrate(self, version: int):
+		"""
+		Upgrades every guild's reminders from an older schema version.
+
+		Version 0 stored them in a list instead of keyed by their id, and version 1 only had daily reminders.
+		"""
+		for guild_id, data in (await self.config.all_guilds()).items():
+			reminders = data["reminders"]
+
+			if(isinstance(reminders, list)):
+				reminders = {str(reminder.pop("id")): reminder for reminder in reminders}
+
+			upgraded = {}
+
+			for reminder_id, reminder in reminders.items():
+				try:
+					upgraded[reminder_id] = upgrade_reminder_data(reminder, version)
+				except Exception as e:
+					log.exception(e)
+
+			await self.config.guild_from_id(guild_id).reminders.set(upgraded)
+
+		await self.config.schema_version.set(SCHEMA_VERSION)
+
+	async def load_schedule(self):
+		"""
+		Loads and schedules the reminders of every guild on a shard this process holds the lease of.
+
+		Only those guilds are read, so the work is split between every process of a clustered bot.
+		"""
+		version = await self.config.schema_version()
+
+		if(version < SCHEMA_VERSION):
+			await self.migrate(version)
+
+		self.reminders.clear()
+		self.scheduler.clear()
+		self.owned_shards = set()
+
+		if(self.leases is None):
+			path = await self.config.lease_file()
+			self.leases = LeaseStore(Path(path) if path else cog_data_path(self) / "leases.sqlite3", ttl=LEASE_TTL)
+			await self.leases.open()
+
+		await self.refresh_leases()
+
+	async def close_leases(self):
+		if(self.leases is not None):
+			leases, self.leases = self.leases, None
+			await leases.release()
+			await leases.close()
+
+	def shard_of(self, guild_id: int) -> int:
+		return (guild_id >> 22) % (self.bot.shard_count or 1)
+
+	async def refresh_leases(self):
+		"""Renews this process' shard leases, loading the guilds of shards it gained and dropping those of shards it lost."""
+		shard_count = self.bot.shard_count or 1
+		held = await self.leases.acquire(shard_count, self.bot.shard_ids or range(shard_count))
+		gained, lost = held - self.owned_shards, self.owned_shards - held
+		self.owned_shards = held
+
+		if(lost):
+			for guild_id in [*self.reminders.guilds]:
+				if(self.shard_of(guild_id) in lost):
+					self.unload_guild(guild_id)
+
+		if(gained):
+			for guild in self.bot.guilds:
+				if(self.shard_of(guild.id) in gained):
+					await self.load_guild(guild.id)
+
+	async def load_guild(self, guild_id: int):
+		for reminder_id, reminder in (await self.config.guild_from_id(guild_id).reminders()).items():
+			try:
+				reminder = Reminder.from_data(int(reminder_id), reminder)
+			except Exception as e:
+				log.exception(e)
+				continue
+
+			self.reminders.set(guild_id, reminder)
+			self.schedule_reminder(guild_id, reminder)
+
+	def unload_guild(self, guild_id: int):
+		for reminder_id in [*self.reminders.guild(guild_id)]:
+			self.reminders.remove(guild_id, reminder_id)
+			self.scheduler.cancel((guild_id, reminder_id))
+
+	async def send_due(self, due: List[Tuple[ReminderKey, datetime]]):
+		"""
+		Sends the due reminders concurrently and schedules each of them again for the next day.
+
+		Reminders are read from the index, and config is written once per guild after every send finished, so it is
+		never held open while waiting on Discord. Reminders the batch did not get to schedule again, because it failed
+		part way, are retried after `RETRY_DELAY` seconds.
+		"""
 		try:
-			# timezones are funny, so let's not deal with them!
-			today: datetime = datetime.utcnow()
-			today_date: date = today.date()
-			current_time: time = today.timetz()
+			jobs: List[SendJob] = []
+			occurrences = []
+			sent: Dict[int, Dict[int, datetime]] = {}
+			stale: Dict[int, List[int]] = {}
+			self.reminders_due.inc(len(due))
 
-			guilds = await self.config.all_guilds()
-
-			for guild_id in guilds.keys():
+			for (guild_id, reminder_id), when in due:
 				guild: discord.Guild = self.bot.get_guild(guild_id)
+				reminder = self.reminders.get(guild_id, reminder_id)
 
-				if(guild == None):
+				if(guild == None or reminder is None):
 					continue
 
-				async with self.config.guild(guild).reminders() as guild_reminders:
-					guild_reminders: list[dict]
-					rem_list: list[int] = [] # remie list...
+				channel: discord.TextChannel = guild.get_channel(reminder.channel_id)
 
-					for idx, reminder in enumerate(guild_reminders):
-						try:
-							reminder_last_sent = date.fromisoformat(reminder["last_sent"])
-							reminder_time = time.fromisoformat(reminder["time"])
-						except Exception as e:
-							log.exception(e)
-							continue
+				# Remove invalid reminders (for when the specific channel gets deleted)
+				if(channel == None):
+					stale.setdefault(guild_id, []).append(reminder_id)
+					continue
 
-						# Check whether we already sent that reminder today or not.
-						if(reminder_last_sent >= today_date):
-							continue
+				jobs.append(SendJob((guild_id, reminder_id), channel, reminder.message, when))
+				occurrences.append((guild_id, reminder_id, reminder.last_sent))
+				sent.setdefault(guild_id, {})[reminder_id] = when
 
-						# Check whether it's time to send that reminder or not.
-						if(reminder_time > current_time):
-							continue
+			for guild_id, reminder_ids in stale.items():
+				await self.delete_reminders(guild_id, reminder_ids)
+
+			# Another process may have sent some of them already, during a failover or a reshard.
+			claimed = await self.leases.claim(occurrences)
+			results = await self.dispatcher.dispatch([job for job, mine in zip(jobs, claimed) if mine])
+			self.reminders_claimed.inc(len(jobs) - len(results))
 
-						channel: discord.TextChannel = guild.get_channel(reminder["channel_id"])
+			for result in results:
+				if(result.sent):
+					self.messages_sent.inc()
+					self.send_lateness.observe(result.lateness)
+				else:
+					self.messages_failed.inc()
 
-						if(channel == None):
-							rem_list.append(idx)
+				log.debug("Recurring message %s went out %.1fs late after %d attempt(s).", result.key, result.lateness, result.attempts)
+
+			late = [result.lateness for result in results if result.lateness >= 60]
+			if(late):
+				log.warning("%d of %d recurring messages went out over a minute late, up to %.0fs.", len(late), len(results), max(late))
+
+			# Failed reminders are still marked as sent, or they would be retried in a loop until the next day.
+			# Batches are sent concurrently, but the config context manager holds the value's lock while it is rewritten.
+			for guild_id, reminder_times in sent.items():
+				async with self.config.guild_from_id(guild_id).reminders() as guild_reminders:
+					for reminder_id, when in reminder_times.items():
+						reminder = self.reminders.get(guild_id, reminder_id)
+
+						# It was deleted while it was being sent.
+						if(reminder is None or str(reminder_id) not in guild_reminders):
 							continue
 
-						await channel.send(reminder["message"])
-						reminder["last_sent"] = today_date.isoformat()
+						reminder = reminder._replace(last_sent=when)
+						guild_reminders[str(reminder_id)]["last_sent"] = reminder.last_sent.isoformat()
+						self.reminders.set(guild_id, reminder)
+						self.schedule_reminder(guild_id, reminder)
+		finally:
+			# They were popped from the scheduler, so one left out here would not be sent again until the cog reloads.
+			now = self.scheduler.clock()
+			retry_at = now + timedelta(seconds=RETRY_DELAY)
 
-					# Remove invalid reminders (for when the specific channel gets deleted)
-					for idx in rem_list:
-						guild_reminders.pop(idx)
-						
+			for key, when in due:
+				reminder = self.reminders.get(*key)
+
+				if(reminder is not None and key not in self.scheduler):
+					self.scheduler.schedule(key, max(next_fire(reminder.schedule, reminder.last_sent, now, reminder.catch_up), retry_at))
+
+	@tasks.loop(seconds=0)
+	async def loop(self):
+		try:
+			# Sleeps until the earliest reminder is due, rather than polling every guild's config.
+			due = await self.scheduler.wait()
+			# Send in the background, so a slow channel or a retry never holds up the reminders due after it.
+			# The dispatcher still bounds how many messages are in flight.
+			task = asyncio.ensure_future(self.send_batch(due))
+			self.send_tasks.add(task)
+			task.add_done_callback(self.send_tasks.discard)
+		except Exception as e:
+			log.exception(e)
 
+	async def send_batch(self, due: List[Tuple[ReminderKey, datetime]]):
+		try:
+			with self.tick_time.time():
+				await self.send_due(due)
 		except Exception as e:
 			log.exception(e)
 
 	@loop.before_loop
 	async def before_loop(self):
-		await self.bot.wait_until_ready()
\ No newline at end of file
+		await self.bot.wait_until_ready()
+		await self.load_schedule()
+
+		if not self.lease_loop.is_running():
+			self.lease_loop.start()
+
+	@tasks.loop(seconds=LEASE_TTL / 3)
+	async def lease_loop(self):
+		try:
+			if(self.leases is not None):
+				await self.refresh_leases()
+				await self.leases.prune(24 * 60 * 60)
+		except Exception as e:
+			log.exception(e)
+
+	@tasks.loop(seconds=60)
+	async def metrics_dump(self):
+		try:
+			path = await self.config.metrics_file()
+
+			if(path):
+				await self.bot.loop.run_in_executor(None, self.metrics.write_prometheus, Path(path))
+		except OSError as e:
+			log.warning("Could not write the metrics to %s: %s", path, e)
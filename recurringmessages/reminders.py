@@ -0,0 +1,116 @@
+from datetime import date, datetime, time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from .recurrence import CATCH_UP_ONCE, Schedule, compile_schedule
+
+# (guild id, reminder id)
+ReminderKey = Tuple[int, int]
+
+
+class Reminder(NamedTuple):
+	id: int
+	channel_id: int
+	message: str
+	schedule: Schedule
+	catch_up: str
+	# The occurrence it was last sent for, in UTC.
+	last_sent: datetime
+
+	@classmethod
+	def from_data(cls, reminder_id: int, data: dict) -> "Reminder":
+		"""Parses a reminder as stored in config, where it is keyed by its id."""
+		return cls(
+			reminder_id,
+			data["channel_id"],
+			data["message"],
+			compile_schedule(data["schedule"], data["timezone"]),
+			data["catch_up"],
+			datetime.fromisoformat(data["last_sent"])
+		)
+
+	def to_data(self) -> dict:
+		return {
+			"channel_id": self.channel_id,
+			"message": self.message,
+			"schedule": self.schedule.spec,
+			"timezone": self.schedule.timezone.zone,
+			"catch_up": self.catch_up,
+			"last_sent": self.last_sent.isoformat()
+		}
+
+
+def upgrade_reminder_data(data: dict, version: int) -> dict:
+	"""Upgrades a reminder stored in config by an older schema version to the current one."""
+	if(version < 2):
+		# Daily reminders at a time of day in UTC, that only kept the date they were last sent on.
+		reminder_time = time.fromisoformat(data["time"]).replace(tzinfo=None)
+		data = {
+			"channel_id": data["channel_id"],
+			"message": data["message"],
+			"schedule": f"daily {reminder_time.isoformat('minutes')}",
+			"timezone": "UTC",
+			"catch_up": CATCH_UP_ONCE,
+			"last_sent": datetime.combine(date.fromisoformat(data["last_sent"]), reminder_time).isoformat()
+		}
+
+	return data
+
+
+class ReminderIndex:
+	"""
+	Every loaded reminder, by guild and id, with their times already parsed.
+
+	It also maps channels to the reminders that send to them, so the reminders of a deleted channel can be found
+	without a scan. It must be kept up to date by everything that changes a guild's reminders in config.
+	"""
+	def __init__(self):
+		self.guilds: Dict[int, Dict[int, Reminder]] = {}
+		self.channels: Dict[int, Set[ReminderKey]] = {}
+
+	def __len__(self) -> int:
+		return sum(map(len, self.guilds.values()))
+
+	def clear(self):
+		self.guilds.clear()
+		self.channels.clear()
+
+	def guild(self, guild_id: int) -> Dict[int, Reminder]:
+		return self.guilds.get(guild_id, {})
+
+	def get(self, guild_id: int, reminder_id: int) -> Optional[Reminder]:
+		return self.guild(guild_id).get(reminder_id)
+
+	def set(self, guild_id: int, reminder: Reminder):
+		"""Adds a reminder, or replaces the one with the same id."""
+		previous = self.get(guild_id, reminder.id)
+
+		if(previous is not None and previous.channel_id != reminder.channel_id):
+			self._unlink(previous.channel_id, (guild_id, reminder.id))
+
+		self.guilds.setdefault(guild_id, {})[reminder.id] = reminder
+		self.channels.setdefault(reminder.channel_id, set()).add((guild_id, reminder.id))
+
+	def remove(self, guild_id: int, reminder_id: int) -> Optional[Reminder]:
+		reminders = self.guilds.get(guild_id)
+		reminder = reminders.pop(reminder_id, None) if reminders is not None else None
+
+		if(reminder is None):
+			return None
+
+		if not reminders:
+			del self.guilds[guild_id]
+
+		self._unlink(reminder.channel_id, (guild_id, reminder_id))
+		return reminder
+
+	def by_channel(self, channel_id: int) -> List[ReminderKey]:
+		return list(self.channels.get(channel_id, ()))
+
+	def _unlink(self, channel_id: int, key: ReminderKey):
+		keys = self.channels.get(channel_id)
+
+		if(keys is not None):
+			keys.discard(key)
+
+			if not keys:
+				del self.channels[channel_id]
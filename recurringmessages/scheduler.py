@@ -0,0 +1,96 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# Longest time the scheduler sleeps without checking the clock again, in case the system clock jumps.
+MAX_SLEEP = 60 * 60
+
+_REMOVED = object()
+
+
+class ReminderScheduler:
+	"""
+	A priority queue of reminders by the time they are next due.
+
+	Reminders are identified by any hashable key. Scheduling or cancelling one costs O(log n); cancelled entries are
+	only marked as removed and dropped once they reach the top of the heap. `wait` sleeps until the earliest
+	reminder is due, and wakes up early if an earlier one gets scheduled in the meantime.
+	"""
+	def __init__(self, clock: Callable[[], datetime] = datetime.utcnow):
+		self.clock = clock
+		self._heap: List[list] = []
+		self._entries: Dict[Hashable, list] = {}
+		self._counter = itertools.count()
+		self._wakeup = asyncio.Event()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._entries
+
+	def schedule(self, key: Hashable, when: datetime):
+		"""Schedules a reminder, replacing any time it was already scheduled for."""
+		self.cancel(key)
+
+		entry = [when, next(self._counter), key]
+		self._entries[key] = entry
+		heapq.heappush(self._heap, entry)
+
+		if(self._heap[0] is entry):
+			self._wakeup.set()
+
+	def cancel(self, key: Hashable):
+		entry = self._entries.pop(key, None)
+
+		if(entry is not None):
+			entry[-1] = _REMOVED
+
+	def clear(self):
+		self._heap.clear()
+		self._entries.clear()
+		self._wakeup.set()
+
+	def when(self, key: Hashable) -> Optional[datetime]:
+		entry = self._entries.get(key)
+		return entry[0] if entry is not None else None
+
+	def next_time(self) -> Optional[datetime]:
+		"""Returns the time the earliest reminder is due, or None if nothing is scheduled."""
+		while(self._heap and self._heap[0][-1] is _REMOVED):
+			heapq.heappop(self._heap)
+
+		return self._heap[0][0] if self._heap else None
+
+	def pop_due(self, now: datetime) -> List[Tuple[Hashable, datetime]]:
+		"""Removes every reminder due at or before `now` and returns their keys and due times, earliest first."""
+		due = []
+
+		while(self._heap and self._heap[0][0] <= now):
+			when, _, key = heapq.heappop(self._heap)
+
+			if(key is not _REMOVED):
+				del self._entries[key]
+				due.append((key, when))
+
+		return due
+
+	async def wait(self) -> List[Tuple[Hashable, datetime]]:
+		"""Sleeps until at least one reminder is due, then removes and returns every due reminder like `pop_due`."""
+		while True:
+			when = self.next_time()
+			now = self.clock()
+
+			if(when is not None and when <= now):
+				return self.pop_due(now)
+
+			timeout = MAX_SLEEP if when is None else min(MAX_SLEEP, (when - now).total_seconds())
+			self._wakeup.clear()
+
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), timeout)
+			except asyncio.TimeoutError:
+				pass
+
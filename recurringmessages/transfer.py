@@ -0,0 +1,166 @@
+import asyncio
+import csv
+import io
+import json
+import re
+from typing import IO, Iterable, Iterator, Tuple, Union
+
+import discord
+
+from .recurrence import CATCH_UP_ONCE, CATCH_UP_POLICIES, Schedule, compile_schedule
+from .reminders import Reminder
+
+# Columns of exported files. Imports need `channel`, `schedule` and `message`, and ignore `id`.
+FIELDS = ("id", "channel", "schedule", "timezone", "catch_up", "message")
+FORMATS = ("csv", "json", "jsonl")
+
+# Rows handled between yields to the event loop.
+CHUNK_SIZE = 500
+
+_channel_mention = re.compile(r"<#(\d+)>")
+
+
+def file_format(filename: str) -> str:
+	"""Returns the format of a file from its extension. Raises ValueError if it isn't supported."""
+	extension = filename.rsplit(".", 1)[-1].lower()
+
+	if(extension == "ndjson"):
+		return "jsonl"
+
+	if extension not in FORMATS:
+		raise ValueError(f"Unsupported file \"{filename}\", it must be a .csv, .json or .jsonl file.")
+
+	return extension
+
+
+def _json_array(text: str) -> Iterator[Tuple[int, Union[dict, ValueError]]]:
+	"""Decodes the items of a JSON array one at a time, instead of building the whole list first."""
+	decoder = json.JSONDecoder()
+	whitespace = re.compile(r"[\s,]*")
+	index = whitespace.match(text).end()
+
+	if(text[index:index + 1] != "["):
+		yield 1, ValueError("a JSON file must contain a list of messages")
+		return
+
+	index = whitespace.match(text, index + 1).end()
+	number = 0
+
+	while(text[index:index + 1] not in ("]", "")):
+		number += 1
+
+		try:
+			item, index = decoder.raw_decode(text, index)
+		except ValueError as e:
+			# There is no telling where the next item starts, so give up on the rest.
+			yield number, ValueError(f"invalid JSON ({e})")
+			return
+
+		yield number, item
+		index = whitespace.match(text, index).end()
+
+
+def read_rows(text: str, fmt: str) -> Iterator[Tuple[int, Union[dict, ValueError]]]:
+	"""
+	Yields the rows of an import file as (row number, row) pairs, as they are read.
+
+	Rows that can't be decoded are yielded as a ValueError instead, so the remaining rows can still be imported.
+	"""
+	if(fmt == "csv"):
+		for number, row in enumerate(csv.DictReader(io.StringIO(text, newline="")), start=1):
+			yield number, {key.strip().lower(): value for key, value in row.items() if key is not None}
+
+	elif(fmt == "jsonl"):
+		for number, line in enumerate(io.StringIO(text), start=1):
+			if not line.strip():
+				continue
+
+			try:
+				yield number, json.loads(line)
+			except ValueError as e:
+				yield number, ValueError(f"invalid JSON ({e})")
+
+	else:
+		yield from _json_array(text)
+
+
+def resolve_channel(guild: discord.Guild, value) -> discord.TextChannel:
+	"""Finds a text channel in a guild by its id, its mention or its name."""
+	value = str(value or "").strip()
+	mention = _channel_mention.fullmatch(value)
+
+	if(mention or value.isdigit()):
+		channel = guild.get_channel(int(mention.group(1) if mention else value))
+	else:
+		channel = discord.utils.get(guild.text_channels, name=value.lstrip("#"))
+
+	if not isinstance(channel, discord.TextChannel):
+		raise ValueError(f"unknown text channel \"{value}\"")
+
+	return channel
+
+
+def parse_row(guild: discord.Guild, row) -> Tuple[discord.TextChannel, str, Schedule, str]:
+	"""Validates an import row, returning its channel, message, schedule and catch-up policy. Raises ValueError."""
+	if(isinstance(row, ValueError)):
+		raise row
+
+	if not isinstance(row, dict):
+		raise ValueError("every message must be an object")
+
+	channel = resolve_channel(guild, row.get("channel") or row.get("channel_id"))
+	message = str(row.get("message") or "")
+
+	if not message.strip():
+		raise ValueError("the message is empty")
+
+	if(len(message) > 2000):
+		raise ValueError("the message is over 2000 characters long")
+
+	schedule = compile_schedule(str(row.get("schedule") or row.get("time") or ""), str(row.get("timezone") or "UTC"))
+	catch_up = str(row.get("catch_up") or CATCH_UP_ONCE).lower()
+
+	if catch_up not in CATCH_UP_POLICIES:
+		raise ValueError(f"unknown catch-up policy \"{catch_up}\"")
+
+	return channel, message, schedule, catch_up
+
+
+def _export_row(reminder: Reminder) -> dict:
+	return {
+		"id": reminder.id,
+		"channel": reminder.channel_id,
+		"schedule": reminder.schedule.spec,
+		"timezone": reminder.schedule.timezone.zone,
+		"catch_up": reminder.catch_up,
+		"message": reminder.message
+	}
+
+
+async def write_rows(file: IO[bytes], reminders: Iterable[Reminder], fmt: str):
+	"""Writes reminders to a binary file as they are formatted, yielding to the event loop every few rows."""
+	text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+	writer = csv.DictWriter(text, FIELDS) if fmt == "csv" else None
+
+	try:
+		if(writer is not None):
+			writer.writeheader()
+		elif(fmt == "json"):
+			text.write("[")
+
+		for number, reminder in enumerate(reminders):
+			if(writer is not None):
+				writer.writerow(_export_row(reminder))
+			elif(fmt == "json"):
+				text.write(("," if number else "") + "\n" + json.dumps(_export_row(reminder)))
+			else:
+				text.write(json.dumps(_export_row(reminder)) + "\n")
+
+			if(number % CHUNK_SIZE == CHUNK_SIZE - 1):
+				await asyncio.sleep(0)
+
+		if(fmt == "json"):
+			text.write("\n]\n")
+	finally:
+		text.flush()
+		text.detach()
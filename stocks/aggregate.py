@@ -0,0 +1,140 @@
+from array import array
+from typing import Dict, List, Tuple
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# (user id, total value in USD, total shares, total investment in USD, profit percentage)
+GlobalRow = Tuple[int, float, int, float, float]
+
+
+class PackedPositions:
+	"""
+	Every stock position across guilds, packed into parallel fixed-width columns.
+
+	Users and tickers are stored as indices into `user_ids` and `tickers`, and investments are converted to USD
+	with the conversion rate of the guild they were made in, so positions from every guild can be summed.
+	"""
+	def __init__(self):
+		self.user_ids: List[int] = []
+		self.tickers: List[str] = []
+		self.user_column = array('q')
+		self.ticker_column = array('q')
+		self.count_column = array('q')
+		self.investment_column = array('d')
+		self._user_index: Dict[int, int] = {}
+		self._ticker_index: Dict[str, int] = {}
+
+	def __len__(self) -> int:
+		return len(self.count_column)
+
+	def add_member(self, member_id: int, positions: Dict[str, dict], conversion: int, prices: Dict[str, float]):
+		"""Adds a member's positions in one guild. Positions are valued at `count * price` if their investment is missing."""
+		user = self._user_index.get(member_id)
+
+		if(user is None):
+			user = self._user_index[member_id] = len(self.user_ids)
+			self.user_ids.append(member_id)
+
+		for ticker, stock in positions.items():
+			index = self._ticker_index.get(ticker)
+
+			if(index is None):
+				index = self._ticker_index[ticker] = len(self.tickers)
+				self.tickers.append(ticker)
+
+			investment = stock.get('investment')
+
+			self.user_column.append(user)
+			self.ticker_column.append(index)
+			self.count_column.append(stock['count'])
+			self.investment_column.append(
+				investment / conversion if investment is not None else stock['count'] * prices.get(ticker, 0.0)
+			)
+
+	def price_column(self, prices: Dict[str, float]) -> array:
+		"""Returns the USD price of every ticker by index, NaN for tickers without one."""
+		return array('d', (prices.get(ticker, float('nan')) for ticker in self.tickers))
+
+
+def pack(members: List[Tuple[int, Dict[str, dict], int]], prices: Dict[str, float]) -> PackedPositions:
+	"""
+	Packs the (member id, positions, conversion rate) of every member in every guild. Like `rank`, this is plain CPU
+	work, so it can run in an executor as long as nothing changes the positions meanwhile.
+	"""
+	packed = PackedPositions()
+
+	for member_id, positions, conversion in members:
+		packed.add_member(member_id, positions, conversion, prices)
+
+	return packed
+
+
+def rank(packed: PackedPositions, prices: array) -> List[GlobalRow]:
+	"""
+	Sums every user's positions and returns them ranked by total value, highest first.
+
+	Positions in tickers without a price are left out, and so are users without any priced position. This is
+	plain CPU work, so it can run in an executor.
+	"""
+	if(np is not None):
+		return _rank_numpy(packed, prices)
+
+	return _rank_python(packed, prices)
+
+
+def _rank_numpy(packed: PackedPositions, prices: array) -> List[GlobalRow]:
+	users = np.frombuffer(packed.user_column, dtype=np.int64)
+	tickers = np.frombuffer(packed.ticker_column, dtype=np.int64)
+	counts = np.frombuffer(packed.count_column, dtype=np.int64)
+	investments = np.frombuffer(packed.investment_column, dtype=np.float64)
+	position_prices = np.frombuffer(prices, dtype=np.float64)[tickers]
+
+	priced = ~np.isnan(position_prices)
+	users, counts, investments, position_prices = users[priced], counts[priced], investments[priced], position_prices[priced]
+
+	size = len(packed.user_ids)
+	values = np.bincount(users, weights=counts * position_prices, minlength=size)
+	shares = np.bincount(users, weights=counts, minlength=size)
+	invested = np.bincount(users, weights=investments, minlength=size)
+
+	held = np.nonzero(shares)[0]
+	order = held[np.argsort(-values[held], kind="stable")]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		change = np.where(invested > 0, (values / invested - 1.0) * 100.0, 0.0)
+
+	return [
+		(packed.user_ids[i], float(values[i]), int(shares[i]), float(invested[i]), float(change[i]))
+		for i in order.tolist()
+	]
+
+
+def _rank_python(packed: PackedPositions, prices: array) -> List[GlobalRow]:
+	size = len(packed.user_ids)
+	values = array('d', bytes(8 * size))
+	shares = array('q', bytes(8 * size))
+	invested = array('d', bytes(8 * size))
+
+	for user, ticker, count, investment in zip(
+		packed.user_column, packed.ticker_column, packed.count_column, packed.investment_column
+	):
+		price = prices[ticker]
+
+		if(price != price):
+			continue
+
+		values[user] += count * price
+		shares[user] += count
+		invested[user] += investment
+
+	order = sorted((i for i in range(size) if shares[i]), key=values.__getitem__, reverse=True)
+
+	return [
+		(
+			packed.user_ids[i], values[i], shares[i], invested[i],
+			((values[i] / invested[i]) - 1.0) * 100.0 if invested[i] > 0 else 0.0
+		)
+		for i in order
+	]
@@ -0,0 +1,45 @@
+import csv
+import gzip
+import io
+import json
+from typing import IO, List, Sequence
+
+# Columns of exported holdings. `real_price` is in USD, `price` and `value` are in the guild's currency.
+FIELDS = ("member_id", "ticker", "count", "investment", "real_price", "price", "value", "stale")
+# Columns of exported trades, as they are kept in the ledger. Sells have a negative number of shares.
+TRADE_FIELDS = ("id", "member_id", "ticker", "shares", "price", "executed_at")
+FORMATS = ("csv", "jsonl")
+
+# Members, or trades, read and written at a time.
+CHUNK_SIZE = 500
+
+
+class HoldingsWriter:
+	"""
+	Writes rows of holdings, or trades with `TRADE_FIELDS`, to a binary file as a gzip-compressed CSV or JSON lines
+	file, a chunk at a time.
+
+	Writing only compresses and formats, so it can be run in an executor while the next chunk is read.
+	"""
+	def __init__(self, file: IO[bytes], fmt: str, fields: Sequence[str] = FIELDS):
+		self.compressed = gzip.GzipFile(fileobj=file, mode="wb")
+		self.text = io.TextIOWrapper(self.compressed, encoding="utf-8", newline="")
+		self.writer = csv.DictWriter(self.text, fields) if fmt == "csv" else None
+		self.rows = 0
+
+		if(self.writer is not None):
+			self.writer.writeheader()
+
+	def write(self, rows: List[dict]):
+		if(self.writer is not None):
+			self.writer.writerows(rows)
+		else:
+			self.text.write("".join(json.dumps(row) + "\n" for row in rows))
+
+		self.rows += len(rows)
+
+	def close(self):
+		"""Finishes the compressed stream, leaving the underlying file open."""
+		self.text.flush()
+		self.text.detach()
+		self.compressed.close()
@@ -0,0 +1,273 @@
+import math
+import mmap
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Name, seconds per sample and number of samples kept, from the finest resolution to the coarsest.
+RESOLUTIONS = (
+	("5m", 5 * 60, 288),      # one day
+	("1h", 60 * 60, 168),     # one week
+	("1d", 24 * 60 * 60, 365) # one year
+)
+
+SAMPLE_INTERVAL = RESOLUTIONS[0][1]
+
+# Samples kept of every series, over all the resolutions, and where the slots of each resolution start.
+SLOTS = sum(capacity for _, _, capacity in RESOLUTIONS)
+_STARTS = tuple(sum(capacity for _, _, capacity in RESOLUTIONS[:i]) for i in range(len(RESOLUTIONS)))
+
+_unsafe = re.compile(r'[^A-Za-z0-9.\-]')
+
+# (book, series name)
+SeriesKey = Tuple[str, str]
+
+
+def _file_name(name: str) -> str:
+	return _unsafe.sub(lambda m: f'_{ord(m.group()):x}_', name)
+
+
+class SeriesBook:
+	"""
+	Time series of the same kind, like every portfolio of a guild, packed into one memory-mapped file.
+
+	The file starts with the bucket number of every slot, shared by all of its series, followed by one row of
+	float64 values per series. Every resolution is a ring of slots: a sample goes into the slot of its bucket at
+	every resolution, so coarser resolutions keep the last sample of each of their buckets, and series without a
+	sample in a bucket hold NaN there. Series names are appended to a text file next to it, one per row, so adding
+	a series never moves the others.
+	"""
+	HEADER = SLOTS * 8
+	ROW = SLOTS * 8
+
+	def __init__(self, path: Path):
+		self.path = path.with_suffix(".series")
+		self.names_path = path.with_suffix(".names")
+		self.rows: Dict[str, int] = {name: row for row, name in enumerate(self._read_names())}
+		self._mmap: mmap.mmap = None
+		self._buckets: memoryview = None
+		self._values: memoryview = None
+
+		with open(self.path, 'ab'):
+			pass
+
+		self._file = open(self.path, 'r+b')
+		self._map()
+
+	def _read_names(self) -> List[str]:
+		if not self.names_path.exists():
+			return []
+
+		text = self.names_path.read_text(encoding="utf-8")
+		complete = text[:text.rfind("\n") + 1]
+
+		# A name cut short by a crash is dropped, so the next one starts on a line of its own.
+		if(complete != text):
+			self.names_path.write_text(complete, encoding="utf-8")
+
+		return complete.split("\n")[:-1]
+
+	def _unmap(self):
+		if(self._mmap is not None):
+			self._buckets.release()
+			self._values.release()
+			self._mmap.close()
+			self._mmap = None
+
+	def _map(self):
+		"""Maps the file, sized for the current rows. Rows it didn't have yet are filled with NaN."""
+		self._unmap()
+		size = self.HEADER + len(self.rows) * self.ROW
+		old_size = os.fstat(self._file.fileno()).st_size
+
+		if(old_size != size):
+			self._file.truncate(size)
+
+		self._mmap = mmap.mmap(self._file.fileno(), size)
+		self._buckets = memoryview(self._mmap)[:self.HEADER].cast('q')
+		self._values = memoryview(self._mmap)[self.HEADER:].cast('d')
+		first_new = max(0, old_size - self.HEADER) // 8
+
+		if(first_new < len(self._values)):
+			self._values[first_new:] = array('d', [math.nan]) * (len(self._values) - first_new)
+
+	def add(self, names: List[str]):
+		with open(self.names_path, 'a', encoding="utf-8") as f:
+			f.write("".join(f"{name}\n" for name in names))
+
+		self.rows.update((name, row) for row, name in enumerate(names, start=len(self.rows)))
+		self._map()
+
+	def record(self, timestamp: float, samples: Dict[str, float]):
+		"""
+		Records a sample of the series in the book at once, adding the new ones. Series without a value in it keep
+		the samples they have in buckets that already started, and get NaN in the buckets it starts.
+		"""
+		new = [name for name in samples if name not in self.rows]
+
+		if(new):
+			self.add(new)
+
+		column = array('d', [math.nan]) * len(self.rows)
+
+		for name, value in samples.items():
+			column[self.rows[name]] = value
+
+		complete = len(samples) == len(self.rows)
+
+		for (_, step, capacity), start in zip(RESOLUTIONS, _STARTS):
+			bucket = int(timestamp // step)
+			slot = start + bucket % capacity
+
+			if(complete or self._buckets[slot] != bucket):
+				self._buckets[slot] = bucket
+				# Every row's slot at once, as one strided write.
+				self._values[slot::SLOTS] = column
+			else:
+				for name, value in samples.items():
+					self._values[self.rows[name] * SLOTS + slot] = value
+
+	def read(self, name: str, resolution: int, now: float) -> List[Tuple[float, float]]:
+		"""Returns the (timestamp, value) samples of a series kept at a resolution, oldest first."""
+		row = self.rows.get(name)
+
+		if(row is None):
+			return []
+
+		_, step, capacity = RESOLUTIONS[resolution]
+		start = _STARTS[resolution]
+		latest = int(now // step)
+		samples = []
+
+		for bucket in range(latest - capacity + 1, latest + 1):
+			slot = start + bucket % capacity
+
+			if(self._buckets[slot] == bucket):
+				value = self._values[row * SLOTS + slot]
+
+				if not math.isnan(value):
+					samples.append((bucket * step, value))
+
+		return samples
+
+	def flush(self):
+		self._mmap.flush()
+
+	def close(self):
+		self._unmap()
+		self._file.close()
+
+
+class HistoryStore:
+	"""
+	Keeps price and portfolio history on disk: the prices of every ticker in one book, the totals of every guild in
+	another, and the portfolios of each guild in a book of their own.
+
+	At most `max_open` books are kept mapped at once. Every method takes a lock, so the store can be written from an
+	executor thread while commands read it.
+	"""
+	def __init__(self, root: Path, max_open: int = 64):
+		self.root = root
+		self.max_open = max_open
+		self._open: "OrderedDict[str, SeriesBook]" = OrderedDict()
+		self._lock = threading.Lock()
+		self._closed = False
+		self.root.mkdir(parents=True, exist_ok=True)
+
+	@staticmethod
+	def ticker_key(ticker: str) -> SeriesKey:
+		return ("tickers", ticker)
+
+	@staticmethod
+	def portfolio_key(guild_id: int, member_id: int) -> SeriesKey:
+		return (f"portfolios-{guild_id}", str(member_id))
+
+	@staticmethod
+	def guild_key(guild_id: int) -> SeriesKey:
+		return ("guilds", str(guild_id))
+
+	def _book(self, name: str, create: bool = True) -> Optional[SeriesBook]:
+		book = self._open.get(name)
+
+		if(book is not None):
+			self._open.move_to_end(name)
+			return book
+
+		path = self.root / _file_name(name)
+
+		if(not create and not path.with_suffix(".series").exists()):
+			return None
+
+		book = self._open[name] = SeriesBook(path)
+
+		while(len(self._open) > self.max_open):
+			_, oldest = self._open.popitem(last=False)
+			oldest.close()
+
+		return book
+
+	def record_many(self, timestamp: float, samples: Dict[SeriesKey, float]):
+		books: Dict[str, Dict[str, float]] = {}
+
+		for (book_name, name), value in samples.items():
+			books.setdefault(book_name, {})[name] = value
+
+		with self._lock:
+			if(self._closed):
+				return
+
+			for book_name, values in books.items():
+				self._book(book_name).record(timestamp, values)
+
+	def read(self, key: SeriesKey, resolution: int, now: float) -> List[Tuple[float, float]]:
+		book_name, name = key
+
+		with self._lock:
+			if(self._closed):
+				return []
+
+			book = self._book(book_name, create=False)
+
+			if(book is None):
+				return []
+
+			return book.read(name, resolution, now)
+
+	def flush(self):
+		with self._lock:
+			for book in self._open.values():
+				book.flush()
+
+	def close(self):
+		with self._lock:
+			for book in self._open.values():
+				book.close()
+
+			self._open.clear()
+			self._closed = True
+
+
+def sparkline(values: List[float]) -> str:
+	"""Draws the values as a line of block characters, scaled between their minimum and maximum."""
+	blocks = "▁▂▃▄▅▆▇█"
+
+	if not values:
+		return ""
+
+	low, high = min(values), max(values)
+	scale = (high - low) or 1
+
+	return "".join(blocks[min(len(blocks) - 1, int((value - low) / scale * len(blocks)))] for value in values)
+
+
+def downsample(samples: List[Tuple[float, float]], points: int) -> List[Tuple[float, float]]:
+	"""Keeps at most `points` evenly spaced samples, always including the last one."""
+	if(len(samples) <= points):
+		return samples
+
+	step = len(samples) / points
+	return [samples[min(len(samples) - 1, int((i + 1) * step) - 1)] for i in range(points)]
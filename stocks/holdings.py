@@ -0,0 +1,157 @@
+import heapq
+from typing import Dict, List, Optional, Set, Tuple
+
+# (member id, total value, total shares, total investment, profit percentage)
+RankedRow = Tuple[int, int, int, int, float]
+
+
+def apply_trade(user_stocks: Dict[str, dict], ticker: str, shares: int, price: int) -> Optional[dict]:
+	"""
+	Applies a trade to a member's stocks in place, with negative shares for sells.
+
+	Returns the new position, or None if the trade closed it. The caller must make sure a member is not selling
+	more shares than they own.
+	"""
+	stock = user_stocks.setdefault(ticker, {'count': 0, 'investment': 0})
+
+	if(stock.get('investment') is None):
+		stock['investment'] = stock['count'] * price
+
+	stock['count'] += shares
+	stock['investment'] = max(0, stock['investment'] + shares * price)
+
+	if(stock['count'] <= 0):
+		del user_stocks[ticker]
+		return None
+
+	return stock
+
+
+class Ranking:
+	"""
+	The leaderboard rows of a guild for one set of prices.
+
+	Rows are kept unsorted, and only the requested top slice is selected, so showing the first few pages of a
+	large leaderboard does not require sorting every member.
+	"""
+	def __init__(self, rows: List[RankedRow]):
+		self.rows = rows
+		self._top: List[RankedRow] = []
+
+	def __len__(self) -> int:
+		return len(self.rows)
+
+	def top(self, k: int) -> List[RankedRow]:
+		"""Returns the `k` rows with the highest total value, in descending order."""
+		k = min(k, len(self.rows))
+
+		if(k > len(self._top)):
+			if(k == len(self.rows)):
+				self._top = sorted(self.rows, key=lambda a: a[1], reverse=True)
+			else:
+				self._top = heapq.nlargest(k, self.rows, key=lambda a: a[1])
+
+		return self._top[:k]
+
+
+class GuildHoldings:
+	"""
+	A materialized index of every stock position held in a guild.
+
+	It maps members to their positions and tickers to their holders, and must be kept up to date by every
+	command that changes a member's stocks. The leaderboard ranking is cached until either the holdings or the
+	prices it was computed with change.
+	"""
+	def __init__(self):
+		self.positions: Dict[int, Dict[str, dict]] = {}
+		self.holders: Dict[str, Set[int]] = {}
+		self.version = 0
+		self._ranking: Optional[Ranking] = None
+		self._ranking_key: Tuple[int, Dict[str, int]] = None
+
+	@classmethod
+	def from_members(cls, members: Dict[int, Dict[str, dict]]) -> "GuildHoldings":
+		"""Builds the index from a dict mapping member ids to their stocks."""
+		index = cls()
+
+		for member_id, user_stocks in members.items():
+			for ticker, stock in user_stocks.items():
+				index.set_position(member_id, ticker, stock['count'], stock.get('investment'))
+
+		return index
+
+	def tickers(self) -> Set[str]:
+		return set(self.holders)
+
+	def member_positions(self, member_id: int) -> Dict[str, dict]:
+		return self.positions.get(member_id, {})
+
+	def set_position(self, member_id: int, ticker: str, count: int, investment: Optional[int]):
+		"""Sets a member's position in a ticker, removing it if the count drops to zero."""
+		if(count <= 0):
+			self.remove_position(member_id, ticker)
+			return
+
+		self.positions.setdefault(member_id, {})[ticker] = {'count': count, 'investment': investment}
+		self.holders.setdefault(ticker, set()).add(member_id)
+		self.version += 1
+
+	def remove_position(self, member_id: int, ticker: str):
+		positions = self.positions.get(member_id)
+
+		if(positions is None or ticker not in positions):
+			return
+
+		del positions[ticker]
+		if not positions:
+			del self.positions[member_id]
+
+		holders = self.holders[ticker]
+		holders.discard(member_id)
+		if not holders:
+			del self.holders[ticker]
+
+		self.version += 1
+
+	def ranking(self, prices: Dict[str, int]) -> Ranking:
+		"""
+		Returns the leaderboard ranking for the given converted prices.
+
+		Tickers without a price are left out, and so are members who do not hold any priced ticker.
+		"""
+		key = (self.version, prices)
+
+		if(self._ranking is not None and self._ranking_key == key):
+			return self._ranking
+
+		rows = []
+
+		for member_id, positions in self.positions.items():
+			total_value = 0
+			total_shares = 0
+			total_investment = 0
+
+			for ticker, stock in positions.items():
+				if ticker not in prices:
+					continue
+
+				price = prices[ticker]
+				investment = stock['investment']
+
+				if(investment is None):
+					investment = stock['count'] * price
+
+				total_value += stock['count'] * price
+				total_shares += stock['count']
+				total_investment += investment
+
+			if not total_shares:
+				continue
+
+			change = ((total_value / total_investment) - 1.0) * 100.0 if total_investment else 0.0
+
+			rows.append((member_id, total_value, total_shares, total_investment, change))
+
+		self._ranking = Ranking(rows)
+		self._ranking_key = (self.version, dict(prices))
+		return self._ranking
@@ -0,0 +1,112 @@
+# Every cog in this repo is installed on its own, so each one ships an identical copy of this file.
+import contextlib
+from collections import OrderedDict
+from math import ceil
+from typing import Callable, List, Optional, Union
+
+import discord
+from prettytable import PrettyTable
+from redbot.core import commands
+from redbot.core.utils.chat_formatting import box
+from redbot.core.utils.menus import menu, close_menu
+
+PREVIOUS_PAGE = "\N{LEFTWARDS BLACK ARROW}\N{VARIATION SELECTOR-16}"
+CLOSE_MENU = "\N{CROSS MARK}"
+NEXT_PAGE = "\N{BLACK RIGHTWARDS ARROW}\N{VARIATION SELECTOR-16}"
+
+
+class LazyPages:
+	"""
+	Table pages for a reaction menu that are only rendered when they are first viewed.
+
+	`get_rows(start, stop)` must return the table rows for that slice of the row source. Every page is rendered
+	with the same table, which is cleared in between, and the last few rendered pages are kept around.
+	"""
+	def __init__(
+		self,
+		table: PrettyTable,
+		row_count: int,
+		get_rows: Callable[[int, int], List[list]],
+		embed: Optional[discord.Embed] = None,
+		per_page: int = 10,
+		cache_size: int = 8
+	):
+		self.table = table
+		self.row_count = row_count
+		self.get_rows = get_rows
+		self.embed = embed
+		self.per_page = per_page
+		self.cache_size = cache_size
+		self._rendered: "OrderedDict[int, Union[str, discord.Embed]]" = OrderedDict()
+
+	def __len__(self) -> int:
+		return ceil(self.row_count / self.per_page)
+
+	def __getitem__(self, index: int) -> Union[str, discord.Embed]:
+		if(index < 0):
+			index += len(self)
+
+		if not 0 <= index < len(self):
+			raise IndexError("page index out of range")
+
+		page = self._rendered.get(index)
+
+		if(page is None):
+			page = self.render(index)
+			self._rendered[index] = page
+
+			while(len(self._rendered) > self.cache_size):
+				self._rendered.popitem(last=False)
+		else:
+			self._rendered.move_to_end(index)
+
+		return page
+
+	def render(self, index: int) -> Union[str, discord.Embed]:
+		start = index * self.per_page
+		self.table.clear_rows()
+
+		for row in self.get_rows(start, min(start + self.per_page, self.row_count)):
+			self.table.add_row(row)
+
+		msg = box(self.table.get_string(), lang="md")
+
+		if(self.embed is None):
+			return msg
+
+		embed = self.embed.copy()
+		embed.description = msg
+		embed.set_footer(text=f"Page {index+1}/{len(self)}")
+		return embed
+
+	async def menu(self, ctx: commands.Context, timeout: float = 30.0):
+		"""
+		Shows the pages in a reaction menu.
+
+		Red's menu is only ever given the page being shown, so pages are rendered one at a time as users turn them.
+		"""
+		current = 0
+
+		async def turn(ctx, message, timeout, emoji, step):
+			nonlocal current
+			current = (current + step) % len(self)
+
+			perms = message.channel.permissions_for(ctx.me)
+			if(perms.manage_messages):
+				with contextlib.suppress(discord.NotFound):
+					await message.remove_reaction(emoji, ctx.author)
+
+			return await menu(ctx, [self[current]], controls, message=message, timeout=timeout)
+
+		async def previous_page(ctx, pages, controls, message, page, timeout, emoji):
+			return await turn(ctx, message, timeout, emoji, -1)
+
+		async def next_page(ctx, pages, controls, message, page, timeout, emoji):
+			return await turn(ctx, message, timeout, emoji, 1)
+
+		if(len(self) > 1):
+			controls = {PREVIOUS_PAGE: previous_page, CLOSE_MENU: close_menu, NEXT_PAGE: next_page}
+		else:
+			controls = {CLOSE_MENU: close_menu}
+
+		return await menu(ctx, [self[0]], controls, timeout=timeout)
@@ -0,0 +1,160 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import aiohttp
+
+
+class RateLimitedError(ValueError):
+	"""Raised when the upstream explicitly tells us we are being rate limited."""
+
+
+class QuoteProvider:
+	"""
+	Base class for the upstreams the Stocks cog gets its quotes from.
+
+	Providers return raw USD quotes as a dict mapping symbols to their `realPrice` and `change`, leaving out any
+	symbol without data. They also declare the limits the fetch layer has to plan its requests around.
+	"""
+	name: str = None
+
+	#: The most symbols a single request may contain.
+	max_batch_size: int = 50
+	#: The most requests that may be in flight at once.
+	max_concurrency: int = 4
+	#: The most requests that may be started per second, or zero for no limit.
+	requests_per_second: float = 0
+
+	async def fetch(self, session: aiohttp.ClientSession, symbols: List[str]) -> Dict[str, dict]:
+		raise NotImplementedError
+
+	def describe(self) -> str:
+		return self.name
+
+	@staticmethod
+	def parse_quote_response(data: dict) -> Dict[str, dict]:
+		"""Parses the body of a Yahoo `v7/finance/quote` response. Raises ValueError if it isn't one."""
+		try:
+			return {
+				x["symbol"]: {
+					"realPrice" : x['regularMarketPrice'],
+					"change" : x["regularMarketChangePercent"]
+				}
+
+				for x in data["quoteResponse"]["result"] if "regularMarketPrice" in x and x["regularMarketPrice"] is not None
+			}
+		except (KeyError, TypeError) as e:
+			raise ValueError('Could not get stock data. The stock API sent an unexpected response.') from e
+
+
+class YahooProvider(QuoteProvider):
+	"""Gets quotes from the Yahoo Finance quote API."""
+	name = "yahoo"
+	max_batch_size = 50
+	max_concurrency = 4
+	requests_per_second = 5
+
+	base_url = 'https://query1.finance.yahoo.com'
+
+	async def fetch(self, session: aiohttp.ClientSession, symbols: List[str]) -> Dict[str, dict]:
+		api_url = self.base_url + '/v7/finance/quote?lang=en-US&region=US&corsDomain=finance.yahoo.com'
+		api_url += "&symbols=" + ','.join(symbols)
+		api_url += "&fields=symbol,regularMarketPrice,regularMarketChangePercent"
+
+		async with session.get(api_url) as r:
+			if(r.status == 429):
+				raise RateLimitedError('Could not get stock data, we are being rate-limited.')
+			if not (200 <= r.status < 300):
+				raise ValueError(f'Could not get stock data. The stock API answered with HTTP {r.status}.')
+			try:
+				r = await r.json()
+			except aiohttp.client_exceptions.ContentTypeError:
+				#This might happen when being rate limited, but IDK for sure...
+				raise ValueError('Could not get stock data. Are we being rate-limited?')
+
+		return self.parse_quote_response(r)
+
+
+class LocalHTTPProvider(YahooProvider):
+	"""
+	Gets quotes from a local server that speaks the Yahoo quote API, such as the one in `stocks.standin`.
+
+	It has no rate limit of its own, so benchmarks are only bound by what the server is configured to allow.
+	"""
+	name = "local"
+	max_batch_size = 200
+	max_concurrency = 8
+	requests_per_second = 0
+
+	def __init__(self, url: str = None):
+		self.base_url = (url or 'http://127.0.0.1:8765').rstrip('/')
+
+	def describe(self) -> str:
+		return f'{self.name} ({self.base_url})'
+
+
+class FixtureProvider(QuoteProvider):
+	"""
+	Gets quotes from a JSON file, without any network access.
+
+	The file may either be a recorded Yahoo quote response, or a dict mapping symbols to a dict with their
+	`regularMarketPrice` and `regularMarketChangePercent`. It is read again whenever it changes on disk.
+	"""
+	name = "fixture"
+	max_batch_size = 10000
+	max_concurrency = 1
+	requests_per_second = 0
+
+	def __init__(self, path: str):
+		self.path = path
+		self._quotes: Optional[Dict[str, dict]] = None
+		self._mtime: float = None
+
+	def describe(self) -> str:
+		return f'{self.name} ({self.path})'
+
+	def load(self) -> Dict[str, dict]:
+		mtime = os.stat(self.path).st_mtime
+
+		if(self._quotes is None or mtime != self._mtime):
+			with open(self.path, encoding="utf-8") as f:
+				data = json.load(f)
+
+			if "quoteResponse" not in data:
+				data = {"quoteResponse": {"result": [dict(quote, symbol=symbol) for symbol, quote in data.items()]}}
+
+			self._quotes = self.parse_quote_response(data)
+			self._mtime = mtime
+
+		return self._quotes
+
+	async def fetch(self, session: aiohttp.ClientSession, symbols: List[str]) -> Dict[str, dict]:
+		try:
+			quotes = self.load()
+		except (OSError, ValueError, KeyError) as e:
+			raise ValueError(f'Could not read the stock data fixture: {e}')
+
+		return {symbol: quotes[symbol] for symbol in symbols if symbol in quotes}
+
+
+PROVIDERS = {
+	YahooProvider.name: YahooProvider,
+	LocalHTTPProvider.name: LocalHTTPProvider,
+	FixtureProvider.name: FixtureProvider,
+}
+
+
+def get_provider(name: str, argument: str = None) -> QuoteProvider:
+	"""Creates a provider by name. The argument is the server URL for `local`, and the file path for `fixture`."""
+	if(name == YahooProvider.name):
+		return YahooProvider()
+
+	if(name == LocalHTTPProvider.name):
+		return LocalHTTPProvider(argument)
+
+	if(name == FixtureProvider.name):
+		if not argument:
+			raise ValueError('The fixture provider needs the path to a JSON file.')
+		return FixtureProvider(argument)
+
+	raise ValueError(f'Unknown provider "{name}". Available providers: {", ".join(PROVIDERS)}.')
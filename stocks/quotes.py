@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+log = logging.getLogger("red.gradient-cogs.stocks")
+
+class QuoteCache:
+	"""
+	An in-process LRU cache of raw USD quotes, keyed by ticker symbol.
+
+	Quotes are stored exactly as the upstream reports them, so a single entry can be shared between every guild.
+	The per-guild conversion rate must be applied by the caller after lookup.
+	"""
+	def __init__(self, ttl: float = 60.0, max_size: int = 1024):
+		self.ttl = ttl
+		self.max_size = max_size
+		self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def __contains__(self, symbol: str) -> bool:
+		return self.get(symbol) is not None
+
+	def get(self, symbol: str) -> Optional[dict]:
+		"""Returns the cached quote for a symbol, or None if it is missing or older than the TTL."""
+		entry = self._entries.get(symbol)
+
+		if(entry is None):
+			return None
+
+		fetched_at, quote = entry
+
+		if(time.time() - fetched_at > self.ttl):
+			return None
+
+		self._entries.move_to_end(symbol)
+		return quote
+
+	def get_stale(self, symbol: str) -> Optional[Tuple[dict, float]]:
+		"""Returns the last known quote for a symbol and when it was fetched, no matter how old it is."""
+		entry = self._entries.get(symbol)
+
+		if(entry is None):
+			return None
+
+		return entry[1], entry[0]
+
+	def get_many(self, symbols: Iterable[str]) -> Tuple[Dict[str, dict], List[str]]:
+		"""Returns a tuple of the fresh quotes found for the given symbols and the symbols that need fetching."""
+		hits = {}
+		misses = []
+
+		for symbol in symbols:
+			quote = self.get(symbol)
+
+			if(quote is None):
+				misses.append(symbol)
+			else:
+				hits[symbol] = quote
+
+		return hits, misses
+
+	def put(self, symbol: str, quote: dict, fetched_at: float = None):
+		"""Stores a raw quote, evicting the least recently used entries if the cache is full."""
+		if(fetched_at is None):
+			fetched_at = time.time()
+
+		self._entries[symbol] = (fetched_at, quote)
+		self._entries.move_to_end(symbol)
+
+		while(len(self._entries) > self.max_size):
+			self._entries.popitem(last=False)
+
+	def put_many(self, quotes: Dict[str, dict], fetched_at: float = None):
+		if(fetched_at is None):
+			fetched_at = time.time()
+
+		for symbol, quote in quotes.items():
+			self.put(symbol, quote, fetched_at)
+
+	def configure(self, ttl: float = None, max_size: int = None):
+		"""Changes the TTL and/or the maximum size of the cache, trimming it if needed."""
+		if(ttl is not None):
+			self.ttl = ttl
+
+		if(max_size is not None):
+			self.max_size = max_size
+
+			while(len(self._entries) > self.max_size):
+				self._entries.popitem(last=False)
+
+	def clear(self):
+		self._entries.clear()
+
+
+class CircuitOpenError(ValueError):
+	"""Raised instead of contacting an upstream that has been failing."""
+
+
+class CircuitBreaker:
+	"""
+	Stops requests to a failing upstream for a while.
+
+	The circuit opens after `failure_threshold` consecutive failures, or right away when we are rate limited.
+	While it is open every request is refused. Once the open period ends, a single probe request is let through
+	(half-open): if it succeeds the circuit closes, otherwise it opens again for twice as long, up to `max_delay`.
+	"""
+	CLOSED = "closed"
+	OPEN = "open"
+	HALF_OPEN = "half-open"
+
+	def __init__(self, failure_threshold: int = 3, base_delay: float = 5.0, max_delay: float = 300.0):
+		self.failure_threshold = failure_threshold
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.state = self.CLOSED
+		self.failures = 0
+		self.trips = 0
+		self.opened_until = 0.0
+
+	@property
+	def closed(self) -> bool:
+		return self.state == self.CLOSED
+
+	def ready(self) -> bool:
+		"""Returns whether a request would be let through right now."""
+		return self.state == self.CLOSED or (self.state == self.OPEN and time.time() >= self.opened_until)
+
+	def retry_after(self) -> float:
+		return max(0.0, self.opened_until - time.time())
+
+	def allow_request(self) -> bool:
+		if(self.state == self.CLOSED):
+			return True
+
+		if(self.state == self.OPEN and time.time() >= self.opened_until):
+			self.state = self.HALF_OPEN
+			return True
+
+		return False
+
+	def record_success(self):
+		self.state = self.CLOSED
+		self.failures = 0
+		self.trips = 0
+
+	def record_failure(self, rate_limited: bool = False):
+		self.failures += 1
+
+		if(rate_limited or self.state == self.HALF_OPEN or self.failures >= self.failure_threshold):
+			delay = min(self.max_delay, self.base_delay * 2 ** self.trips)
+			self.trips += 1
+			self.state = self.OPEN
+			self.opened_until = time.time() + delay
+			log.warning("Quote circuit breaker opened for %.0f seconds after %d failures.", delay, self.failures)
+
+	def record_cancelled(self):
+		"""Lets another probe through right away if the probe was cancelled, rather than staying half-open for good."""
+		if(self.state == self.HALF_OPEN):
+			self.state = self.OPEN
+			self.opened_until = time.time()
+
+
+class RequestPacer:
+	"""Spaces out the start of upstream requests so no more than `rate` are started per second."""
+	def __init__(self, rate: float = 0):
+		self.rate = rate
+		self._next_slot = 0.0
+
+	async def wait(self):
+		if not self.rate:
+			return
+
+		loop = asyncio.get_event_loop()
+		now = loop.time()
+		slot = max(now, self._next_slot)
+		self._next_slot = slot + 1 / self.rate
+
+		if(slot > now):
+			await asyncio.sleep(slot - now)
+
+
+class QuoteBatcher:
+	"""
+	Coalesces concurrent quote lookups into as few upstream requests as possible.
+
+	Symbols that are already being fetched are awaited instead of being requested again, and symbols requested
+	within `window` seconds of each other are merged into a single batch. Every caller only gets back the
+	symbols it asked for.
+
+	Batches are split into chunks of at most `chunk_size` symbols, which are fetched in parallel with at most
+	`max_concurrency` requests in flight. A failed chunk only fails the symbols it contained.
+	"""
+	def __init__(
+		self,
+		fetch: Callable[[List[str]], Awaitable[Dict[str, dict]]],
+		window: float = 0.05,
+		chunk_size: int = 50,
+		max_concurrency: int = 4
+	):
+		self.fetch = fetch
+		self.window = window
+		self.chunk_size = chunk_size
+		self.max_concurrency = max_concurrency
+		self._pending: Dict[str, asyncio.Future] = {}
+		self._inflight: Dict[str, asyncio.Future] = {}
+		self._flush_handle: asyncio.TimerHandle = None
+		self._semaphore: asyncio.Semaphore = None
+
+	async def get(self, symbols: Iterable[str]) -> Dict[str, dict]:
+		"""
+		Returns a dict mapping the given symbols to their raw quotes. Symbols without data are left out.
+
+		If the upstream request failed for every symbol, the first exception is raised.
+		"""
+		quotes, errors = await self.get_with_errors(symbols)
+
+		if(errors and not quotes):
+			raise next(iter(errors.values()))
+
+		return quotes
+
+	async def get_with_errors(self, symbols: Iterable[str]) -> Tuple[Dict[str, dict], Dict[str, BaseException]]:
+		"""
+		Returns a tuple of the raw quotes found for the given symbols, and the exception for each symbol whose
+		chunk could not be fetched.
+		"""
+		loop = asyncio.get_event_loop()
+		futures = {}
+
+		for symbol in symbols:
+			future = self._inflight.get(symbol) or self._pending.get(symbol)
+
+			if(future is None):
+				future = loop.create_future()
+				self._pending[symbol] = future
+
+			futures[symbol] = future
+
+		if(self._pending and self._flush_handle is None):
+			self._flush_handle = loop.call_later(max(0, self.window), self._flush)
+
+		# Shield the shared futures so a cancelled caller does not cancel them for everyone else.
+		results = await asyncio.gather(*(asyncio.shield(f) for f in futures.values()), return_exceptions=True)
+
+		quotes = {}
+		errors = {}
+
+		for symbol, result in zip(futures, results):
+			if(isinstance(result, BaseException)):
+				errors[symbol] = result
+			elif(result is not None):
+				quotes[symbol] = result
+
+		return quotes, errors
+
+	def configure(self, chunk_size: int = None, max_concurrency: int = None):
+		if(chunk_size is not None):
+			self.chunk_size = chunk_size
+
+		if(max_concurrency is not None and max_concurrency != self.max_concurrency):
+			self.max_concurrency = max_concurrency
+			# Chunks that are already waiting keep the old semaphore, new ones get the new limit.
+			self._semaphore = None
+
+	def close(self):
+		"""Cancels the scheduled flush and fails every lookup that has not been sent yet."""
+		if(self._flush_handle is not None):
+			self._flush_handle.cancel()
+			self._flush_handle = None
+
+		for future in self._pending.values():
+			if not future.done():
+				future.cancel()
+
+		self._pending.clear()
+
+	def _flush(self):
+		self._flush_handle = None
+		batch, self._pending = self._pending, {}
+
+		if not batch:
+			return
+
+		self._inflight.update(batch)
+		symbols = list(batch)
+
+		for i in range(0, len(symbols), self.chunk_size):
+			chunk = {symbol: batch[symbol] for symbol in symbols[i:i + self.chunk_size]}
+			asyncio.ensure_future(self._run(chunk))
+
+	async def _run(self, chunk: Dict[str, asyncio.Future]):
+		if(self._semaphore is None):
+			self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+		try:
+			async with self._semaphore:
+				quotes = await self.fetch(list(chunk))
+		except Exception as e:
+			log.warning("Could not fetch quotes for %d symbols (%s): %r", len(chunk), ",".join(chunk), e)
+
+			for future in chunk.values():
+				if not future.done():
+					future.set_exception(e)
+					# Mark it as retrieved, the callers that are still waiting will get it anyway.
+					future.exception()
+		else:
+			for symbol, future in chunk.items():
+				if not future.done():
+					future.set_result(quotes.get(symbol))
+		finally:
+			for symbol, future in chunk.items():
+				if(self._inflight.get(symbol) is future):
+					del self._inflight[symbol]
@@ -0,0 +1,135 @@
+"""
+A local stand-in for the Yahoo quote API, to load test and benchmark the Stocks cog without network access.
+
+Run it with `python -m stocks.standin --port 8765`, then point the cog at it with `[p]stocks set provider local`.
+"""
+import argparse
+import asyncio
+import json
+import math
+import time
+import zlib
+from collections import deque
+from typing import Dict, Optional
+
+from aiohttp import web
+
+
+class StandInServer:
+	"""
+	Serves `/v7/finance/quote` with the same response shape as Yahoo.
+
+	Prices are either read from a fixture file in the format accepted by `FixtureProvider`, or derived from the
+	symbol itself and slowly drift over time. An artificial latency and a rate limit can be configured; requests
+	over the limit get a non-JSON 429 response, like the real upstream. Symbols starting with `UNKNOWN` are never
+	found.
+	"""
+	def __init__(self, fixture: Dict[str, dict] = None, latency: float = 0.0, rate_limit: int = 0):
+		fixture = fixture or {}
+
+		if "quoteResponse" in fixture:
+			fixture = {quote["symbol"]: quote for quote in fixture["quoteResponse"]["result"]}
+
+		self.fixture = fixture
+		self.latency = latency
+		self.rate_limit = rate_limit
+		self.request_count = 0
+		self.symbol_count = 0
+		self.rejected_count = 0
+		self._recent = deque()
+		self._runner: Optional[web.AppRunner] = None
+
+	def make_app(self) -> web.Application:
+		app = web.Application()
+		app.router.add_get('/v7/finance/quote', self.handle_quote)
+		app.router.add_get('/stats', self.handle_stats)
+		return app
+
+	def quote(self, symbol: str) -> Optional[dict]:
+		if symbol in self.fixture:
+			return dict(self.fixture[symbol], symbol=symbol)
+
+		if(symbol.startswith('UNKNOWN')):
+			return None
+
+		base = zlib.crc32(symbol.encode()) % 1000 + 1
+		drift = math.sin(time.time() / 60 + base)
+
+		return {
+			"symbol": symbol,
+			"regularMarketPrice": round(base * (1 + drift / 100), 2),
+			"regularMarketChangePercent": drift
+		}
+
+	def is_rate_limited(self) -> bool:
+		if not self.rate_limit:
+			return False
+
+		now = time.monotonic()
+
+		while(self._recent and now - self._recent[0] > 1):
+			self._recent.popleft()
+
+		if(len(self._recent) >= self.rate_limit):
+			return True
+
+		self._recent.append(now)
+		return False
+
+	async def handle_quote(self, request: web.Request) -> web.Response:
+		self.request_count += 1
+
+		if(self.is_rate_limited()):
+			self.rejected_count += 1
+			return web.Response(status=429, text='Too Many Requests', content_type='text/html')
+
+		if(self.latency):
+			await asyncio.sleep(self.latency)
+
+		symbols = [s for s in request.query.get('symbols', '').split(',') if s]
+		self.symbol_count += len(symbols)
+		result = [quote for quote in map(self.quote, symbols) if quote is not None]
+
+		return web.json_response({"quoteResponse": {"result": result, "error": None}})
+
+	async def handle_stats(self, request: web.Request) -> web.Response:
+		return web.json_response(self.stats())
+
+	def stats(self) -> dict:
+		return {
+			"requests": self.request_count,
+			"symbols": self.symbol_count,
+			"rejected": self.rejected_count
+		}
+
+	async def start(self, host: str = '127.0.0.1', port: int = 8765):
+		self._runner = web.AppRunner(self.make_app())
+		await self._runner.setup()
+		await web.TCPSite(self._runner, host, port).start()
+
+	async def stop(self):
+		if(self._runner is not None):
+			await self._runner.cleanup()
+			self._runner = None
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=8765)
+	parser.add_argument('--fixture', help='JSON file mapping symbols to their quotes')
+	parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before answering')
+	parser.add_argument('--rate-limit', type=int, default=0, help='requests allowed per second, 0 for no limit')
+	args = parser.parse_args()
+
+	fixture = None
+	if(args.fixture):
+		with open(args.fixture, encoding="utf-8") as f:
+			fixture = json.load(f)
+
+	server = StandInServer(fixture=fixture, latency=args.latency, rate_limit=args.rate_limit)
+	web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+	main()
@@ -22,26 +22,212 @@
 
 # Forked from https://github.com/Flame442/FlameCogs
 
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from weakref import WeakValueDictionary
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
 import discord
 from redbot.core import bank
 from redbot.core import commands
 from redbot.core import Config
+from redbot.core.data_manager import cog_data_path
 from redbot.core.utils.chat_formatting import pagify, box
-from redbot.core.utils.menus import menu, DEFAULT_CONTROLS, close_menu
 from redbot.core.bot import Red
+from discord.ext import tasks
 from prettytable import PrettyTable
 from math import ceil
-import aiohttp, prettytable
+from .aggregate import PackedPositions, pack, rank
+from .export import CHUNK_SIZE, FIELDS, FORMATS, TRADE_FIELDS, HoldingsWriter
+from .history import RESOLUTIONS, SAMPLE_INTERVAL, HistoryStore, SeriesKey, downsample, sparkline
+from .holdings import GuildHoldings, apply_trade
+from .metrics import Metrics
+from .pages import LazyPages
+from .providers import PROVIDERS, QuoteProvider, RateLimitedError, YahooProvider, get_provider
+from .storage import ConfigStorage, HoldingsStorage, SQLiteStorage, Trade, WriteBehindStorage
+from .quotes import CircuitBreaker, CircuitOpenError, QuoteBatcher, QuoteCache, RequestPacer
+import aiohttp, prettytable, asyncio, logging, shutil, tempfile, time
 
+log = logging.getLogger("red.gradient-cogs.stocks")
+
+SCHEMA_VERSION = 2
 
 class Stocks(commands.Cog):
 	"""Buy and sell stocks with bot currency."""
 	def __init__(self, bot):
 		self.bot: Red = bot
 		self.config = Config.get_conf(self, identifier=8712341782873811)
+		self.config.register_global(quote_cache_ttl = 60, quote_cache_size = 1024, quote_batch_window = 50)
+		self.config.register_global(poll_enabled = False, poll_interval = 60)
+		self.config.register_global(provider = YahooProvider.name, provider_argument = None)
+		self.config.register_global(storage = ConfigStorage.name, history_enabled = False)
+		self.config.register_global(schema_version = 0, metrics_file = None)
 		self.config.register_guild(conversion = 10)
 		self.config.register_member(stocks = {})
+		self.quote_cache = QuoteCache()
+		self.quote_batcher = QuoteBatcher(self._fetch_and_cache_quotes)
+		self.request_pacer = RequestPacer()
+		self.circuit_breaker = CircuitBreaker()
+		self.revalidate_task: asyncio.Task = None
+		self.provider: QuoteProvider = None
+		self.use_provider(YahooProvider())
+		self.session: aiohttp.ClientSession = None
+		# Number of members holding each ticker, only tracked while the price poller is running.
+		self.held_tickers: Counter = None
+		# ticker -> (raw quote, when the poller fetched it)
+		self.price_table: Dict[str, Tuple[dict, float]] = {}
+		self.holdings: Dict[int, GuildHoldings] = {}
+		self.holdings_locks: Dict[int, asyncio.Lock] = {}
+		# Changes made to the holdings of guilds whose index is being loaded, to apply once it is.
+		self.holdings_loading: Dict[int, List[Tuple[int, str, Optional[dict]]]] = {}
+		self.migration_task: asyncio.Task = None
+		self.metrics: Metrics = self.create_metrics()
+		self.metrics_file: Path = None
+		self.storage: HoldingsStorage = self.make_storage(ConfigStorage.name)
+		self.history_store: HistoryStore = None
+		self.member_locks: "WeakValueDictionary[Tuple[int, int], asyncio.Lock]" = WeakValueDictionary()
+		# Set while the storage engine is being switched, so new trades wait for it.
+		self.storage_switch: asyncio.Event = None
+		self.running_trades = 0
+
+	async def initialize(self):
+		self.session = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(
+				limit=20,
+				limit_per_host=10,
+				ttl_dns_cache=300,
+				keepalive_timeout=60
+			),
+			timeout=aiohttp.ClientTimeout(total=15),
+			headers={'Accept': 'application/json'}
+		)
+		self.quote_cache.configure(
+			ttl=await self.config.quote_cache_ttl(),
+			max_size=await self.config.quote_cache_size()
+		)
+		self.quote_batcher.window = (await self.config.quote_batch_window()) / 1000
+
+		if(await self.config.storage() == SQLiteStorage.name):
+			self.storage = self.make_storage(SQLiteStorage.name)
+			await self.storage.open()
+
+		try:
+			self.use_provider(get_provider(await self.config.provider(), await self.config.provider_argument()))
+		except ValueError as e:
+			log.error("Could not set up the configured quote provider, falling back to Yahoo: %s", e)
+
+		if(await self.config.poll_enabled()):
+			await self.start_price_poller(await self.config.poll_interval())
+
+		if(await self.config.history_enabled()):
+			self.start_history_sampler()
+
+		if(await self.config.schema_version() < SCHEMA_VERSION):
+			self.migration_task = asyncio.ensure_future(self.migrate())
+
+		metrics_file = await self.config.metrics_file()
+
+		if(metrics_file):
+			self.metrics_file = Path(metrics_file)
+			self.metrics_dump.start()
+
+	def create_metrics(self) -> Metrics:
+		"""Creates the metrics of the hot paths. Recording them is a few additions, so they are always on."""
+		metrics = Metrics("stocks")
+		self.stock_data_time = metrics.histogram("get_stock_data_seconds", "Time spent getting converted stock data.")
+		self.stock_data_errors = metrics.counter("get_stock_data_errors_total", "Stock data lookups that failed.")
+		self.symbols_requested = metrics.counter("symbols_requested_total", "Symbols looked up.")
+		self.symbols_per_lookup = metrics.histogram(
+			"symbols_per_lookup", "Distinct symbols per lookup.", (1, 5, 10, 25, 50, 100, 250, 1000)
+		)
+		self.price_table_hits = metrics.counter("price_table_hits_total", "Symbols served by the price poller.")
+		self.quote_cache_hits = metrics.counter("quote_cache_hits_total", "Symbols served by the quote cache.")
+		self.quote_cache_misses = metrics.counter("quote_cache_misses_total", "Symbols missing from the quote cache.")
+		self.stale_quotes = metrics.counter("stale_quotes_served_total", "Symbols served stale because the API failed.")
+		self.upstream_requests = metrics.counter("upstream_requests_total", "Requests made to the quote API.")
+		self.upstream_errors = metrics.counter("upstream_errors_total", "Requests to the quote API that failed.")
+		self.upstream_rate_limited = metrics.counter("upstream_rate_limited_total", "Requests the quote API rate limited.")
+		self.upstream_rejected = metrics.counter("upstream_rejected_total", "Requests refused by the circuit breaker.")
+		self.upstream_time = metrics.histogram("upstream_request_seconds", "Time the quote API took to answer.")
+		self.upstream_symbols = metrics.histogram(
+			"upstream_symbols_per_request", "Symbols per request to the quote API.", (1, 5, 10, 25, 50, 100, 250, 1000)
+		)
+		self.config_read_time = metrics.histogram("config_read_seconds", "Time spent reading guild settings.")
+		self.storage_read_time = metrics.histogram("storage_read_seconds", "Time spent reading a member's stocks.")
+		self.storage_write_time = metrics.histogram("storage_write_seconds", "Time spent writing a member's stocks.")
+		metrics.gauge("quote_cache_size", "Quotes in the quote cache.", lambda: len(self.quote_cache))
+		metrics.gauge("circuit_open", "Whether the circuit breaker is open.", lambda: int(not self.circuit_breaker.closed))
+		return metrics
+
+	async def migrate(self):
+		"""
+		Brings the stored data up to the current schema version, in bulk.
+
+		Version 1 fills in the `investment` of every position stored without one, valuing it at the current price.
+		Only the members that need it are written to, and the version is only bumped if every price could be
+		fetched, so the migration is retried on the next load otherwise. It goes through the storage engine in use,
+		where positions without an investment have a None one rather than none at all.
+		Version 2 runs it again, for bots where version 1 filled in Config while their holdings were in SQLite.
+		"""
+		try:
+			all_members = await self.storage.all_members()
+			missing = set()
+
+			for members in all_members.values():
+				for user_stocks in members.values():
+					missing.update(ticker for ticker, stock in user_stocks.items() if stock.get('investment') is None)
+
+			quotes, errors = await self.quote_batcher.get_with_errors(list(missing))
+			conversions = {guild_id: data['conversion'] for guild_id, data in (await self.config.all_guilds()).items()}
+			updated = 0
+
+			for guild_id, members in all_members.items():
+				conversion = conversions.get(guild_id, 10)
+
+				for member_id, user_stocks in members.items():
+					if all(stock.get('investment') is not None or ticker in errors for ticker, stock in user_stocks.items()):
+						continue
+
+					# Re-read the member's stocks here, in case they traded since we loaded everything.
+					async with self.trade_lock(guild_id, member_id):
+						positions = {}
+
+						for ticker, stock in (await self.storage.get_stocks(guild_id, member_id)).items():
+							if(stock.get('investment') is not None or ticker in errors):
+								continue
+
+							# Stocks without any data are worth nothing, same as the list command shows them.
+							price = self.convert_price(quotes[ticker]['realPrice'], conversion) if ticker in quotes else 0
+							positions[ticker] = dict(stock, investment=stock['count'] * price)
+
+						if(positions):
+							await self.storage.set_positions(guild_id, member_id, positions, [])
+
+					self.invalidate_holdings(guild_id)
+					updated += 1
+
+			if(errors):
+				log.warning("Stocks schema migration could not price %d stocks, it will be retried on the next load.", len(errors))
+				return
+
+			await self.config.schema_version.set(SCHEMA_VERSION)
+			log.info("Stocks schema migrated to version %d, %d members updated.", SCHEMA_VERSION, updated)
+		except Exception as e:
+			log.exception(e)
+
+	def cog_unload(self):
+		self.stop_history_sampler()
+		if(self.migration_task is not None):
+			self.migration_task.cancel()
+		if(self.revalidate_task is not None):
+			self.revalidate_task.cancel()
+		self.price_poller.cancel()
+		self.metrics_dump.cancel()
+		self.quote_batcher.close()
+		if(self.session is not None):
+			self.bot.loop.create_task(self.session.close())
+		self.bot.loop.create_task(self.storage.close())
 
 	@commands.guild_only()
 	@commands.group(aliases=['stock', 'stonks', 'stonk'])
@@ -66,6 +252,192 @@ class Stocks(commands.Cog):
 		await self.config.guild(ctx.guild).conversion.set(rate)
 		await ctx.tick()
 
+	@commands.is_owner()
+	@set.command(name="cache")
+	async def set_cache(self, ctx: commands.Context, ttl: int, size: int = None):
+		"""
+		Sets how many seconds quotes are cached for, and optionally how many symbols the cache holds.
+
+		The cache is shared between every server. Set the TTL to zero to disable it.
+		"""
+		if(ttl < 0 or (size is not None and size < 1)):
+			await ctx.react_quietly(reaction="❌")
+			await ctx.send_help()
+			return
+
+		await self.config.quote_cache_ttl.set(ttl)
+		if(size is not None):
+			await self.config.quote_cache_size.set(size)
+
+		self.quote_cache.configure(ttl=ttl, max_size=size)
+		await ctx.tick()
+
+	@commands.is_owner()
+	@set.command(name="batchwindow")
+	async def set_batch_window(self, ctx: commands.Context, milliseconds: int):
+		"""
+		Sets how many milliseconds quote lookups wait for others to be merged into the same request.
+
+		Set it to zero to send every lookup right away. Identical concurrent lookups are always merged.
+		"""
+		if(milliseconds < 0):
+			await ctx.react_quietly(reaction="❌")
+			await ctx.send_help()
+			return
+
+		await self.config.quote_batch_window.set(milliseconds)
+		self.quote_batcher.window = milliseconds / 1000
+		await ctx.tick()
+
+	@commands.is_owner()
+	@set.command(name="provider")
+	async def set_provider(self, ctx: commands.Context, name: str = None, argument: str = None):
+		"""
+		Sets where stock quotes are fetched from.
+
+		Available providers:
+		- `yahoo`: the Yahoo Finance API (default).
+		- `local`: a local server that speaks the Yahoo API. The argument is its URL, `http://127.0.0.1:8765` by default.
+		- `fixture`: a JSON file mapping symbols to quotes, without any network access. The argument is its path.
+
+		Leave the name empty to see the current provider.
+		"""
+		if(name is None):
+			await ctx.send(f'Current provider: {self.provider.describe()}. Available providers: {", ".join(PROVIDERS)}.')
+			return
+
+		try:
+			provider = get_provider(name.lower(), argument)
+		except ValueError as e:
+			await ctx.send(e)
+			return
+
+		await self.config.provider.set(provider.name)
+		await self.config.provider_argument.set(argument)
+		self.use_provider(provider)
+		self.quote_cache.clear()
+		self.price_table.clear()
+		await ctx.tick()
+
+	@commands.is_owner()
+	@set.command(name="storage")
+	async def set_storage(self, ctx: commands.Context, name: str):
+		"""
+		Sets where member holdings are stored, copying every holding over.
+
+		Available storage engines:
+		- `config`: Red's own config (default).
+		- `sqlite`: a local SQLite database, which also keeps a history of every trade.
+		"""
+		name = name.lower()
+
+		if(name not in (ConfigStorage.name, SQLiteStorage.name)):
+			await ctx.send(f'Unknown storage "{name}". Available storage engines: {ConfigStorage.name}, {SQLiteStorage.name}.')
+			return
+
+		if(name == self.storage.name):
+			await ctx.send(f'Holdings are already stored in {name}.')
+			return
+
+		if(self.storage_switch is not None):
+			await ctx.send('The storage engine is already being switched.')
+			return
+
+		async with ctx.typing():
+			# Hold off new trades and wait for the running ones, so none of them land in the old engine after the copy.
+			self.storage_switch = asyncio.Event()
+
+			try:
+				while(self.running_trades):
+					await asyncio.sleep(0.05)
+
+				storage = self.make_storage(name)
+				await storage.open()
+				await storage.replace_all(await self.storage.all_members())
+				await self.config.storage.set(name)
+
+				old_storage, self.storage = self.storage, storage
+				await old_storage.close()
+				self.invalidate_holdings()
+			finally:
+				switch, self.storage_switch = self.storage_switch, None
+				switch.set()
+
+		await ctx.tick()
+
+	@commands.is_owner()
+	@set.command(name="history")
+	async def set_history(self, ctx: commands.Context, enabled: bool):
+		"""
+		Enables or disables recording the price and portfolio history of every held stock.
+
+		Prices and portfolio values are sampled every five minutes, and kept for up to a year at lower resolutions.
+		"""
+		await self.config.history_enabled.set(enabled)
+
+		if(enabled):
+			self.start_history_sampler()
+		else:
+			self.stop_history_sampler()
+
+		await ctx.tick()
+
+	@commands.is_owner()
+	@set.command(name="poller")
+	async def set_poller(self, ctx: commands.Context, enabled: bool, interval: int = None):
+		"""
+		Enables or disables refreshing the prices of every held stock in the background.
+
+		While enabled, commands read prices from memory instead of waiting for the upstream.
+		The interval is in seconds, and must be at least 10.
+		"""
+		if(interval is not None and interval < 10):
+			await ctx.react_quietly(reaction="❌")
+			await ctx.send_help()
+			return
+
+		await self.config.poll_enabled.set(enabled)
+		if(interval is not None):
+			await self.config.poll_interval.set(interval)
+
+		if(enabled):
+			await self.start_price_poller(await self.config.poll_interval())
+		else:
+			self.stop_price_poller()
+
+		await ctx.tick()
+
+	@commands.is_owner()
+	@set.command(name="metricsfile")
+	async def set_metrics_file(self, ctx: commands.Context, path: str = None):
+		"""
+		Sets a file to write the metrics to every minute, in the Prometheus text format.
+
+		Point a node exporter's textfile collector at it to scrape them. Leave the path out to stop writing it.
+		"""
+		if(path is not None):
+			path = Path(path).expanduser().resolve()
+
+			if not path.parent.is_dir():
+				await ctx.send(f'The folder `{path.parent}` does not exist.')
+				return
+
+		await self.config.metrics_file.set(str(path) if path is not None else None)
+		self.metrics_file = path
+
+		if(path is not None and not self.metrics_dump.is_running()):
+			self.metrics_dump.start()
+		elif(path is None):
+			self.metrics_dump.cancel()
+
+		await ctx.tick()
+
+	@commands.is_owner()
+	@stocks.command(name="metrics")
+	async def show_metrics(self, ctx: commands.Context):
+		"""Shows how the quote lookups and the storage performed since the cog was loaded."""
+		for page in pagify(self.metrics.render()):
+			await ctx.send(box(page))
 
 	@stocks.command("conversion")
 	async def get_conversion(self, ctx: commands.Context):
@@ -96,29 +468,26 @@ class Stocks(commands.Cog):
 			return
 		price = stock_data[name]['price']
 		total = shares * price
-		try:
-			bal = await bank.withdraw_credits(ctx.author, total)
-		except ValueError:
-			bal = await bank.get_balance(ctx.author)
-			await ctx.send(
-				f'You cannot afford {shares} share{plural} of {name}. '
-				f'It would cost {total} {currency} ({price} {currency} each). '
-				f'You only have {bal} {currency}.'
-			)
-			return
-		async with self.config.member(ctx.author).stocks() as user_stocks:
-			if name in user_stocks:
-				user_stocks[name]['count'] += shares
-
-				if('investment' not in user_stocks[name]):
-					user_stocks[name]['investment'] = (user_stocks[name]['count'] - shares) * price
-
-				user_stocks[name]['investment'] += total
-			else:
-				user_stocks[name] = {'count': shares, 'investment': total}
+		async with self.trade_lock(ctx.guild.id, ctx.author.id):
+			try:
+				bal = await bank.withdraw_credits(ctx.author, total)
+			except ValueError:
+				bal = await bank.get_balance(ctx.author)
+				await ctx.send(
+					f'You cannot afford {shares} share{plural} of {name}. '
+					f'It would cost {total} {currency} ({price} {currency} each). '
+					f'You only have {bal} {currency}.'
+				)
+				return
+			user_stocks = await self.storage.get_stocks(ctx.guild.id, ctx.author.id)
+			if name not in user_stocks:
+				self.track_ticker(name, 1)
+			stock = apply_trade(user_stocks, name, shares, price)
+			await self.storage.set_position(ctx.guild.id, ctx.author.id, name, stock, Trade(name, shares, price))
+			self.update_holdings(ctx.guild, ctx.author.id, name, stock)
 		await ctx.send(
 			f'You purchased {shares} share{plural} of {name} for {total} {currency} '
-			f'({price} {currency} each).\nYou now have {bal} {currency}.'
+			f'({price} {currency} each).\nYou now have {bal} {currency}.{self.stale_note(stock_data)}'
 		)
 
 	@stocks.command()
@@ -142,7 +511,8 @@ class Stocks(commands.Cog):
 			return
 		price = stock_data[name]['price']
 		total = shares * price
-		async with self.config.member(ctx.author).stocks() as user_stocks:
+		async with self.trade_lock(ctx.guild.id, ctx.author.id):
+			user_stocks = await self.storage.get_stocks(ctx.guild.id, ctx.author.id)
 			if name not in user_stocks:
 				await ctx.send(f'You do not have any shares of {name}.')
 				return
@@ -152,31 +522,127 @@ class Stocks(commands.Cog):
 					f'You only have {user_stocks[name]["count"]} share{plural}.'
 				)
 				return
-			user_stocks[name]['count'] -= shares
-
-			if('investment' not in user_stocks[name]):
-				user_stocks[name]['investment'] = (user_stocks[name]['count'] + shares) * price
-
-			investment = user_stocks[name]['investment']
-			user_stocks[name]['investment'] = max(0, investment - total)
+			stock = apply_trade(user_stocks, name, -shares, price)
+			if stock is None:
+				self.track_ticker(name, -1)
+			await self.storage.set_position(ctx.guild.id, ctx.author.id, name, stock, Trade(name, -shares, price))
+			self.update_holdings(ctx.guild, ctx.author.id, name, stock)
+			bal = await bank.deposit_credits(ctx.author, total)
 
-			if user_stocks[name]['count'] == 0:
-				del user_stocks[name]
-
-		bal = await bank.deposit_credits(ctx.author, total)
 		currency = await bank.get_currency_name(ctx.guild)
 		await ctx.send(
 			f'You sold {shares} share{plural} of {name} for {total} {currency} '
-			f'({price} {currency} each).\nYou now have {bal} {currency}.'
+			f'({price} {currency} each).\nYou now have {bal} {currency}.{self.stale_note(stock_data)}'
 		)
 
+	@stocks.command()
+	async def order(self, ctx: commands.Context, *orders: str):
+		"""
+		Buy and sell several stocks at once.
+
+		Every order is an action, a ticker symbol and a number of shares, e.g. `BUY AAPL 5 SELL TSLA 2`.
+		Either every order goes through or none of them do. Money from the sales goes towards the purchases.
+		"""
+		if(not orders or len(orders) % 3 != 0):
+			await ctx.send_help()
+			return
+
+		legs = []
+
+		for i in range(0, len(orders), 3):
+			action, name, shares = orders[i].upper(), orders[i+1].upper(), orders[i+2]
+
+			if(action not in ('BUY', 'SELL')):
+				await ctx.send(f'"{orders[i]}" is not a valid action, it must be either BUY or SELL.')
+				return
+
+			try:
+				shares = int(shares)
+			except ValueError:
+				await ctx.send(f'"{orders[i+2]}" is not a valid number of shares.')
+				return
+
+			if shares < 1:
+				await ctx.send(f'You cannot {action.lower()} less than one share.')
+				return
+
+			legs.append((action, name, shares))
+
+		try:
+			stock_data = await self.get_stock_data(ctx, [name for _, name, _ in legs])
+		except ValueError as e:
+			return await ctx.send(e)
+
+		missing = [name for _, name, _ in legs if name not in stock_data]
+		if missing:
+			await ctx.send(f'I couldn\'t find any data for {", ".join(dict.fromkeys(missing))}. Please try other stocks.')
+			return
+
+		currency = await bank.get_currency_name(ctx.guild)
+
+		async with self.trade_lock(ctx.guild.id, ctx.author.id):
+			user_stocks = await self.storage.get_stocks(ctx.guild.id, ctx.author.id)
+			held_before = set(user_stocks)
+			trades = []
+			cost = 0
+
+			# Run every order against a copy of the holdings first, so nothing is changed if any of them fail.
+			for action, name, shares in legs:
+				price = stock_data[name]['price']
+				owned = user_stocks.get(name, {}).get('count', 0)
+
+				if(action == 'SELL' and shares > owned):
+					plural = 's' if owned != 1 else ''
+					await ctx.send(
+						f'You do not have enough shares of {name} to sell {shares}. '
+						f'You would only have {owned} share{plural} by then.'
+					)
+					return
+
+				signed = shares if action == 'BUY' else -shares
+				apply_trade(user_stocks, name, signed, price)
+				trades.append(Trade(name, signed, price))
+				cost += signed * price
+
+			try:
+				if cost > 0:
+					bal = await bank.withdraw_credits(ctx.author, cost)
+				else:
+					bal = await bank.deposit_credits(ctx.author, -cost)
+			except ValueError:
+				bal = await bank.get_balance(ctx.author)
+				await ctx.send(
+					f'You cannot afford these orders. They would cost {cost} {currency} in total. '
+					f'You only have {bal} {currency}.'
+				)
+				return
+
+			positions = {trade.ticker: user_stocks.get(trade.ticker) for trade in trades}
+			await self.storage.set_positions(ctx.guild.id, ctx.author.id, positions, trades)
+
+			for name, stock in positions.items():
+				if(name not in held_before and stock is not None):
+					self.track_ticker(name, 1)
+				elif(name in held_before and stock is None):
+					self.track_ticker(name, -1)
+				self.update_holdings(ctx.guild, ctx.author.id, name, stock)
+
+		lines = [
+			f'{"Bought" if trade.shares > 0 else "Sold"} {abs(trade.shares)} {trade.ticker} '
+			f'for {abs(trade.shares) * trade.price} {currency} ({trade.price} {currency} each).'
+			for trade in trades
+		]
+		total = f'You paid {cost} {currency} in total.' if cost > 0 else f'You received {-cost} {currency} in total.'
+		for page in pagify('\n'.join(lines) + f'\n{total}\nYou now have {bal} {currency}.{self.stale_note(stock_data)}'):
+			await ctx.send(page)
+
 	@stocks.command()
 	async def list(self, ctx: commands.Context, user: discord.Member = None):
 		"""List someone's stocks."""
 		if(user == None):
 			user = ctx.author
 
-		user_stocks = await self.config.member(user).stocks()
+		user_stocks = await self.storage.get_stocks(ctx.guild.id, user.id)
 
 		if(len(user_stocks.items()) == 0):
 			await ctx.send(f"{user.name} does not have any stocks.")
@@ -202,109 +668,107 @@ class Stocks(commands.Cog):
 
 		base_table.align["Profit"] = "m"
 
-		temp_table = base_table.copy()
+		tickers = [*user_stocks]
+
+		def get_rows(start: int, stop: int):
+			rows = []
 
-		pages = []
+			for idx, stock in enumerate(tickers[start:stop], start=start+1):
+				if stock in stock_data:
+					price = stock_data[stock]["price"]
+				else:
+					price = 0
 
-		def make_embed():
-			nonlocal temp_table, pages
-			msg = temp_table.get_string()
+				count = user_stocks[stock]["count"]
+				total = price * count
 
-			if(embed_requested):
-				embed = base_embed.copy()
-				embed.description = box(msg, lang="md")
-				embed.set_footer(text=f"Page {len(pages)+1}/{ceil(len(user_stocks)/10)}")
-				pages.append(embed)
-			else:
-				pages.append(box(msg, lang="md"))
+				# Only possible until the schema migration has finished, so don't write it back from here.
+				investment = user_stocks[stock].get('investment')
+				if(investment is None):
+					investment = total
+				percentage = ((total / investment) - 1.0) * 100.0 if investment else 0.0
 
-			temp_table = base_table.copy()
+				rows.append([f"{idx}.", stock, count, total, price, investment, self.pretty_percentage(percentage)])
 
-		for idx, stock in enumerate(user_stocks, start=1):
-			if stock in stock_data:
-				price = stock_data[stock]["price"]
-			else:
-				price = 0
+			return rows
 
-			count = user_stocks[stock]["count"]
-			total = price * count
+		note = self.stale_note(stock_data)
+		if note:
+			await ctx.send(note.strip())
 
-			if('investment' not in user_stocks[stock]):
-				async with self.config.member(user).stocks() as s:
-					s[stock]['investment'] = count * price
-					user_stocks[stock]['investment'] = count * price
+		pages = LazyPages(base_table, len(tickers), get_rows, base_embed if embed_requested else None)
+		await pages.menu(ctx)
 
-			investment = user_stocks[stock]['investment']
-			percentage = ((total / investment) - 1.0) * 100.0
+	@stocks.command()
+	async def trades(self, ctx: commands.Context, user: discord.Member = None):
+		"""List someone's most recent trades."""
+		if(user == None):
+			user = ctx.author
 
-			temp_table.add_row([f"{idx}.", stock, count, total, price, investment, self.pretty_percentage(percentage)])
-			
-			if(idx % 10 == 0):
-				make_embed()
+		if(self.storage.name != SQLiteStorage.name):
+			await ctx.send('Trade history is only kept when holdings are stored in SQLite.')
+			return
 
-		if(len(pages) != ceil(len(user_stocks)/10)):
-			make_embed()
+		trades = await self.storage.trades(ctx.guild.id, user.id, limit=100)
 
-		if not pages:
-			await ctx.send(f"{user.name} does not have any stocks.")
+		if not trades:
+			await ctx.send(f"{user.name} has not made any trades.")
 			return
 
-		c = DEFAULT_CONTROLS if len(pages) > 1 else {"\N{CROSS MARK}": close_menu}
+		currency = await bank.get_currency_name(ctx.guild)
+		embed_requested = await ctx.embed_requested()
+		base_embed = discord.Embed()
+		base_embed.set_author(name=f"{user.name} - Trades", icon_url=user.avatar_url)
+		base_table = PrettyTable(field_names=["Date", "Type", "Name", "Shares", "Price", "Total"])
+		base_table.set_style(prettytable.PLAIN_COLUMNS)
+		base_table.right_padding_width = 2
+		base_table.align = "l"
 
-		await menu(ctx, pages, c)
+		base_table.align["Shares"] =\
+			base_table.align["Price"] =\
+				base_table.align["Total"] = "r"
+
+		def get_rows(start: int, stop: int):
+			return [
+				[
+					datetime.utcfromtimestamp(trade['executed_at']).strftime('%Y-%m-%d %H:%M'),
+					"Buy" if trade['shares'] > 0 else "Sell",
+					trade['ticker'],
+					abs(trade['shares']),
+					trade['price'],
+					f"{abs(trade['shares']) * trade['price']} {currency}"
+				]
+				for trade in trades[start:stop]
+			]
+
+		pages = LazyPages(base_table, len(trades), get_rows, base_embed if embed_requested else None)
+		await pages.menu(ctx)
 
 	@stocks.command()
 	async def leaderboard(self, ctx: commands.Context):
 		"""Show a leaderboard of total stock value by user."""
 		# TODO: convert to buttons whenever I get around to 3.5 support
-		raw = await self.config.all_members()
-
 		guild: discord.Guild = ctx.guild
+		index = await self.get_holdings(guild)
+		stocks = index.tickers()
 
-		if(guild.id not in raw):
+		if not stocks:
 			await ctx.send("Nobody owns any stocks yet!")
 			return
 
-		raw = raw[guild.id]		
-		stocks = set()
-
-		for uid, data in raw.items():
-			stocks = stocks.union(set(data['stocks'].keys()))
-
 		try:
 			stock_data = await self.get_stock_data(ctx, list(stocks))
 		except ValueError as e:
 			return await ctx.send(e)
 
-		processed = []
-
-		for uid, data in raw.items():
-			total_value = 0
-			total_shares = 0
-			total_investment = 0
-			member = guild.get_member(uid)
-			for ticker, stock in data['stocks'].items():
-				if ticker not in stock_data:
-					continue
-				total_value += stock['count'] * stock_data[ticker]['price']
-				total_shares += stock['count']
-
-				if("investment" not in stock):
-					stock["investment"] = stock["count"] * stock_data[ticker]["price"]
-					if(member is not None):
-						async with self.config.member(member).stocks() as s:
-							s[ticker]["investment"] = stock["investment"]
+		unpriced = sorted(stocks.difference(stock_data))
 
-				total_investment += stock["investment"]
-			if not total_shares:
-				continue
+		ranking = index.ranking({ticker: data["price"] for ticker, data in stock_data.items()})
 
-			change = ((total_value / total_investment) - 1.0) * 100.0
+		if not ranking:
+			await ctx.send('Nobody owns any stocks yet!')
+			return
 
-			processed.append((uid, total_value, total_shares, total_investment, change))
-		
-		processed.sort(key=lambda a: a[1], reverse=True)
-		
 		embed_requested = await ctx.embed_requested()
 		base_embed = discord.Embed()
 		base_embed.set_author(name=f"{guild.name} - Stocks", icon_url=guild.icon_url)
@@ -318,48 +782,312 @@ class Stocks(commands.Cog):
 				 base_table.align["Investment"] = "r"
 
 		base_table.align["Profit"] = "m"
- 
-		temp_table = base_table.copy()
 
-		pages = []
+		def get_rows(start: int, stop: int):
+			rows = []
 
-		def make_embed():
-			nonlocal temp_table, pages
-			msg = temp_table.get_string()
+			# Only the pages up to the one being viewed are ever selected, not the whole ranking.
+			for idx, data in enumerate(ranking.top(stop)[start:stop], start=start+1):
+				uid, total_value, total_shares, investment, percentage = data
+				user = self.bot.get_user(uid)
+				if user:
+					user = user.name
+				else:
+					user = f'<Unknown user `{uid}`>'
 
-			if(embed_requested):
-				embed = base_embed.copy()
-				embed.description = box(msg, lang="md")
-				embed.set_footer(text=f"Page {len(pages)+1}/{ceil(len(processed)/10)}")
-				pages.append(embed)
-			else:
-				pages.append(box(msg, lang="md"))
+				rows.append([f"{idx}.", user, total_value, total_shares, investment, self.pretty_percentage(percentage)])
 
-			temp_table = base_table.copy()
+			return rows
 
-		for idx, data in enumerate(processed, start=1):
-			uid, total_value, total_shares, investment, percentage = data
-			user = self.bot.get_user(uid)
-			if user:
-				user = user.name
-			else:
-				user = f'<Unknown user `{uid}`>'
+		if unpriced:
+			await ctx.send(
+				f'I couldn\'t get prices for {len(unpriced)} stock{"s" if len(unpriced) != 1 else ""}, '
+				f'so they were left out: {", ".join(unpriced[:20])}{"..." if len(unpriced) > 20 else ""}'
+			)
 
-			temp_table.add_row([f"{idx}.", user, total_value, total_shares, investment, self.pretty_percentage(percentage)])
+		note = self.stale_note(stock_data)
+		if note:
+			await ctx.send(note.strip())
+
+		pages = LazyPages(base_table, len(ranking), get_rows, base_embed if embed_requested else None)
+		await pages.menu(ctx)
+
+	@commands.is_owner()
+	@stocks.command(aliases=["gleaderboard"])
+	async def globalleaderboard(self, ctx: commands.Context):
+		"""Show a leaderboard of total stock value by user across every server, in USD."""
+		async with ctx.typing():
+			try:
+				packed, quotes = await self.pack_global_positions()
+			except ValueError as e:
+				return await ctx.send(e)
+
+			if not len(packed):
+				await ctx.send("Nobody owns any stocks yet!")
+				return
 
-			if(idx % 10 == 0):
-				make_embed()
+			# The aggregation itself is plain number crunching, so keep it off the event loop.
+			prices = packed.price_column({ticker: quote['realPrice'] for ticker, quote in quotes.items()})
+			rows = await self.bot.loop.run_in_executor(None, rank, packed, prices)
+			unpriced = len(set(packed.tickers).difference(quotes))
 
-		if(len(pages) != ceil(len(processed)/10)):
-			make_embed()
+		if not rows:
+			await ctx.send("Nobody owns any stocks yet!")
+			return
 
-		if not pages:
-			await ctx.send('Nobody owns any stocks yet!')
+		embed_requested = await ctx.embed_requested()
+		base_embed = discord.Embed()
+		base_embed.set_author(name="Global - Stocks")
+		base_table = PrettyTable(field_names=["#", "Name", "Value", "Shares", "Investment", "Profit"])
+		base_table.set_style(prettytable.PLAIN_COLUMNS)
+		base_table.right_padding_width = 2
+		base_table.align = "l"
+
+		base_table.align["Value"] =\
+			base_table.align["Shares"] =\
+				base_table.align["Investment"] = "r"
+
+		base_table.align["Profit"] = "m"
+
+		def get_rows(start: int, stop: int):
+			table_rows = []
+
+			for idx, (uid, total_value, total_shares, investment, percentage) in enumerate(rows[start:stop], start=start+1):
+				user = self.bot.get_user(uid)
+				user = user.name if user else f'<Unknown user `{uid}`>'
+				table_rows.append([
+					f"{idx}.", user, f"${total_value:.2f}", total_shares, f"${investment:.2f}", self.pretty_percentage(percentage)
+				])
+
+			return table_rows
+
+		if unpriced:
+			await ctx.send(f'I couldn\'t get prices for {unpriced} stock{"s" if unpriced != 1 else ""}, so they were left out.')
+
+		note = self.stale_note(quotes)
+		if(note):
+			await ctx.send(note.strip())
+
+		pages = LazyPages(base_table, len(rows), get_rows, base_embed if embed_requested else None)
+		await pages.menu(ctx)
+
+	async def pack_global_positions(self) -> Tuple[PackedPositions, Dict[str, dict]]:
+		"""
+		Packs the positions of every guild the bot is in into columns, with investments converted to USD.
+
+		Returns the packed positions and the raw quotes of every ticker that could be priced.
+		"""
+		indexes = [(guild.id, await self.get_holdings(guild)) for guild in self.bot.guilds]
+		tickers = set().union(*(index.tickers() for _, index in indexes))
+		quotes = await self.get_raw_quotes(list(tickers))
+		conversions = {guild_id: data['conversion'] for guild_id, data in (await self.config.all_guilds()).items()}
+
+		prices = {ticker: quote['realPrice'] for ticker, quote in quotes.items()}
+		members = []
+
+		for n, (guild_id, index) in enumerate(indexes, start=1):
+			conversion = conversions.get(guild_id, 10)
+			# Trades change the index in place while the columns are packed, so copy each member's positions first.
+			members.extend((member_id, dict(positions), conversion) for member_id, positions in index.positions.items())
+
+			# Give other commands a chance to run while copying a lot of guilds.
+			if(n % 50 == 0):
+				await asyncio.sleep(0)
+
+		packed = await self.bot.loop.run_in_executor(None, pack, members, prices)
+		return packed, quotes
+
+	@commands.is_owner()
+	@stocks.command(name="export")
+	async def export_holdings(self, ctx: commands.Context, file_type: str = "jsonl", guild_id: int = None):
+		"""
+		Export every position in a server, valued at current prices, as a gzip-compressed JSON lines or CSV file.
+
+		Defaults to this server. Members are valued and written a chunk at a time, while other commands keep working.
+		Only SQLite storage also reads them a chunk at a time, so even the largest servers can be exported without
+		holding them in memory. With Config storage, the whole server's holdings are read first.
+		"""
+		guild_id = guild_id or ctx.guild.id
+		await self.send_export(
+			ctx, self.iter_holdings(guild_id), FIELDS, file_type, f"stocks-{guild_id}", "positions",
+			"Nobody in that server owns any stocks."
+		)
+
+	@commands.is_owner()
+	@stocks.command(name="exporttrades")
+	async def export_trades(self, ctx: commands.Context, file_type: str = "jsonl", guild_id: int = None):
+		"""
+		Export every trade made in a server as a gzip-compressed JSON lines or CSV file, oldest first.
+
+		Defaults to this server. Trades are only kept when holdings are stored in SQLite, and are streamed from the
+		ledger a chunk at a time.
+		"""
+		if(self.storage.name != SQLiteStorage.name):
+			await ctx.send('Trade history is only kept when holdings are stored in SQLite.')
+			return
+
+		guild_id = guild_id or ctx.guild.id
+		await self.send_export(
+			ctx, self.storage.iter_trades(guild_id, CHUNK_SIZE), TRADE_FIELDS, file_type, f"stocks-trades-{guild_id}",
+			"trades", "Nobody in that server made any trades yet."
+		)
+
+	async def send_export(
+		self, ctx: commands.Context, chunks: AsyncIterator[List[dict]], fields: Tuple[str, ...], file_type: str,
+		name: str, noun: str, empty: str
+	):
+		"""Writes the chunks of rows to a compressed file as they come, and sends it, or saves it if it is too large."""
+		file_type = file_type.lower().lstrip(".")
+		filename = f"{name}.{file_type}.gz"
+
+		if file_type not in FORMATS:
+			await ctx.send(f'The format must be one of {", ".join(FORMATS)}.')
+			return
+
+		async with ctx.typing():
+			with tempfile.TemporaryFile() as file:
+				writer = HoldingsWriter(file, file_type, fields)
+
+				try:
+					async for rows in chunks:
+						# Compressing is the slow part, so keep it off the event loop.
+						await self.bot.loop.run_in_executor(None, writer.write, rows)
+				finally:
+					await self.bot.loop.run_in_executor(None, writer.close)
+
+				if not writer.rows:
+					await ctx.send(empty)
+					return
+
+				size = file.tell()
+				file.seek(0)
+
+				if(size > ctx.guild.filesize_limit):
+					path = cog_data_path(self) / filename
+
+					with open(path, "wb") as saved:
+						await self.bot.loop.run_in_executor(None, shutil.copyfileobj, file, saved)
+
+					await ctx.send(f'The export of {writer.rows} {noun} is too large to upload here, so it was saved to `{path}`.')
+					return
+
+				await ctx.send(f'Exported {writer.rows} {noun}.', file=discord.File(file, filename=filename))
+
+	async def iter_holdings(self, guild_id: int, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[List[dict]]:
+		"""
+		Yields every position in a guild as rows with the columns of `export.FIELDS`, a chunk of members at a time.
+
+		Each ticker is priced the first time it shows up, through the quote cache, and keeps that price for the rest of
+		the export so every row is valued consistently. Positions that could not be priced have no price or value.
+		Members are read a chunk at a time only if the storage engine supports it, see `HoldingsStorage.iter_guild_members`.
+		"""
+		conversion = await self.config.guild_from_id(guild_id).conversion()
+		# ticker -> (USD price, when it was fetched if stale), or None if it could not be priced.
+		prices: Dict[str, Optional[Tuple[float, float]]] = {}
+
+		async for chunk in self.storage.iter_guild_members(guild_id, chunk_size):
+			missing = {ticker for _, user_stocks in chunk for ticker in user_stocks}.difference(prices)
+
+			if(missing):
+				try:
+					quotes = await self.get_raw_quotes(list(missing))
+				except ValueError:
+					quotes = {}
+
+				for ticker in missing:
+					quote = quotes.get(ticker)
+					prices[ticker] = (quote['realPrice'], quote.get('stale')) if quote is not None else None
+
+			rows = []
+
+			for member_id, user_stocks in chunk:
+				for ticker, stock in user_stocks.items():
+					row = {
+						"member_id": member_id,
+						"ticker": ticker,
+						"count": stock['count'],
+						"investment": stock.get('investment'),
+						"real_price": None,
+						"price": None,
+						"value": None,
+						"stale": None
+					}
+
+					if(prices[ticker] is not None):
+						real_price, stale = prices[ticker]
+						price = self.convert_price(real_price, conversion)
+						row.update(real_price=real_price, price=price, value=price * stock['count'], stale=stale)
+
+					rows.append(row)
+
+			yield rows
+
+	@stocks.command()
+	async def history(self, ctx: commands.Context, name: str, resolution: str = "1h"):
+		"""
+		View the price history of a stock.
+
+		The resolution is one of `5m` (last day), `1h` (last week) or `1d` (last year).
+		"""
+		name = name.upper()
+		samples = await self.read_history(ctx, HistoryStore.ticker_key(name), resolution)
+
+		if(samples is None):
 			return
 
-		c = DEFAULT_CONTROLS if len(pages) > 1 else {"\N{CROSS MARK}": close_menu}
+		if not samples:
+			await ctx.send(f'There is no history for {name} yet. History is only recorded for stocks someone owns.')
+			return
 
-		await menu(ctx, pages, c)
+		await ctx.send(self.format_history(f'{name} (USD)', samples, resolution, lambda v: f'${v:.2f}'))
+
+	@stocks.command()
+	async def portfolio(self, ctx: commands.Context, user: Optional[discord.Member] = None, resolution: str = "1h"):
+		"""
+		View how the value of someone's stocks changed over time.
+
+		The resolution is one of `5m` (last day), `1h` (last week) or `1d` (last year).
+		"""
+		if(user == None):
+			user = ctx.author
+
+		samples = await self.read_history(ctx, HistoryStore.portfolio_key(ctx.guild.id, user.id), resolution)
+
+		if(samples is None):
+			return
+
+		if not samples:
+			await ctx.send(f'There is no portfolio history for {user.name} yet.')
+			return
+
+		currency = await bank.get_currency_name(ctx.guild)
+		await ctx.send(self.format_history(f'{user.name} - Portfolio', samples, resolution, lambda v: f'{v:.0f} {currency}'))
+
+	async def read_history(self, ctx: commands.Context, key: SeriesKey, resolution: str):
+		names = [name for name, _, _ in RESOLUTIONS]
+
+		if(resolution not in names):
+			await ctx.send(f'"{resolution}" is not a valid resolution. Valid resolutions: {", ".join(names)}.')
+			return None
+
+		if(self.history_store is None):
+			await ctx.send('History is not being recorded on this bot.')
+			return None
+
+		return await self.bot.loop.run_in_executor(None, self.history_store.read, key, names.index(resolution), time.time())
+
+	def format_history(self, title: str, samples, resolution: str, fmt) -> str:
+		values = [value for _, value in downsample(samples, 60)]
+		first, last = samples[0][1], samples[-1][1]
+		change = ((last / first) - 1.0) * 100.0 if first else 0.0
+		since = datetime.utcfromtimestamp(samples[0][0]).strftime('%Y-%m-%d %H:%M')
+
+		return (
+			f'**{title}** since {since} UTC ({resolution} samples):\n'
+			f'{box(sparkline(values))}\n'
+			f'Low {fmt(min(v for _, v in samples))} · High {fmt(max(v for _, v in samples))} · '
+			f'Now {fmt(last)} <{self.pretty_percentage(change)}>'
+		)
 
 	@stocks.command()
 	async def price(self, ctx: commands.Context, name: str):
@@ -370,7 +1098,7 @@ class Stocks(commands.Cog):
 		"""
 		name = name.upper()
 		try:
-			stock_data = await self.get_stock_data(ctx, [name])
+			stock_data = await self.get_stock_data(ctx, [name], live=True)
 		except ValueError as e:
 			return await ctx.send(e)
 		if name not in stock_data:
@@ -381,7 +1109,182 @@ class Stocks(commands.Cog):
 		change = stock_data[name]['change']
 		currency = await bank.get_currency_name(ctx.guild)
 
-		await ctx.send(f'**{name}:** {price} {currency} per share (${"%.3f" % real} <{self.pretty_percentage(change)}>).')
+		await ctx.send(f'**{name}:** {price} {currency} per share (${"%.3f" % real} <{self.pretty_percentage(change)}>).{self.stale_note(stock_data)}')
+
+	async def start_price_poller(self, interval: int):
+		if(self.held_tickers is None):
+			self.held_tickers = Counter()
+
+			for members in (await self.storage.all_members()).values():
+				for user_stocks in members.values():
+					self.held_tickers.update(user_stocks.keys())
+
+		self.price_poller.change_interval(seconds=interval)
+
+		if not self.price_poller.is_running():
+			self.price_poller.start()
+
+	def stop_price_poller(self):
+		self.price_poller.cancel()
+		self.held_tickers = None
+		self.price_table.clear()
+
+	def track_ticker(self, ticker: str, delta: int):
+		"""Updates the number of members holding a ticker, so the price poller knows what to refresh."""
+		if(self.held_tickers is None):
+			return
+
+		self.held_tickers[ticker] += delta
+
+		if(self.held_tickers[ticker] <= 0):
+			del self.held_tickers[ticker]
+			self.price_table.pop(ticker, None)
+
+	def start_history_sampler(self):
+		if(self.history_store is None):
+			self.history_store = HistoryStore(cog_data_path(self) / "history")
+
+		if not self.history_sampler.is_running():
+			self.history_sampler.start()
+
+	def stop_history_sampler(self):
+		self.history_sampler.cancel()
+
+		if(self.history_store is not None):
+			self.history_store.close()
+			self.history_store = None
+
+	@tasks.loop(seconds=SAMPLE_INTERVAL)
+	async def history_sampler(self):
+		try:
+			indexes = {guild.id: await self.get_holdings(guild) for guild in self.bot.guilds}
+			tickers = set().union(*(index.tickers() for index in indexes.values()))
+
+			if not tickers:
+				return
+
+			# Stale prices would only repeat an old sample, so they are left out.
+			quotes = {
+				ticker: quote for ticker, quote in (await self.get_raw_quotes(list(tickers))).items()
+				if not quote.get("stale")
+			}
+			conversions = {guild_id: data['conversion'] for guild_id, data in (await self.config.all_guilds()).items()}
+			samples = {HistoryStore.ticker_key(ticker): quote['realPrice'] for ticker, quote in quotes.items()}
+
+			for guild_id, index in indexes.items():
+				if not index.positions:
+					continue
+
+				conversion = conversions.get(guild_id, 10)
+				ranking = index.ranking({ticker: self.convert_price(quote['realPrice'], conversion) for ticker, quote in quotes.items()})
+
+				for member_id, total_value, *_ in ranking.rows:
+					samples[HistoryStore.portfolio_key(guild_id, member_id)] = total_value
+
+				samples[HistoryStore.guild_key(guild_id)] = sum(row[1] for row in ranking.rows)
+
+			store = self.history_store
+
+			if(store is not None):
+				# Writing thousands of samples is disk work, so keep it off the event loop.
+				await self.bot.loop.run_in_executor(None, store.record_many, time.time(), samples)
+				await self.bot.loop.run_in_executor(None, store.flush)
+		except Exception as e:
+			log.exception(e)
+
+	@history_sampler.before_loop
+	async def before_history_sampler(self):
+		await self.bot.wait_until_ready()
+
+	async def get_holdings(self, guild: discord.Guild) -> GuildHoldings:
+		"""Returns the holdings index of a guild, loading it from config the first time it is needed."""
+		index = self.holdings.get(guild.id)
+
+		if(index is not None):
+			return index
+
+		lock = self.holdings_locks.setdefault(guild.id, asyncio.Lock())
+
+		async with lock:
+			while guild.id not in self.holdings:
+				# Trades made while the guild is read may or may not be in what is read, so they are recorded and
+				# applied on top of it. Setting a position is idempotent, so applying one twice does no harm.
+				changes = self.holdings_loading[guild.id] = []
+
+				try:
+					index = GuildHoldings.from_members(await self.storage.guild_members(guild.id))
+				except BaseException:
+					if(self.holdings_loading.get(guild.id) is changes):
+						del self.holdings_loading[guild.id]
+					raise
+
+				# The holdings were invalidated while they were read, so read them again.
+				if(self.holdings_loading.get(guild.id) is not changes):
+					continue
+
+				del self.holdings_loading[guild.id]
+
+				for member_id, ticker, stock in changes:
+					self.apply_holding(index, member_id, ticker, stock)
+
+				self.holdings[guild.id] = index
+
+		return self.holdings[guild.id]
+
+	def update_holdings(self, guild: discord.Guild, member_id: int, ticker: str, stock: dict = None):
+		"""Updates a member's position in the guild's holdings index, if it was loaded already or is being loaded."""
+		index = self.holdings.get(guild.id)
+
+		if(index is not None):
+			self.apply_holding(index, member_id, ticker, stock)
+		elif guild.id in self.holdings_loading:
+			self.holdings_loading[guild.id].append((member_id, ticker, stock))
+
+	@staticmethod
+	def apply_holding(index: GuildHoldings, member_id: int, ticker: str, stock: Optional[dict]):
+		if(stock is None):
+			index.remove_position(member_id, ticker)
+		else:
+			index.set_position(member_id, ticker, stock['count'], stock.get('investment'))
+
+	def invalidate_holdings(self, guild_id: int = None):
+		"""Drops the holdings index of a guild, or of every guild, including any that is being loaded right now."""
+		if(guild_id is None):
+			self.holdings.clear()
+			self.holdings_loading.clear()
+		else:
+			self.holdings.pop(guild_id, None)
+			self.holdings_loading.pop(guild_id, None)
+
+	@tasks.loop(seconds=60)
+	async def price_poller(self):
+		try:
+			tickers = list(self.held_tickers or ())
+
+			if not tickers:
+				return
+
+			quotes, errors = await self.quote_batcher.get_with_errors(tickers)
+			# Only the stocks that were refreshed get a new fetch time, the others expire from the table.
+			fetched_at = time.time()
+			self.price_table.update((symbol, (quote, fetched_at)) for symbol, quote in quotes.items())
+
+			if(errors):
+				log.warning("Price poller could not refresh %d of %d stocks.", len(errors), len(tickers))
+		except Exception as e:
+			log.exception(e)
+
+	@price_poller.before_loop
+	async def before_price_poller(self):
+		await self.bot.wait_until_ready()
+
+	@tasks.loop(seconds=60)
+	async def metrics_dump(self):
+		try:
+			if(self.metrics_file is not None):
+				await self.bot.loop.run_in_executor(None, self.metrics.write_prometheus, self.metrics_file)
+		except OSError as e:
+			log.warning("Could not write the metrics to %s: %s", self.metrics_file, e)
 
 	def pretty_percentage(self, number: float) -> str:
 		if(number > 0):
@@ -391,43 +1294,216 @@ class Stocks(commands.Cog):
 
 		return f"{sign}{'%.2f' % number} %"
 
-	async def get_stock_data(self, ctx: commands.Context, stocks: List[str]):
+	async def get_stock_data(self, ctx: commands.Context, stocks: List[str], live: bool = False):
 		"""
 		Returns a dict mapping stock symbols to a dict of their converted price and the total shares of that stock.
 
-		This function is designed to contain all of the API code in order to avoid having to mangle multiple parts
-		of the code in the event of an API change.
+		The guild's conversion rate is applied to the raw quotes, so cached quotes can be reused by every guild.
+		"""
+		with self.stock_data_time.time():
+			try:
+				quotes = await self.get_raw_quotes(stocks, live)
+			except ValueError:
+				self.stock_data_errors.inc()
+				raise
+
+			with self.config_read_time.time():
+				conversion = await self.config.guild(ctx.guild).conversion()
+
+		stock = {
+			symbol: {
+				"realPrice" : quote["realPrice"],
+				"change" : quote["change"],
+				"price": self.convert_price(quote["realPrice"], conversion),
+				"stale": quote.get("stale")
+			}
+
+			for symbol, quote in quotes.items()
+		}
+
+		return stock
+
+	@staticmethod
+	def convert_price(real_price: float, conversion: int) -> int:
+		return max(1, round(real_price * conversion))
+
+	async def get_raw_quotes(self, stocks: List[str], live: bool = False) -> Dict[str, dict]:
 		"""
-		api_url = 'https://query1.finance.yahoo.com/v7/finance/quote?lang=en-US&region=US&corsDomain=finance.yahoo.com'
-		stocks = ','.join(stocks)
+		Returns a dict mapping stock symbols to their raw USD quotes.
+
+		Raw quotes are read from the price poller's table when it refreshed them recently, unless `live` is set. Otherwise they
+		are looked up in the shared quote cache, and only the missing symbols are fetched.
+		Concurrent lookups for the same symbols are coalesced into a single upstream request.
+		Large symbol sets are fetched in chunks, and symbols from chunks that failed are left out of the result.
+		"""
+		stocks = list(dict.fromkeys(stocks))
 
 		if not stocks:
-			return []
+			return {}
 
-		api_url += "&symbols=" + stocks
-		api_url += "&fields=symbol,regularMarketPrice,regularMarketChangePercent"
+		self.symbols_requested.inc(len(stocks))
+		self.symbols_per_lookup.observe(len(stocks))
+		quotes = {}
 
-		headers = {'Accept': 'application/json'}
-		async with aiohttp.ClientSession() as session:
-			async with session.get(api_url, headers=headers) as r:
-				try:
-					r = await r.json()
-				except aiohttp.client_exceptions.ContentTypeError:
-					#This might happen when being rate limited, but IDK for sure...
-					raise ValueError('Could not get stock data. Are we being rate-limited?')
-		
-		r = r["quoteResponse"]["result"]
+		if(not live and self.price_table):
+			fresh_after = time.time() - self.price_poller.seconds * 2
 
-		conversion = await self.config.guild(ctx.guild).conversion()
+			# Prices the poller failed to refresh go through the cache instead, and are marked stale from there.
+			for symbol in stocks:
+				entry = self.price_table.get(symbol)
 
-		stock = {
-			x["symbol"]: {
-				"realPrice" : x['regularMarketPrice'],
-				"change" : x["regularMarketChangePercent"],
-				"price": max(1, round(x['regularMarketPrice'] * conversion))
-			}
+				if(entry is not None and entry[1] >= fresh_after):
+					quotes[symbol] = entry[0]
 
-			for x in r if "regularMarketPrice" in x and x["regularMarketPrice"] is not None
-		}
+			stocks = [symbol for symbol in stocks if symbol not in quotes]
+			self.price_table_hits.inc(len(quotes))
+
+		hits, missing = self.quote_cache.get_many(stocks)
+		quotes.update(hits)
+		self.quote_cache_hits.inc(len(hits))
+		self.quote_cache_misses.inc(len(missing))
+
+		# While the upstream is unavailable, serve what we last knew and try again in the background.
+		if(missing and not self.circuit_breaker.closed):
+			stale = self.get_stale_quotes(missing)
+
+			if(stale):
+				quotes.update(stale)
+				self.stale_quotes.inc(len(stale))
+				missing = [symbol for symbol in missing if symbol not in stale]
+				self.revalidate(list(stale))
+
+		if missing:
+			fetched, errors = await self.quote_batcher.get_with_errors(missing)
+			quotes.update(fetched)
+			stale = self.get_stale_quotes(errors)
+			quotes.update(stale)
+			self.stale_quotes.inc(len(stale))
+
+			# Only fail outright when nothing could be priced, otherwise return whatever we got.
+			if(errors and not quotes):
+				raise next(iter(errors.values()))
+
+		return quotes
+
+	def get_stale_quotes(self, stocks: List[str]) -> Dict[str, dict]:
+		"""Returns the last known quotes for the given symbols, marked with when they were fetched."""
+		stale = {}
+
+		for symbol in stocks:
+			entry = self.quote_cache.get_stale(symbol)
+
+			if(entry is not None):
+				quote, fetched_at = entry
+				stale[symbol] = dict(quote, stale=fetched_at)
+
+		return stale
+
+	def revalidate(self, stocks: List[str]):
+		"""Refreshes the given symbols in the background, once the circuit breaker lets a request through."""
+		if(not self.circuit_breaker.ready() or (self.revalidate_task is not None and not self.revalidate_task.done())):
+			return
+
+		self.revalidate_task = asyncio.ensure_future(self.quote_batcher.get_with_errors(stocks))
+
+	def stale_note(self, stock_data: Dict[str, dict]) -> str:
+		"""Returns a note saying how old the prices are if any of them are stale, or an empty string otherwise."""
+		stale = [data["stale"] for data in stock_data.values() if data.get("stale")]
+
+		if not stale:
+			return ''
 
-		return stock
\ No newline at end of file
+		as_of = datetime.utcfromtimestamp(min(stale)).strftime('%Y-%m-%d %H:%M')
+		return f'\n*The stock API is unavailable right now, prices are stale as of {as_of} UTC.*'
+
+	def make_storage(self, name: str) -> HoldingsStorage:
+		"""Creates a storage engine by name. Trades are buffered, so bursts of them cost one write per member."""
+		if(name == SQLiteStorage.name):
+			storage = SQLiteStorage(cog_data_path(self) / "holdings.sqlite3")
+		else:
+			storage = ConfigStorage(self.config)
+
+		return WriteBehindStorage(storage, read_time=self.storage_read_time, write_time=self.storage_write_time)
+
+	@asynccontextmanager
+	async def trade_lock(self, guild_id: int, member_id: int):
+		"""
+		Holds the member's lock for a trade. Trades wait while the storage engine is being switched, and the switch
+		waits for the trades already running, so every trade is written to the engine it was copied from or to.
+		"""
+		while(self.storage_switch is not None):
+			await self.storage_switch.wait()
+
+		self.running_trades += 1
+
+		try:
+			async with self.member_lock(guild_id, member_id):
+				yield
+		finally:
+			self.running_trades -= 1
+
+	def member_lock(self, guild_id: int, member_id: int) -> asyncio.Lock:
+		"""Returns the lock that must be held while trading for a member, so their trades never interleave."""
+		lock = self.member_locks.get((guild_id, member_id))
+
+		if(lock is None):
+			lock = self.member_locks[guild_id, member_id] = asyncio.Lock()
+
+		return lock
+
+	def use_provider(self, provider: QuoteProvider):
+		"""Switches the quote provider, planning batch sizes and request rates around its limits."""
+		self.provider = provider
+		self.quote_batcher.configure(chunk_size=provider.max_batch_size, max_concurrency=provider.max_concurrency)
+		self.request_pacer.rate = provider.requests_per_second
+
+	async def _fetch_and_cache_quotes(self, stocks: List[str]):
+		quotes = await self.fetch_quotes(stocks)
+		self.quote_cache.put_many(quotes)
+		return quotes
+
+	async def fetch_quotes(self, stocks: List[str]):
+		"""
+		Returns a dict mapping stock symbols to their raw USD price and change percentage.
+
+		All of the API code lives in the quote providers, in order to avoid having to mangle multiple parts
+		of the code in the event of an API change. Requests are refused while the circuit breaker is open.
+		"""
+		if not self.circuit_breaker.allow_request():
+			self.upstream_rejected.inc()
+			raise CircuitOpenError(
+				f'Could not get stock data, the stock API is unavailable. '
+				f'Try again in {ceil(self.circuit_breaker.retry_after())} seconds.'
+			)
+
+		await self.request_pacer.wait()
+		self.upstream_requests.inc()
+		self.upstream_symbols.observe(len(stocks))
+
+		try:
+			with self.upstream_time.time():
+				quotes = await self.provider.fetch(self.session, stocks)
+		except RateLimitedError:
+			self.upstream_rate_limited.inc()
+			self.circuit_breaker.record_failure(rate_limited=True)
+			raise
+		except ValueError:
+			self.upstream_errors.inc()
+			self.circuit_breaker.record_failure()
+			raise
+		except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+			self.upstream_errors.inc()
+			self.circuit_breaker.record_failure()
+			raise ValueError('Could not get stock data. The stock API did not respond.') from e
+		except asyncio.CancelledError:
+			self.circuit_breaker.record_cancelled()
+			raise
+		except Exception as e:
+			# Anything else still counts as a failure, or a failed probe would leave the breaker half-open for good.
+			log.exception(e)
+			self.upstream_errors.inc()
+			self.circuit_breaker.record_failure()
+			raise ValueError('Could not get stock data. The stock API sent an unexpected response.') from e
+
+		self.circuit_breaker.record_success()
+		return quotes
@@ -0,0 +1,459 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+import aiosqlite
+import discord
+from redbot.core import Config
+
+from .metrics import Histogram
+
+log = logging.getLogger("red.gradient-cogs.stocks")
+
+# member id -> ticker -> {"count": int, "investment": int}
+MemberStocks = Dict[int, Dict[str, dict]]
+# A chunk of a guild's (member id, stocks), in member id order where the engine can.
+MemberChunk = List[Tuple[int, Dict[str, dict]]]
+
+
+class Trade(NamedTuple):
+	"""A single executed trade. Sells have a negative number of shares."""
+	ticker: str
+	shares: int
+	price: int
+	executed_at: float = None
+
+
+class HoldingsStorage:
+	"""
+	Base class for the storage engines that keep member holdings.
+
+	Every engine stores the same per-member dict of positions the cog has always used, mapping tickers to their
+	`count` and `investment`.
+	"""
+	name: str = None
+
+	async def open(self):
+		pass
+
+	async def close(self):
+		pass
+
+	async def get_stocks(self, guild_id: int, member_id: int) -> Dict[str, dict]:
+		raise NotImplementedError
+
+	async def set_position(self, guild_id: int, member_id: int, ticker: str, stock: Optional[dict], trade: Trade = None):
+		"""Stores a member's position in a ticker, removing it if `stock` is None, and records the trade if given."""
+		await self.set_positions(guild_id, member_id, {ticker: stock}, [trade] if trade is not None else [])
+
+	async def set_positions(self, guild_id: int, member_id: int, positions: Dict[str, Optional[dict]], trades: List[Trade]):
+		"""Stores several of a member's positions and records their trades, in a single write where possible."""
+		raise NotImplementedError
+
+	async def guild_members(self, guild_id: int) -> MemberStocks:
+		raise NotImplementedError
+
+	async def iter_guild_members(self, guild_id: int, chunk_size: int = 500) -> AsyncIterator[MemberChunk]:
+		"""
+		Yields a guild's members and their stocks, in chunks of up to about `chunk_size` members.
+
+		By default the whole guild is read at once and then chunked, which is all Config can do: its drivers read a
+		guild's members as a single value. Engines that can read a chunk at a time, like SQLite, override this so their
+		memory use doesn't grow with the size of the guild.
+		"""
+		members = list((await self.guild_members(guild_id)).items())
+
+		for start in range(0, len(members), chunk_size):
+			yield members[start:start + chunk_size]
+
+	async def all_members(self) -> Dict[int, MemberStocks]:
+		raise NotImplementedError
+
+	async def replace_all(self, data: Dict[int, MemberStocks]):
+		"""Replaces every stored position with the given ones. Used when switching storage engines."""
+		raise NotImplementedError
+
+	async def trades(self, guild_id: int, member_id: int, limit: int = 50) -> List[dict]:
+		"""Returns a member's most recent trades, newest first. Engines without a ledger return an empty list."""
+		return []
+
+	async def iter_trades(self, guild_id: int, chunk_size: int = 500) -> AsyncIterator[List[dict]]:
+		"""Yields every trade made in a guild, oldest first, in chunks. Engines without a ledger yield nothing."""
+		return
+		# Unreachable, but it makes this an async generator like the overrides.
+		yield
+
+
+class ConfigStorage(HoldingsStorage):
+	"""Keeps holdings in Red's Config, as a `stocks` dict on every member. It has no trade history."""
+	name = "config"
+
+	def __init__(self, config: Config):
+		self.config = config
+
+	async def get_stocks(self, guild_id: int, member_id: int) -> Dict[str, dict]:
+		return await self.config.member_from_ids(guild_id, member_id).stocks()
+
+	async def set_positions(self, guild_id: int, member_id: int, positions: Dict[str, Optional[dict]], trades: List[Trade]):
+		async with self.config.member_from_ids(guild_id, member_id).stocks() as user_stocks:
+			for ticker, stock in positions.items():
+				if(stock is None):
+					user_stocks.pop(ticker, None)
+				else:
+					user_stocks[ticker] = stock
+
+	async def guild_members(self, guild_id: int) -> MemberStocks:
+		members = await self.config.all_members(guild=discord.Object(guild_id))
+		return {member_id: data['stocks'] for member_id, data in members.items()}
+
+	async def all_members(self) -> Dict[int, MemberStocks]:
+		return {
+			guild_id: {member_id: data['stocks'] for member_id, data in members.items()}
+			for guild_id, members in (await self.config.all_members()).items()
+		}
+
+	async def replace_all(self, data: Dict[int, MemberStocks]):
+		await self.config.clear_all_members()
+
+		for guild_id, members in data.items():
+			for member_id, user_stocks in members.items():
+				if user_stocks:
+					await self.config.member_from_ids(guild_id, member_id).stocks.set(user_stocks)
+
+
+class SQLiteStorage(HoldingsStorage):
+	"""
+	Keeps holdings in a local SQLite database, as an append-only trade ledger plus a table of current positions.
+
+	Positions are keyed by (guild, member, ticker) and indexed by ticker, so portfolio and leaderboard lookups are
+	plain indexed queries. The database runs in WAL mode, and writes are committed in batches at most
+	`commit_delay` seconds after they happen.
+	"""
+	name = "sqlite"
+
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS trades (
+		id INTEGER PRIMARY KEY AUTOINCREMENT,
+		guild_id INTEGER NOT NULL,
+		member_id INTEGER NOT NULL,
+		ticker TEXT NOT NULL,
+		shares INTEGER NOT NULL,
+		price INTEGER NOT NULL,
+		executed_at REAL NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS trades_member ON trades (guild_id, member_id, id);
+	CREATE INDEX IF NOT EXISTS trades_guild ON trades (guild_id, id);
+	CREATE TABLE IF NOT EXISTS positions (
+		guild_id INTEGER NOT NULL,
+		member_id INTEGER NOT NULL,
+		ticker TEXT NOT NULL,
+		count INTEGER NOT NULL,
+		investment INTEGER,
+		PRIMARY KEY (guild_id, member_id, ticker)
+	) WITHOUT ROWID;
+	CREATE INDEX IF NOT EXISTS positions_ticker ON positions (guild_id, ticker);
+	"""
+
+	def __init__(self, path: Path, commit_delay: float = 0.1):
+		self.path = path
+		self.commit_delay = commit_delay
+		self.db: aiosqlite.Connection = None
+		self._commit_handle: asyncio.TimerHandle = None
+		self._commit_task: asyncio.Task = None
+
+	async def open(self):
+		self.db = await aiosqlite.connect(str(self.path))
+		await self.db.execute("PRAGMA journal_mode=WAL")
+		await self.db.execute("PRAGMA synchronous=NORMAL")
+		await self.db.executescript(self.SCHEMA)
+		await self.db.commit()
+
+	async def close(self):
+		if(self.db is None):
+			return
+
+		if(self._commit_handle is not None):
+			self._commit_handle.cancel()
+			self._commit_handle = None
+
+		await self.db.commit()
+		await self.db.close()
+		self.db = None
+
+	def _schedule_commit(self):
+		if(self._commit_handle is None):
+			self._commit_handle = asyncio.get_event_loop().call_later(self.commit_delay, self._start_commit)
+
+	def _start_commit(self):
+		self._commit_handle = None
+		self._commit_task = asyncio.ensure_future(self._commit())
+
+	async def _commit(self):
+		try:
+			if(self.db is not None):
+				await self.db.commit()
+		except Exception as e:
+			log.exception(e)
+
+	async def get_stocks(self, guild_id: int, member_id: int) -> Dict[str, dict]:
+		async with self.db.execute(
+			"SELECT ticker, count, investment FROM positions WHERE guild_id = ? AND member_id = ?",
+			(guild_id, member_id)
+		) as cursor:
+			return {ticker: {'count': count, 'investment': investment} async for ticker, count, investment in cursor}
+
+	async def set_positions(self, guild_id: int, member_id: int, positions: Dict[str, Optional[dict]], trades: List[Trade]):
+		await self.db.executemany(
+			"DELETE FROM positions WHERE guild_id = ? AND member_id = ? AND ticker = ?",
+			[(guild_id, member_id, ticker) for ticker, stock in positions.items() if stock is None]
+		)
+		await self.db.executemany(
+			"INSERT OR REPLACE INTO positions (guild_id, member_id, ticker, count, investment) VALUES (?, ?, ?, ?, ?)",
+			[
+				(guild_id, member_id, ticker, stock['count'], stock.get('investment'))
+				for ticker, stock in positions.items() if stock is not None
+			]
+		)
+
+		if(trades):
+			executed_at = time.time()
+			await self.db.executemany(
+				"INSERT INTO trades (guild_id, member_id, ticker, shares, price, executed_at) VALUES (?, ?, ?, ?, ?, ?)",
+				[
+					(guild_id, member_id, trade.ticker, trade.shares, trade.price, trade.executed_at or executed_at)
+					for trade in trades
+				]
+			)
+
+		self._schedule_commit()
+
+	async def guild_members(self, guild_id: int) -> MemberStocks:
+		members = {}
+
+		async with self.db.execute(
+			"SELECT member_id, ticker, count, investment FROM positions WHERE guild_id = ?",
+			(guild_id,)
+		) as cursor:
+			async for member_id, ticker, count, investment in cursor:
+				members.setdefault(member_id, {})[ticker] = {'count': count, 'investment': investment}
+
+		return members
+
+	async def iter_guild_members(self, guild_id: int, chunk_size: int = 500) -> AsyncIterator[MemberChunk]:
+		"""Pages through the guild's members by id, so each chunk is two indexed queries and nothing more is held."""
+		last = 0
+
+		while True:
+			async with self.db.execute(
+				"SELECT DISTINCT member_id FROM positions WHERE guild_id = ? AND member_id > ? ORDER BY member_id LIMIT ?",
+				(guild_id, last, chunk_size)
+			) as cursor:
+				member_ids = [member_id async for member_id, in cursor]
+
+			if not member_ids:
+				return
+
+			members = {}
+
+			# Members who traded for the first time in between are in range too, and are included here rather than skipped.
+			async with self.db.execute(
+				"SELECT member_id, ticker, count, investment FROM positions "
+				"WHERE guild_id = ? AND member_id BETWEEN ? AND ? ORDER BY member_id",
+				(guild_id, member_ids[0], member_ids[-1])
+			) as cursor:
+				async for member_id, ticker, count, investment in cursor:
+					members.setdefault(member_id, {})[ticker] = {'count': count, 'investment': investment}
+
+			last = member_ids[-1]
+			yield list(members.items())
+
+	async def all_members(self) -> Dict[int, MemberStocks]:
+		guilds = {}
+
+		async with self.db.execute("SELECT guild_id, member_id, ticker, count, investment FROM positions") as cursor:
+			async for guild_id, member_id, ticker, count, investment in cursor:
+				guilds.setdefault(guild_id, {}).setdefault(member_id, {})[ticker] = {'count': count, 'investment': investment}
+
+		return guilds
+
+	async def replace_all(self, data: Dict[int, MemberStocks]):
+		await self.db.execute("DELETE FROM positions")
+		await self.db.executemany(
+			"INSERT INTO positions (guild_id, member_id, ticker, count, investment) VALUES (?, ?, ?, ?, ?)",
+			(
+				(guild_id, member_id, ticker, stock['count'], stock.get('investment'))
+				for guild_id, members in data.items()
+				for member_id, user_stocks in members.items()
+				for ticker, stock in user_stocks.items()
+			)
+		)
+		await self.db.commit()
+
+	async def trades(self, guild_id: int, member_id: int, limit: int = 50) -> List[dict]:
+		async with self.db.execute(
+			"SELECT ticker, shares, price, executed_at FROM trades WHERE guild_id = ? AND member_id = ? ORDER BY id DESC LIMIT ?",
+			(guild_id, member_id, limit)
+		) as cursor:
+			return [
+				{'ticker': ticker, 'shares': shares, 'price': price, 'executed_at': executed_at}
+				async for ticker, shares, price, executed_at in cursor
+			]
+
+	async def iter_trades(self, guild_id: int, chunk_size: int = 500) -> AsyncIterator[List[dict]]:
+		"""Pages through the guild's trades by id, so only one chunk is held at a time."""
+		last = 0
+
+		while True:
+			async with self.db.execute(
+				"SELECT id, member_id, ticker, shares, price, executed_at FROM trades "
+				"WHERE guild_id = ? AND id > ? ORDER BY id LIMIT ?",
+				(guild_id, last, chunk_size)
+			) as cursor:
+				trades = [
+					{'id': id, 'member_id': member_id, 'ticker': ticker, 'shares': shares, 'price': price, 'executed_at': executed_at}
+					async for id, member_id, ticker, shares, price, executed_at in cursor
+				]
+
+			if not trades:
+				return
+
+			last = trades[-1]['id']
+			yield trades
+
+
+
+class WriteBehindStorage(HoldingsStorage):
+	"""
+	Buffers position changes in memory and writes them to another storage engine in the background.
+
+	All the changes made to a member within `delay` seconds are merged into a single write. Reads go through the
+	buffer, so they always see the latest positions. Anything left in the buffer is written when it is closed, but
+	a crash loses it, while the bank change of the same trade is already saved.
+	Reads and writes of single members are timed into the given histograms, if any.
+	"""
+	def __init__(self, storage: HoldingsStorage, delay: float = 0.5, read_time: Histogram = None, write_time: Histogram = None):
+		self.storage = storage
+		self.delay = delay
+		self.read_time = read_time
+		self.write_time = write_time
+		self._pending: Dict[Tuple[int, int], Tuple[Dict[str, Optional[dict]], List[Trade]]] = {}
+		self._flushing: Dict[Tuple[int, int], Tuple[Dict[str, Optional[dict]], List[Trade]]] = {}
+		self._flush_handle: asyncio.TimerHandle = None
+		self._flush_lock: asyncio.Lock = None
+
+	@property
+	def name(self) -> str:
+		return self.storage.name
+
+	async def open(self):
+		await self.storage.open()
+
+	async def close(self):
+		if(self._flush_handle is not None):
+			self._flush_handle.cancel()
+			self._flush_handle = None
+
+		await self.flush()
+		await self.storage.close()
+
+	async def get_stocks(self, guild_id: int, member_id: int) -> Dict[str, dict]:
+		# Take the buffered changes before reading. A flush can finish while the read is awaited, emptying the
+		# buffers, and the read may still have seen the positions from before it.
+		overlay: Dict[str, Optional[dict]] = {}
+
+		for buffer in (self._flushing, self._pending):
+			if (guild_id, member_id) in buffer:
+				overlay.update(buffer[guild_id, member_id][0])
+
+		started = time.perf_counter()
+		user_stocks = await self.storage.get_stocks(guild_id, member_id)
+
+		if(self.read_time is not None):
+			self.read_time.observe(time.perf_counter() - started)
+
+		for ticker, stock in overlay.items():
+			if(stock is None):
+				user_stocks.pop(ticker, None)
+			else:
+				user_stocks[ticker] = dict(stock)
+
+		return user_stocks
+
+	async def set_positions(self, guild_id: int, member_id: int, positions: Dict[str, Optional[dict]], trades: List[Trade]):
+		pending_positions, pending_trades = self._pending.setdefault((guild_id, member_id), ({}, []))
+		pending_positions.update({ticker: dict(stock) if stock is not None else None for ticker, stock in positions.items()})
+		# Stamp the trades now, they may only reach the ledger a while later.
+		pending_trades.extend(trade if trade.executed_at else trade._replace(executed_at=time.time()) for trade in trades)
+
+		self._schedule_flush()
+
+	def _schedule_flush(self):
+		if(self._flush_handle is None):
+			self._flush_handle = asyncio.get_event_loop().call_later(self.delay, self._start_flush)
+
+	def _start_flush(self):
+		self._flush_handle = None
+		asyncio.ensure_future(self.flush())
+
+	async def flush(self):
+		"""Writes everything in the buffer to the underlying storage engine right away."""
+		if(self._flush_lock is None):
+			self._flush_lock = asyncio.Lock()
+
+		# Only one flush at a time, so writes for the same member are never reordered.
+		async with self._flush_lock:
+			self._flushing, self._pending = self._pending, {}
+			failed = False
+
+			try:
+				for (guild_id, member_id), (positions, trades) in self._flushing.items():
+					started = time.perf_counter()
+
+					try:
+						await self.storage.set_positions(guild_id, member_id, positions, trades)
+					except Exception as e:
+						log.exception(e)
+						failed = True
+						# Put it back, unless the member changed those positions again in the meantime.
+						pending_positions, pending_trades = self._pending.setdefault((guild_id, member_id), ({}, []))
+						for ticker, stock in positions.items():
+							pending_positions.setdefault(ticker, stock)
+						pending_trades[:0] = trades
+					else:
+						if(self.write_time is not None):
+							self.write_time.observe(time.perf_counter() - started)
+			finally:
+				self._flushing = {}
+
+			if(failed):
+				self._schedule_flush()
+
+	async def guild_members(self, guild_id: int) -> MemberStocks:
+		await self.flush()
+		return await self.storage.guild_members(guild_id)
+
+	async def iter_guild_members(self, guild_id: int, chunk_size: int = 500) -> AsyncIterator[MemberChunk]:
+		await self.flush()
+
+		async for chunk in self.storage.iter_guild_members(guild_id, chunk_size):
+			yield chunk
+
+	async def iter_trades(self, guild_id: int, chunk_size: int = 500) -> AsyncIterator[List[dict]]:
+		await self.flush()
+
+		async for chunk in self.storage.iter_trades(guild_id, chunk_size):
+			yield chunk
+
+	async def all_members(self) -> Dict[int, MemberStocks]:
+		await self.flush()
+		return await self.storage.all_members()
+
+	async def replace_all(self, data: Dict[int, MemberStocks]):
+		await self.flush()
+		await self.storage.replace_all(data)
+
+	async def trades(self, guild_id: int, member_id: int, limit: int = 50) -> List[dict]:
+		await self.flush()
+		return await self.storage.trades(guild_id, member_id, limit)
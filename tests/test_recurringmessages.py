@@ -0,0 +1,127 @@
+"""
+Tests for the RecurringMessages cog, run against Red's JSON Config driver in a scratch folder.
+
+They reuse the stand-ins of the scheduler benchmark, so Discord is never involved.
+"""
+import asyncio
+import sys
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("redbot")
+
+BENCHMARKS = Path(__file__).resolve().parent.parent / "benchmarks"
+
+if str(BENCHMARKS) not in sys.path:
+	sys.path.insert(0, str(BENCHMARKS))
+
+from common import setup_config
+from recurring_scheduler import START, RecordingChannel, SimulatedBot, SimulatedGuild, VirtualClock
+
+
+def run(test, data_path: Path, schedules):
+	"""Runs a test against a fresh cog, failing it if it hangs."""
+	# The cog's task loops bind to the event loop current when it is imported, so set one up first.
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+
+	async def with_cog():
+		cog, clock, guild, channel = await make_cog(loop, data_path, schedules)
+
+		try:
+			await asyncio.wait_for(test(cog, clock, guild, channel), timeout=10)
+		finally:
+			# The lease database runs on a thread of its own, which would keep the process alive.
+			cog.leases, leases = None, cog.leases
+			await leases.close()
+
+	try:
+		loop.run_until_complete(with_cog())
+	finally:
+		loop.close()
+		asyncio.set_event_loop(None)
+
+
+async def make_cog(loop, data_path: Path, schedules):
+	from recurringmessages.recurringmessages import RecurringMessages, SCHEMA_VERSION
+
+	await setup_config(data_path)
+
+	clock = VirtualClock(START)
+	guild = SimulatedGuild(10 ** 17)
+	channel = RecordingChannel(guild.id * 100, guild, clock, 0)
+	guild.channels[channel.id] = channel
+
+	cog = RecurringMessages(SimulatedBot(loop, [guild]))
+	cog.loop.cancel()
+	cog.metrics_dump.cancel()
+	cog.scheduler.clock = clock.now
+	cog.dispatcher.clock = clock.now
+
+	await cog.config.guild_from_id(guild.id).reminders.set({
+		str(reminder_id): {
+			"channel_id": channel.id,
+			"message": f"Reminder #{reminder_id}",
+			"schedule": schedule,
+			"timezone": "UTC",
+			"catch_up": "once",
+			"last_sent": (START - timedelta(minutes=1)).isoformat()
+		}
+		for reminder_id, schedule in enumerate(schedules, start=1)
+	})
+	await cog.config.guild_from_id(guild.id).last_id.set(len(schedules))
+	await cog.config.schema_version.set(SCHEMA_VERSION)
+	await cog.load_schedule()
+
+	return cog, clock, guild, channel
+
+
+async def send_next(cog, clock):
+	clock.jump(cog.scheduler.next_time())
+	await cog.send_due(cog.scheduler.pop_due(clock.now()))
+
+
+def test_send_due_twice_for_the_same_guild(tmp_path):
+	async def test(cog, clock, guild, channel):
+		await send_next(cog, clock)
+		await send_next(cog, clock)
+
+		assert len(channel.sent) == 2
+
+		stored = await cog.config.guild_from_id(guild.id).reminders()
+		assert stored["1"]["last_sent"] == (START + timedelta(minutes=5)).isoformat()
+		assert stored["2"]["last_sent"] == (START + timedelta(minutes=10)).isoformat()
+
+		# Both are due again the next day, and the guild's reminders can still be changed.
+		assert cog.scheduler.when((guild.id, 1)) == START + timedelta(days=1, minutes=5)
+		assert cog.scheduler.when((guild.id, 2)) == START + timedelta(days=1, minutes=10)
+
+		await cog.delete_reminders(guild.id, [1])
+		assert list(await cog.config.guild_from_id(guild.id).reminders()) == ["2"]
+
+	run(test, tmp_path, ["00:05", "00:10"])
+
+
+def test_failed_batch_is_retried(tmp_path):
+	from recurringmessages.recurringmessages import RETRY_DELAY
+
+	async def test(cog, clock, guild, channel):
+		# Sending fails while the lease file is being reopened.
+		leases, cog.leases = cog.leases, None
+
+		with pytest.raises(AttributeError):
+			await send_next(cog, clock)
+
+		cog.leases = leases
+		assert channel.sent == []
+		retry_at = START + timedelta(minutes=5, seconds=RETRY_DELAY)
+		assert retry_at <= cog.scheduler.when((guild.id, 1)) < retry_at + timedelta(seconds=1)
+
+		await send_next(cog, clock)
+
+		assert len(channel.sent) == 1
+		assert cog.scheduler.when((guild.id, 1)) == START + timedelta(days=1, minutes=5)
+
+	run(test, tmp_path, ["00:05"])